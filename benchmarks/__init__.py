@@ -0,0 +1,5 @@
+"""
+Checks on how long Gud takes to do things. These aren't part of the installed package - run them from the root of the repo, eg
+`python -m benchmarks.check_startup` (how long it takes to start) or `python -m benchmarks.run_benchmarks` (how long commands
+take on a generated repository)
+"""
@@ -0,0 +1,85 @@
+"""
+Checks that `gud status` doesn't import more than it needs to before it can start doing anything, using `python -X importtime`.
+Fails if any module that is only needed for prompts is imported, or if the time spent importing (everything not already
+imported by Python itself on startup) is over budget. The fastest of several runs is used, as timings are noisy.
+
+    python -m benchmarks.check_startup [--budget-ms 100] [--runs 5]
+"""
+import argparse
+import compileall
+import os
+import subprocess
+import sys
+import tempfile
+
+
+DEFAULT_BUDGET_MS = 100
+DEFAULT_RUNS = 5
+# only ever needed once a prompt is shown
+FORBIDDEN_MODULES = ["questionary", "prompt_toolkit"]
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_with_importtime(args: list, cwd: str, env: dict) -> dict:
+    """ {module name: (self time, cumulative time)} of every module imported, in microseconds """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", *args], cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode != 0:
+        sys.exit(f"`{' '.join(args)}` failed:\n{result.stderr}")
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_time, cumulative_time, name = line.removeprefix("import time:").split("|")
+        imports[name.rstrip()] = (int(self_time), int(cumulative_time))
+    return imports
+
+
+def get_import_time(imports: dict, startup_modules: set) -> int:
+    """ Time spent importing modules that Python doesn't import on startup anyway, in microseconds """
+    return sum(self_time for name, (self_time, _) in imports.items() if name.strip() not in startup_modules)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="The most time that can be spent on imports")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="How many times to run `gud status`")
+    args = parser.parse_args()
+    # as an installed package would be, rather than timing how long it takes to compile
+    compileall.compile_dir(os.path.join(REPO_ROOT, "gud"), quiet=1)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        repo_dir = os.path.join(temp_dir, "repo")
+        os.mkdir(repo_dir)
+        env = {
+            **os.environ,
+            "PYTHONPATH": os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")])),
+            # so the global config is kept in the temporary directory too
+            "HOME": temp_dir,
+            "XDG_CONFIG_HOME": os.path.join(temp_dir, ".config")
+        }
+        gud = ["-c", "from gud import main; main()"]
+        subprocess.run([sys.executable, *gud, "init", "default"], cwd=repo_dir, env=env, stdout=subprocess.DEVNULL, check=True)
+
+        startup_modules = {name.strip() for name in run_with_importtime(["-c", "pass"], repo_dir, env)}
+        import_times = []
+        for _ in range(args.runs):
+            imports = run_with_importtime([*gud, "status"], repo_dir, env)
+            import_times.append(get_import_time(imports, startup_modules))
+
+    failures = []
+    imported_names = {name.strip() for name in imports}
+    for module_name in FORBIDDEN_MODULES:
+        if module_name in imported_names:
+            failures.append(f"{module_name} was imported, but is only needed for prompts")
+    import_time_ms = min(import_times) / 1000
+    print(f"`gud status` spent {import_time_ms:.1f}ms on imports (budget {args.budget_ms:g}ms, fastest of {args.runs} runs)")
+    if import_time_ms > args.budget_ms:
+        failures.append(f"imports took {import_time_ms:.1f}ms, which is over the budget of {args.budget_ms:g}ms")
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
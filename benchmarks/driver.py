@@ -0,0 +1,38 @@
+"""
+Runs Gud commands in this process, through the same run_command() that `gud` uses, so that the benchmarks time the
+commands themselves rather than starting Python. None of the commands used may prompt (eg commits are given `-m`).
+"""
+import contextlib
+import os
+import sys
+
+
+def isolate_global_config(home_dir: str) -> dict:
+    """
+    Keep Gud's global config in home_dir, so the benchmarks don't depend on (or change) the user's own.
+    Has to be called before gud.classes is imported, which is when the location of the global config is worked out.
+    Returns the environment variables to give any subprocesses
+    """
+    os.environ["HOME"] = home_dir
+    os.environ["XDG_CONFIG_HOME"] = os.path.join(home_dir, ".config")
+    return dict(os.environ)
+
+
+def run_gud(repo_dir: str, argv: list) -> int:
+    """ Run `gud <argv>` in repo_dir, throwing away its output. Returns the exit code """
+    from gud.run import parser, run_command
+
+    all_args = parser.parse_args(argv)
+    original_cwd = os.getcwd()
+    os.chdir(repo_dir)
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            run_command(all_args, os.getcwd())
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(f"`gud {' '.join(argv)}` failed: {e.code}", file=sys.stderr)
+        return 1
+    finally:
+        os.chdir(original_cwd)
+    return 0
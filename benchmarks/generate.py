@@ -0,0 +1,228 @@
+"""
+Generates a synthetic repository for the benchmarks to run against. Everything is decided by a seeded random number generator,
+so the same options always give the same files and commit history.
+
+    python -m benchmarks.generate DIR [--files 1000] [--depth 3] [--fanout 4] [--median-file-size 2048] [--file-size-sigma 1.5]
+                                      [--max-file-size 1048576] [--ignore-rules 20] [--commits 10] [--branches 3] [--seed 0]
+
+The working directory is a tree of directories `depth` levels deep, with `fanout` subdirectories in each, and the files spread
+across all of them. File sizes follow a log-normal distribution (most files are small, a few are much larger), and their contents
+are lines of made-up words, so they compress about as well as source code does.
+The root .gudignore has `ignore_rules` rules of several kinds (globs, directories, anchored paths, **, negations), and some
+files that they ignore are created too, so that status has to skip over them.
+Each commit after the first changes about 5% of the files, and adds and deletes a few. The branches point at earlier commits,
+spread out over the history.
+
+What was generated is recorded in .gud/benchmark.json (see generate_repo), for the scenarios to use.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+from .driver import isolate_global_config, run_gud
+
+
+DEFAULT_SPEC = {
+    "files": 1000,
+    "depth": 3,
+    "fanout": 4,
+    "median_file_size": 2048, # bytes
+    "file_size_sigma": 1.5,
+    "max_file_size": 1024 * 1024, # bytes
+    "ignore_rules": 20,
+    "commits": 10,
+    "branches": 3,
+    "seed": 0
+}
+INFO_FILE_NAME = "benchmark.json"
+CHANGED_FILES_PER_COMMIT = 0.05 # the fraction of files changed by each commit
+_FILE_EXTENSIONS = [".py", ".txt", ".md", ".json", ".c"]
+_WORDS_PER_CORPUS = 200_000
+
+
+class FileGenerator:
+    """ Makes up file contents, by taking slices of a block of random words (so generating lots of files is quick) """
+    def __init__(self, rng: random.Random, spec: dict):
+        self.rng = rng
+        self.spec = spec
+        words = ["".join(rng.choices("abcdefghijklmnopqrstuvwxyz_", k=rng.randint(2, 10))) for _ in range(2000)]
+        lines = []
+        line_words = []
+        for word in rng.choices(words, k=_WORDS_PER_CORPUS):
+            line_words.append(word)
+            if len(line_words) >= rng.randint(3, 12):
+                lines.append("    " * rng.randint(0, 3) + " ".join(line_words))
+                line_words = []
+        self.corpus = ("\n".join(lines) + "\n").encode()
+
+    def random_size(self) -> int:
+        size = int(self.rng.lognormvariate(0, self.spec["file_size_sigma"]) * self.spec["median_file_size"])
+        return max(1, min(size, self.spec["max_file_size"]))
+
+    def random_contents(self, size: int) -> bytes:
+        chunks = []
+        while size > 0:
+            start = self.rng.randrange(len(self.corpus))
+            chunk = self.corpus[start:start + size]
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def write_new_file(self, abs_path: str) -> None:
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        with open(abs_path, "wb") as f:
+            f.write(self.random_contents(self.random_size()))
+
+    def modify_file(self, abs_path: str) -> None:
+        """ Replace a random part of the file, as an edit would """
+        with open(abs_path, "rb") as f:
+            contents = f.read()
+        start = self.rng.randrange(len(contents) + 1)
+        end = min(len(contents), start + self.rng.randint(0, 512))
+        replacement = self.random_contents(self.rng.randint(1, 512))
+        with open(abs_path, "wb") as f:
+            f.write(contents[:start] + replacement + contents[end:])
+
+
+def get_dir_paths(depth: int, fanout: int) -> list[str]:
+    """ Every directory in the working directory (including the root, as ""), shallowest first """
+    dir_paths = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [os.path.join(parent, f"dir{i}") for parent in level for i in range(fanout)]
+        dir_paths += level
+    return dir_paths
+
+
+def write_ignore_rules(repo_dir: str, dir_paths: list[str], file_generator: FileGenerator) -> None:
+    """ Write the root .gudignore, and create some of the files and directories that it ignores """
+    rng = file_generator.rng
+    rules = []
+    for i in range(file_generator.spec["ignore_rules"]):
+        dir_path = rng.choice(dir_paths)
+        match i % 5:
+            case 0:
+                rules.append(f"*.tmp{i}")
+                ignored_paths = [os.path.join(dir_path, f"scratch.tmp{i}")]
+            case 1:
+                rules.append(f"build{i}/")
+                ignored_paths = [os.path.join(dir_path, f"build{i}", f"output{j}.o") for j in range(5)]
+            case 2:
+                rules.append(f"**/cache{i}/**")
+                ignored_paths = [os.path.join(dir_path, f"cache{i}", f"entry{j}") for j in range(3)]
+            case 3:
+                rules.append(f"/{dir_path}/notes{i}.txt".replace("//", "/"))
+                ignored_paths = [os.path.join(dir_path, f"notes{i}.txt")]
+            case _:
+                # ignore every .log file in the dir, apart from one
+                rules += [f"/{dir_path}/*.log".replace("//", "/"), f"!keep{i}.log"]
+                ignored_paths = [os.path.join(dir_path, f"debug{i}.log")]
+                file_generator.write_new_file(os.path.join(repo_dir, dir_path, f"keep{i}.log"))
+        for ignored_path in ignored_paths:
+            file_generator.write_new_file(os.path.join(repo_dir, ignored_path))
+    with open(os.path.join(repo_dir, ".gudignore"), "w", encoding="utf-8") as f:
+        f.write("\n".join(rules) + "\n")
+
+
+def commit_all(repo_dir: str, message: str) -> str:
+    """ Stage and commit every change in the working directory. Returns the hash of the new commit """
+    for argv in (["stage", "add", "."], ["commit", "-m", message]):
+        if run_gud(repo_dir, argv) != 0:
+            sys.exit(f"`gud {' '.join(argv)}` failed while generating the repository.")
+    from gud.classes import Repository
+    return Repository(repo_dir).head
+
+
+def generate_repo(repo_dir: str, spec: dict) -> dict:
+    """
+    Create a new repository in repo_dir, as described by spec (see DEFAULT_SPEC).
+    Returns (and saves) what was generated:
+        {"spec": spec, "files": [every file in the last commit], "commits": [hashes, oldest first], "branches": {name: hash}}
+    """
+    rng = random.Random(spec["seed"])
+    file_generator = FileGenerator(rng, spec)
+    os.makedirs(repo_dir, exist_ok=True)
+    if run_gud(repo_dir, ["init", "default"]) != 0:
+        sys.exit(f"Could not create a repository in {repo_dir}.")
+
+    dir_paths = get_dir_paths(spec["depth"], spec["fanout"])
+    files = []
+    for i in range(spec["files"]):
+        file_path = os.path.join(rng.choice(dir_paths), f"file{i}{rng.choice(_FILE_EXTENSIONS)}")
+        file_generator.write_new_file(os.path.join(repo_dir, file_path))
+        files.append(file_path)
+    write_ignore_rules(repo_dir, dir_paths, file_generator)
+    commits = [commit_all(repo_dir, "Initial commit")]
+
+    num_new_files = spec["files"]
+    for commit_num in range(1, spec["commits"]):
+        for file_path in rng.sample(files, max(1, int(len(files) * CHANGED_FILES_PER_COMMIT))):
+            file_generator.modify_file(os.path.join(repo_dir, file_path))
+        for _ in range(rng.randint(0, 3)):
+            file_path = os.path.join(rng.choice(dir_paths), f"file{num_new_files}{rng.choice(_FILE_EXTENSIONS)}")
+            num_new_files += 1
+            file_generator.write_new_file(os.path.join(repo_dir, file_path))
+            files.append(file_path)
+        for _ in range(min(rng.randint(0, 2), len(files) - 1)):
+            file_path = files.pop(rng.randrange(len(files)))
+            os.remove(os.path.join(repo_dir, file_path))
+        commits.append(commit_all(repo_dir, f"Commit {commit_num}"))
+
+    # spread the branches out over the history, oldest first
+    branches = {}
+    for i in range(spec["branches"]):
+        commit_hash = commits[i * len(commits) // max(1, spec["branches"])]
+        branches[f"branch{i}"] = commit_hash
+        with open(os.path.join(repo_dir, ".gud", "heads", f"branch{i}"), "w", encoding="utf-8") as f:
+            f.write(commit_hash)
+
+    info = {"spec": spec, "files": sorted(files), "commits": commits, "branches": branches}
+    with open(os.path.join(repo_dir, ".gud", INFO_FILE_NAME), "w", encoding="utf-8") as f:
+        json.dump(info, f)
+    return info
+
+
+def load_or_generate_repo(repo_dir: str, spec: dict) -> dict:
+    """ Reuse the repository in repo_dir if it was generated with the same spec, otherwise generate it again """
+    info_path = os.path.join(repo_dir, ".gud", INFO_FILE_NAME)
+    if os.path.exists(info_path):
+        with open(info_path, encoding="utf-8") as f:
+            info = json.load(f)
+        if info["spec"] == spec:
+            return info
+    if os.path.exists(repo_dir):
+        if not os.path.exists(os.path.join(repo_dir, ".gud", INFO_FILE_NAME)):
+            sys.exit(f"{repo_dir} already exists, and wasn't generated by the benchmarks - refusing to replace it.")
+        shutil.rmtree(repo_dir)
+    return generate_repo(repo_dir, spec)
+
+
+def add_spec_arguments(parser: argparse.ArgumentParser) -> None:
+    """ An option for each value in DEFAULT_SPEC """
+    for name, default in DEFAULT_SPEC.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", dest=name, type=type(default), default=default, help=f"(default {default})")
+
+
+def get_spec(args: argparse.Namespace) -> dict:
+    return {name: getattr(args, name) for name in DEFAULT_SPEC}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("repo_dir", help="Where to create the repository (which mustn't already exist)")
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+    if os.path.exists(args.repo_dir):
+        sys.exit(f"{args.repo_dir} already exists.")
+    repo_dir = os.path.abspath(args.repo_dir)
+    with tempfile.TemporaryDirectory() as home_dir:
+        isolate_global_config(home_dir)
+        info = generate_repo(repo_dir, get_spec(args))
+    print(f"Generated {len(info['files'])} files, {len(info['commits'])} commits and {len(info['branches'])} branches in {repo_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Runs a single Gud command in a fresh process, and prints (as JSON) what it cost. Used by run_benchmarks, so that each
+measurement has a process to itself (peak memory use can't be reset, and nothing is left cached from a previous command).
+
+    python -m benchmarks.measure REPO_DIR '["status"]'
+
+Only the command itself is timed - not starting Python or importing Gud, which check_startup covers.
+The syscall counts are the read and write syscalls from /proc/self/io (Linux only, otherwise None), plus the files opened,
+directories listed and files mmap'd (counted with an audit hook, as they are made from Python).
+"""
+import json
+import os
+import sys
+import time
+from .driver import run_gud
+
+
+# audit event -> what it's counted as
+_COUNTED_AUDIT_EVENTS = {
+    "open": "opens",
+    "os.scandir": "dir_listings",
+    "os.listdir": "dir_listings",
+    "mmap.__new__": "mmaps"
+}
+
+
+def read_proc_io() -> dict|None:
+    """ {"syscr": ..., "syscw": ..., ...} for this process, or None if it can't be read """
+    try:
+        with open("/proc/self/io", encoding="utf-8") as f:
+            return {key: int(value) for key, value in (line.split(": ") for line in f.read().splitlines())}
+    except OSError:
+        return None
+
+
+def get_peak_rss_kb() -> int|None:
+    try:
+        import resource
+    except ImportError: # (Windows)
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss // 1024 if sys.platform == "darwin" else peak_rss # (bytes on macOS, KB everywhere else)
+
+
+def measure(repo_dir: str, argv: list) -> dict:
+    # imported up front, so it isn't timed
+    import gud.run, gud.classes, gud.commands
+
+    counts = dict.fromkeys(_COUNTED_AUDIT_EVENTS.values(), 0)
+    def count_event(event: str, _) -> None:
+        if event in _COUNTED_AUDIT_EVENTS:
+            counts[_COUNTED_AUDIT_EVENTS[event]] += 1
+
+    io_before = read_proc_io()
+    sys.addaudithook(count_event)
+    start = time.perf_counter()
+    exit_code = run_gud(repo_dir, argv)
+    wall_time = time.perf_counter() - start
+    final_counts = dict(counts) # (so reading /proc/self/io again isn't counted)
+    io_after = read_proc_io()
+
+    syscalls = {
+        "reads": io_after["syscr"] - io_before["syscr"] if io_before and io_after else None,
+        "writes": io_after["syscw"] - io_before["syscw"] if io_before and io_after else None,
+        **final_counts
+    }
+    return {"exit_code": exit_code, "wall_time_s": wall_time, "peak_rss_kb": get_peak_rss_kb(), "syscalls": syscalls}
+
+
+def main():
+    repo_dir, argv = sys.argv[1], json.loads(sys.argv[2])
+    result = measure(os.path.abspath(repo_dir), argv)
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
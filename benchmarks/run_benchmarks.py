@@ -0,0 +1,198 @@
+"""
+Times common Gud commands against a synthetic repository (see generate.py), and reports the results as JSON.
+
+    python -m benchmarks.run_benchmarks [--runs 3] [--scenarios status_clean log ...] [--repo DIR] [--output FILE]
+                                        [--baseline FILE] [--save-baseline] [--threshold 0.2] [generator options...]
+
+Each scenario is run on a fresh copy of the repository: its setup (eg editing some files, then staging them) isn't timed,
+and then the command is run and measured in a new process (see measure.py). Every copy starts with a `gud status`,
+as copying the files changes their inodes and ctimes, which would otherwise make the first command re-hash everything.
+For each scenario, the median wall time is reported (along with every run's), as are the peak RSS and syscall counts of that run.
+
+If there's a baseline (benchmarks/baseline.json by default, which --save-baseline writes), each scenario's wall time,
+peak RSS and syscall counts are compared against it, and the exit code is 1 if any got worse by more than the threshold.
+Baselines are only comparable if they were made with the same generator options (and on the same machine, for wall times).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+from .driver import isolate_global_config, run_gud
+from .generate import FileGenerator, CHANGED_FILES_PER_COMMIT, add_spec_arguments, get_spec, load_or_generate_repo
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+DEFAULT_BASELINE_PATH = os.path.join(BENCHMARKS_DIR, "baseline.json")
+DEFAULT_RUNS = 3
+DEFAULT_THRESHOLD = 0.2 # how much worse than the baseline a result can be before it counts as a regression
+SETUP_SEED = 1 # so that every run of a scenario changes the same files
+
+
+class Scenario:
+    """ A Gud command to time, and the (untimed) setup it needs """
+    def __init__(self, name: str, argv, setup=None):
+        self.name = name
+        self._argv = argv # or a function of the repo info, if it depends on the generated repo
+        self._setup = setup
+
+    def get_argv(self, info: dict) -> list:
+        return self._argv(info) if callable(self._argv) else self._argv
+
+    def setup(self, repo_dir: str, info: dict) -> None:
+        if run_gud(repo_dir, ["status"]) != 0:
+            sys.exit(f"`gud status` failed while setting up {self.name}.")
+        if self._setup is not None:
+            self._setup(repo_dir, info)
+
+
+def modify_some_files(repo_dir: str, info: dict) -> None:
+    """ Edit the same fraction of files as each generated commit did, and add and delete a couple """
+    file_generator = FileGenerator(random.Random(SETUP_SEED), info["spec"])
+    files = info["files"]
+    for file_path in file_generator.rng.sample(files, max(1, int(len(files) * CHANGED_FILES_PER_COMMIT))):
+        file_generator.modify_file(os.path.join(repo_dir, file_path))
+    for i in range(2):
+        file_generator.write_new_file(os.path.join(repo_dir, os.path.dirname(files[i]), f"new_file{i}.txt"))
+    os.remove(os.path.join(repo_dir, files[-1]))
+
+
+def modify_and_stage_files(repo_dir: str, info: dict) -> None:
+    modify_some_files(repo_dir, info)
+    if run_gud(repo_dir, ["stage", "add", "."]) != 0:
+        sys.exit("`gud stage add .` failed while setting up a benchmark.")
+
+
+def modify_first_file(repo_dir: str, info: dict) -> None:
+    with open(os.path.join(repo_dir, info["files"][0]), "ab") as f:
+        f.write(b"an unstaged change\n")
+
+
+SCENARIOS = [
+    Scenario("status_clean", ["status"]),
+    Scenario("status_modified", ["status"], modify_some_files),
+    Scenario("stage_add", ["stage", "add", "."], modify_some_files),
+    Scenario("commit", ["commit", "-m", "Benchmark commit"], modify_and_stage_files),
+    Scenario("log", ["log", "--no-pager"]),
+    # to the oldest branch, so (nearly) every file that was ever changed has to be changed back
+    Scenario("checkout", lambda info: ["checkout", "--hash", next(iter(info["branches"].values()), info["commits"][0])]),
+    Scenario("restore", lambda info: ["restore", info["files"][0]], modify_first_file)
+]
+
+
+def run_scenario(scenario: Scenario, template_dir: str, info: dict, work_dir: str, env: dict) -> dict:
+    """ Set up a copy of the repository, then measure the command in a new process """
+    repo_dir = os.path.join(work_dir, "repo")
+    shutil.copytree(template_dir, repo_dir, symlinks=True)
+    try:
+        scenario.setup(repo_dir, info)
+        argv = scenario.get_argv(info)
+        result = subprocess.run(
+            [sys.executable, "-m", "benchmarks.measure", repo_dir, json.dumps(argv)],
+            cwd=REPO_ROOT, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+        )
+        if result.returncode != 0:
+            sys.exit(f"Measuring {scenario.name} failed:\n{result.stderr}")
+        measurement = json.loads(result.stdout)
+        if measurement["exit_code"] != 0:
+            sys.exit(f"`gud {' '.join(argv)}` failed in {scenario.name}:\n{result.stderr}")
+        return measurement
+    finally:
+        shutil.rmtree(repo_dir)
+
+
+def summarise(measurements: list[dict]) -> dict:
+    """ The run with the median wall time, along with every run's wall time """
+    wall_times = [measurement["wall_time_s"] for measurement in measurements]
+    median_run = sorted(measurements, key=lambda measurement: measurement["wall_time_s"])[(len(measurements) - 1) // 2]
+    return {
+        "wall_time_s": statistics.median(wall_times),
+        "wall_times_s": wall_times,
+        "peak_rss_kb": median_run["peak_rss_kb"],
+        "syscalls": median_run["syscalls"]
+    }
+
+
+def get_comparable_metrics(result: dict) -> dict:
+    """ {metric name: value} of every metric that's compared against the baseline """
+    metrics = {"wall_time_s": result["wall_time_s"], "peak_rss_kb": result["peak_rss_kb"]}
+    for name, count in result["syscalls"].items():
+        metrics[f"syscalls.{name}"] = count
+    return {name: value for name, value in metrics.items() if value is not None}
+
+
+def compare_to_baseline(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """ Print how each scenario compares to the baseline. Returns a description of every regression """
+    if baseline["spec"] != results["spec"]:
+        print("The baseline was made with different generator options, so can't be compared against.", file=sys.stderr)
+        return []
+    regressions = []
+    for name, result in results["scenarios"].items():
+        baseline_result = baseline["scenarios"].get(name)
+        if baseline_result is None:
+            continue
+        baseline_metrics = get_comparable_metrics(baseline_result)
+        for metric, value in get_comparable_metrics(result).items():
+            baseline_value = baseline_metrics.get(metric)
+            if not baseline_value:
+                continue
+            change = value / baseline_value - 1
+            print(f"{name:16} {metric:24} {baseline_value:>12g} -> {value:<12g} ({change:+.1%})", file=sys.stderr)
+            if change > threshold:
+                regressions.append(f"{name}: {metric} went from {baseline_value:g} to {value:g} ({change:+.1%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="How many times to run each scenario")
+    parser.add_argument("--scenarios", nargs="+", choices=[scenario.name for scenario in SCENARIOS], help="Only run these scenarios")
+    parser.add_argument("--repo", help="Keep the generated repository here, and reuse it next time (if the generator options match)")
+    parser.add_argument("--output", help="Write the results to this file, rather than printing them")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="The results to compare against, if the file exists")
+    parser.add_argument("--save-baseline", action="store_true", help="Save the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="The fraction a metric can get worse by")
+    add_spec_arguments(parser)
+    args = parser.parse_args()
+    spec = get_spec(args)
+    scenarios = [scenario for scenario in SCENARIOS if not args.scenarios or scenario.name in args.scenarios]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        env = isolate_global_config(os.path.join(temp_dir, "home"))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get("PYTHONPATH")]))
+        template_dir = os.path.abspath(args.repo) if args.repo else os.path.join(temp_dir, "template")
+        info = load_or_generate_repo(template_dir, spec)
+
+        results = {"spec": spec, "python": platform.python_version(), "platform": sys.platform, "runs": args.runs, "scenarios": {}}
+        for scenario in scenarios:
+            measurements = [run_scenario(scenario, template_dir, info, temp_dir, env) for _ in range(args.runs)]
+            results["scenarios"][scenario.name] = summarise(measurements)
+            print(f"{scenario.name}: {results['scenarios'][scenario.name]['wall_time_s'] * 1000:.1f}ms", file=sys.stderr)
+
+    results_json = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(results_json + "\n")
+    else:
+        print(results_json)
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare_to_baseline(results, json.load(f), args.threshold)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            f.write(results_json + "\n")
+        print(f"Saved the results as the baseline, in {args.baseline}", file=sys.stderr)
+    if regressions:
+        sys.exit("Regressions (compared to the baseline):\n" + "\n".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,34 +1,62 @@
 import argparse
 import os
 import sys
-from os.path import realpath
 from datetime import datetime
 from configparser import ConfigParser
 from .helpers import (
     OperatingSystem,
-    get_file_from_package_installation
+    get_file_from_package_installation,
+    get_empty_stat_info,
+    get_entry_signature,
+    get_mtime,
+    get_new_file_permissions,
+    find_repo_root_dir,
+    LRUCache,
+    LazyModule
 )
-from .globals import COMPRESSION_LEVEL
-import platform
+from .globals import (
+    COMPRESSION_LEVEL,
+    INDEX_STAT_FIELDS,
+    LEGACY_OBJECT_FORMAT,
+    OBJECT_CACHE_SIZE,
+    OBJECT_FORMAT_VERSION,
+    OBJECT_STREAM_CHUNK_SIZE,
+    PACK_DELTA_WINDOW,
+    PACK_DELTA_WINDOW_MEMORY,
+    PACK_MAX_DELTA_DEPTH,
+    PACK_MAX_DELTA_OBJECT_SIZE
+)
+from .index import IndexFile, CacheTree, FsMonitorState, CACHE_TREE_SIGNATURE, FSMONITOR_SIGNATURE
+from .packs import PackStore, PackWriter
+from .commit_graph import CommitGraph, CommitGraphWriter
+from .delta import DeltaIndex
+from .trace import traced
+import io
+import shutil
 import zlib
+from bisect import bisect_left
+from collections import deque
 from hashlib import sha1
-from questionary import Validator, ValidationError
 import appdirs
 
+tempfile = LazyModule("tempfile") # only needed when writing objects
+
 
 class CommandInvocation:
-    def __init__(self, all_args: argparse.Namespace, cwd: str):
+    def __init__(self, all_args: argparse.Namespace, cwd: str, repo: "Repository|None" = None):
         self.command: str = all_args.command
         self.args: dict = __class__.get_additional_commands(all_args)
         self.cwd = cwd # current working directory
         self.timestamp = __class__.get_timestamp_aware()
         # get the OS of the host system
         try:
-            pltform = platform.system()
+            pltform = "Windows" if os.name == "nt" else os.uname().sysname # (the same as platform.system(), which is slow to import)
             self.os = OperatingSystem(pltform)
         except ValueError:
             sys.exit(f"Your platform ({pltform}) is not supported.\nSupported platforms: {OperatingSystem.get_all_names()}")
-        if self.command == "init":
+        if repo is not None: # kept open between commands (see daemon.py)
+            self.repo = repo
+        elif self.command == "init":
             self.repo = Repository(cwd, create_new_repo=True)
         else:
             self.repo = Repository(cwd)
@@ -50,7 +78,7 @@ class CommandInvocation:
 class Repository:
     def __init__(self, cwd: str, create_new_repo = False):
         if create_new_repo:
-            existing_repo_root_dir = __class__.find_repo_root_dir(cwd)
+            existing_repo_root_dir = find_repo_root_dir(cwd)
             if existing_repo_root_dir:
                 existing_repo_path = os.path.join(existing_repo_root_dir, ".gud/")
                 sys.exit(f"Repository already exists at {existing_repo_path}")
@@ -58,19 +86,105 @@ class Repository:
                 self.root = cwd
                 self.path = os.path.join(self.root, ".gud/")
         else:
-            self.root = __class__.find_repo_root_dir(cwd)
+            self.root = find_repo_root_dir(cwd)
             if not self.root:
                 sys.exit("No gud repository found in this directory, or in any parent directory.\nUse `gud init` to create a repository.")
             self.path = os.path.join(self.root, ".gud/")
 
-        self.global_config = GlobalConfig()
+        self.is_new_repo = create_new_repo
         self.repo_config = RepoConfig(repo_path=self.path)
+        self._global_config = None
+        self._config = None
+        self._config_mtimes = None # of the global and repo config files, when self._config was read
+        self._config_checked = False
+        self._refs = None # (branch, head, detached head)
+
+        self._forget_index()
+        self._packs = None
+        self._object_writer = None
+        self._object_cache = None
+        self._commit_graph = None
+        self._commit_graph_checked = False
+
+        if create_new_repo:
+            self.object_format = OBJECT_FORMAT_VERSION
+        else: # if the .gud dir already exists
+            self._read_repo_state()
+
+    def _read_repo_state(self) -> None:
+        self.object_format = self.get_object_format()
+        if self.object_format > OBJECT_FORMAT_VERSION:
+            sys.exit(f"This repository uses object format {self.object_format}, which is newer than this version of Gud supports.\nPlease upgrade Gud.")
+
+    @property
+    def global_config(self) -> "GlobalConfig":
+        if self._global_config is None:
+            self._global_config = GlobalConfig() # (creates the global config file if it doesn't exist yet)
+        return self._global_config
+
+    @property
+    def config(self) -> ConfigParser:
+        """
+        The global and repo config combined - only read when first needed, and only re-read (after a refresh)
+        if either file has been modified since
+        """
+        if not self._config_checked:
+            global_config_path = self.global_config.path
+            config_mtimes = (get_mtime(global_config_path), get_mtime(self.repo_config.path))
+            if config_mtimes != self._config_mtimes:
+                self._config = self.resolve_working_config()
+                self._config_mtimes = config_mtimes
+            self._config_checked = True
+        return self._config
+
+    @property
+    def branch(self) -> str:
+        """ The name of the current branch """
+        return self._get_refs()[0]
+
+    @property
+    def head(self) -> str|None:
+        """ The commit at the head of the current branch """
+        return self._get_refs()[1]
 
-        if not create_new_repo: # if the .gud dir already exists
-            self.config = self.resolve_working_config()
-            self.branch = self.get_current_branch() # get the name of the branch
-            self.head: str|None = self.get_head() # get the commit of the HEAD
-            self.detached_head: str|None = self.get_current_detached_head() # commit of detached head (if it exists)
+    @property
+    def detached_head(self) -> str|None:
+        """ The commit that is checked out, if it isn't the head of a branch """
+        return self._get_refs()[2]
+
+    def _get_refs(self) -> tuple[str, str|None, str|None]:
+        """
+        The refs are read together, the first time any of them is needed, so they are always consistent with each other
+        (and stay as they were, even once a command starts changing them)
+        """
+        if self._refs is None:
+            branch = self.get_current_branch()
+            self._refs = (branch, self.get_head(branch), self.get_current_detached_head())
+        return self._refs
+
+    def _forget_index(self) -> None:
+        # set when the index is parsed - used to detect "racily clean" index entries
+        self.index_mtime = 0
+        self._racy_entries = {}
+        self.cache_tree = CacheTree()
+        self.fsmonitor_state = FsMonitorState()
+        self._indexed_signatures = None # {file_path: signature} as of the last read/write of the index
+
+    def refresh(self) -> None:
+        """
+        Catch up with any changes made by other processes, for when the repo is kept open between commands (see daemon.py).
+        Objects never change once written, so parsed ones are kept - but the refs and config are re-read, the index is
+        forgotten (so it's parsed again by the next command), and packs or a commit-graph that have been replaced are closed
+        """
+        self._forget_index()
+        self._object_writer = None # (it remembers which fan-out dirs exist)
+        if self._packs is not None:
+            self._packs.refresh()
+        if self._commit_graph is None or self._commit_graph.is_stale():
+            self.close_commit_graph()
+        self._read_repo_state()
+        self._config_checked = False
+        self._refs = None
 
     def create_repo(self) -> None:
         """
@@ -97,11 +211,78 @@ class Repository:
         head_path = os.path.join(self.path, "DETACHED_HEAD")
         with open(head_path, "w", encoding="utf-8") as f:
             pass # initially empty
-        # create index
-        index_path = os.path.join(self.path, "index")
-        with open(index_path, "w", encoding="utf-8") as f:
-            pass
+        # create (empty) index
+        IndexFile(os.path.join(self.path, "index")).write({})
+        # create FORMAT - this stores the version of the object format in use
+        self.set_object_format(self.object_format)
         
+    @property
+    def packs(self) -> PackStore:
+        """ Shared by every object in the repo, so pack files are only opened once """
+        if self._packs is None:
+            self._packs = PackStore(os.path.join(self.path, "objects"))
+        return self._packs
+
+    @property
+    def object_writer(self) -> "ObjectWriter":
+        if self._object_writer is None:
+            self._object_writer = ObjectWriter(self)
+        return self._object_writer
+
+    @property
+    def object_cache(self) -> LRUCache:
+        """ Parsed trees and commits, keyed by (object type, hash) - shared so nothing is decoded twice """
+        if self._object_cache is None:
+            max_size = OBJECT_CACHE_SIZE
+            if not self.is_new_repo:
+                max_size = self.config.getint("core", "object_cache_size", fallback=OBJECT_CACHE_SIZE)
+            self._object_cache = LRUCache(max_size)
+        return self._object_cache
+
+    @property
+    def commit_graph(self) -> CommitGraph|None:
+        """ The mmap'd commit-graph, or None if one hasn't been written yet """
+        if not self._commit_graph_checked:
+            commit_graph_path = os.path.join(self.path, "commit-graph")
+            if os.path.exists(commit_graph_path):
+                self._commit_graph = CommitGraph(commit_graph_path)
+            self._commit_graph_checked = True
+        return self._commit_graph
+
+    def close_commit_graph(self) -> None:
+        """ Required before replacing the commit-graph (it'll be re-read if needed) """
+        if self._commit_graph is not None:
+            self._commit_graph.close()
+        self._commit_graph = None
+        self._commit_graph_checked = False
+
+    def get_num_threads(self) -> int:
+        """ How many threads to hash/write files on - GUD_THREADS takes priority over the config """
+        num_threads = os.environ.get("GUD_THREADS")
+        if not num_threads and not self.is_new_repo:
+            num_threads = self.config.get("core", "threads", fallback=None)
+        if not num_threads:
+            return os.cpu_count() or 1
+        try:
+            return max(1, int(num_threads))
+        except ValueError:
+            sys.exit(f"Invalid number of threads: {num_threads}")
+
+    def get_object_format(self) -> int:
+        """ Repositories created before the FORMAT file existed use the legacy object format """
+        format_file_path = os.path.join(self.path, "FORMAT")
+        try:
+            with open(format_file_path, "r", encoding="utf-8") as f:
+                return int(f.read().strip())
+        except FileNotFoundError:
+            return LEGACY_OBJECT_FORMAT
+
+    def set_object_format(self, version: int) -> None:
+        format_file_path = os.path.join(self.path, "FORMAT")
+        with open(format_file_path, "w", encoding="utf-8") as f:
+            f.write(str(version))
+        self.object_format = version
+
     def get_current_branch(self) -> str:
         branch_ref_file_path = os.path.join(self.path, "BRANCH")
         with open(branch_ref_file_path, "r", encoding="utf-8") as f:
@@ -164,44 +345,81 @@ class Repository:
         global_config = self.global_config.get_config()
         self.repo_config.set_config(global_config)
 
+    @traced("parse index")
     def parse_index(self) -> dict:
-        """ The index contains file paths relative to the root of the repo """
-        index_path = os.path.join(self.path, "index")
-        indexed_files = {}
-        with open(index_path, "r", encoding="utf-8") as f:
-            lines = [line.strip() for line in f.readlines()]
-            for line in lines:
-                file_mode, file_type, file_hash, file_path = line.split("\t")
-                indexed_files[file_path] = {
-                    "type": file_type,
-                    "mode": file_mode,
-                    "hash": file_hash
-                }
+        """
+        The index contains file paths relative to the root of the repo.
+        Each entry also caches the stat info of the file from when it was last hashed,
+        so that unchanged files don't need to be hashed again
+        """
+        index_file = IndexFile(os.path.join(self.path, "index"))
+        indexed_files = index_file.read()
+        self.index_mtime = index_file.mtime
+        self.cache_tree = CacheTree.from_bytes(index_file.extensions.get(CACHE_TREE_SIGNATURE))
+        self.fsmonitor_state = FsMonitorState.from_bytes(index_file.extensions.get(FSMONITOR_SIGNATURE))
+        self._indexed_signatures = {file_path: get_entry_signature(entry) for file_path, entry in indexed_files.items()}
+        self._racy_entries = {}
+        for file_path, entry in indexed_files.items():
+            if self.is_racy_entry(entry):
+                stat_values = tuple(entry[field] for field in INDEX_STAT_FIELDS)
+                self._racy_entries[file_path] = (entry["hash"], stat_values)
+        if index_file.is_legacy: # one-off conversion from the old text format
+            self.write_to_index(indexed_files)
         return indexed_files
+
+    def get_index_entry(self, file_path: str) -> dict|None:
+        """ Look up a single path in the index, without parsing the whole thing """
+        return IndexFile(os.path.join(self.path, "index")).lookup(file_path)
     
-    def write_to_index(self, new_index_dict) -> None:
-        index_path = os.path.join(self.path, "index")
-        with open(index_path, "w", encoding="utf-8") as f:
-            for file_path in new_index_dict:
-                file_mode = new_index_dict[file_path]["mode"]
-                file_type = new_index_dict[file_path]["type"]
-                file_hash = new_index_dict[file_path]["hash"]
-                f.write(f"{file_mode}\t{file_type}\t{file_hash}\t{file_path}\n")
-    
-    @staticmethod
-    def find_repo_root_dir(curr_path) -> str:
+    @traced("write index")
+    def write_to_index(self, new_index_dict, cache_tree: CacheTree|None = None, fsmonitor_state: FsMonitorState|None = None) -> None:
         """
-        Recurse up the path tree to find the parent dir of
-        the deepest .gud/ directory, if there is one
+        Unless a cache_tree that is known to match the new entries is given,
+        the cached tree of every directory above an added, changed or removed entry is invalidated.
+        Likewise, unless a new fsmonitor_state is given, every added, changed or removed path is marked as dirty
         """
-        while True:
-            parent_dir_path = realpath(os.path.dirname(curr_path))
-            if curr_path == parent_dir_path:
-                return ""
-            if ".gud" in os.listdir(curr_path):
-                break
-            curr_path = parent_dir_path
-        return curr_path   
+        new_signatures = {file_path: get_entry_signature(entry) for file_path, entry in new_index_dict.items()}
+        changed_paths = None # None if there's nothing to compare against, so nothing can be trusted
+        if self._indexed_signatures is not None:
+            old_signatures = self._indexed_signatures
+            changed_paths = [file_path for file_path, signature in new_signatures.items() if old_signatures.get(file_path) != signature]
+            changed_paths.extend(old_signatures.keys() - new_signatures.keys())
+        if cache_tree is not None:
+            self.cache_tree = cache_tree
+        elif changed_paths is None:
+            self.cache_tree = CacheTree()
+        else:
+            for file_path in changed_paths:
+                self.cache_tree.invalidate(file_path)
+        if fsmonitor_state is not None:
+            self.fsmonitor_state = fsmonitor_state
+        elif changed_paths is None:
+            self.fsmonitor_state = FsMonitorState()
+        else:
+            self.fsmonitor_state.dirty_paths.update(changed_paths)
+        self._indexed_signatures = new_signatures
+
+        entries_to_write = {}
+        for file_path, entry in new_index_dict.items():
+            stat_values = tuple(entry.get(field, 0) for field in INDEX_STAT_FIELDS)
+            # a racy entry carried over unchanged from the old index has never been verified
+            # against its stat info, so "smudge" it to force it to be re-hashed next time
+            if self._racy_entries.get(file_path) == (entry["hash"], stat_values):
+                entry = {**entry, **get_empty_stat_info()}
+            entries_to_write[file_path] = entry
+        extensions = {}
+        if self.cache_tree.trees:
+            extensions[CACHE_TREE_SIGNATURE] = self.cache_tree.to_bytes()
+        if self.fsmonitor_state.token:
+            extensions[FSMONITOR_SIGNATURE] = self.fsmonitor_state.to_bytes()
+        IndexFile(os.path.join(self.path, "index")).write(entries_to_write, extensions)
+
+    def is_racy_entry(self, index_entry: dict) -> bool:
+        """
+        If a file was modified in the same timestamp "tick" as the index was written,
+        its stat info can match even though its contents changed, so it can't be trusted
+        """
+        return bool(index_entry.get("mtime")) and index_entry["mtime"] >= self.index_mtime
 
 
 class GudObject:
@@ -209,48 +427,294 @@ class GudObject:
         self.repo = repo
         self.objects_dir = os.path.join(repo.path, "objects")
 
+    @traced()
     def serialise_object(self, uncompressed_content: bytes, object_type: str, write_to_file=False) -> str:
         uncompressed_size = len(uncompressed_content)
         header = f"{object_type} {uncompressed_size}\0".encode()
-        compressed_content = zlib.compress(uncompressed_content, level=COMPRESSION_LEVEL)
-        full_content = header + compressed_content
-        hash = sha1(full_content).hexdigest()
+        compressed_content = None
+        if self.repo.object_format == LEGACY_OBJECT_FORMAT: # the hash depends on the compressed content
+            compressed_content = zlib.compress(uncompressed_content, level=COMPRESSION_LEVEL)
+            hash = sha1(header + compressed_content).hexdigest()
+        else: # only compress if actually storing the object
+            hash = sha1(header + uncompressed_content).hexdigest()
+        object_writer = self.repo.object_writer
+        if write_to_file and not object_writer.object_exists(hash):
+            if compressed_content is None:
+                compressed_content = zlib.compress(uncompressed_content, level=COMPRESSION_LEVEL)
+            object_writer.write_object(hash, header + compressed_content)
+        return hash
+
+    def serialise_file(self, file_path: str, object_type: str, write_to_file=False) -> str:
+        """
+        The same as serialise_object, but for the contents of a file.
+        Large files are hashed (and compressed) one chunk at a time and streamed into a temporary
+        object file, which is moved into place once the hash is known - so memory use stays
+        constant no matter how big the file is
+        """
+        with open(file_path, "rb") as f:
+            uncompressed_size = os.fstat(f.fileno()).st_size
+            if uncompressed_size <= OBJECT_STREAM_CHUNK_SIZE: # small enough to just read in one go
+                return self.serialise_object(f.read(), object_type, write_to_file)
+
+            header = f"{object_type} {uncompressed_size}\0".encode()
+            if self.repo.object_format == LEGACY_OBJECT_FORMAT: # the hash needs compressing anyway, so do it all at once
+                return self._stream_file_into_object(f, file_path, header, uncompressed_size, write_to_file)
+            # hashing is much cheaper than compressing, so hash first, and only compress if the object is new
+            hash = self._stream_file_into_object(f, file_path, header, uncompressed_size, write_to_file=False)
+            if write_to_file and not self.repo.object_writer.object_exists(hash):
+                f.seek(0)
+                if self._stream_file_into_object(f, file_path, header, uncompressed_size, write_to_file=True) != hash:
+                    raise Exception(f"{file_path} was modified while it was being read.")
+        return hash
+
+    def _stream_file_into_object(self, f, file_path: str, header: bytes, uncompressed_size: int, write_to_file: bool) -> str:
+        is_legacy_format = self.repo.object_format == LEGACY_OBJECT_FORMAT
+        hasher = sha1(header)
+        # compressing is only needed to store the object, or if the hash depends on the compressed content
+        compressor = zlib.compressobj(COMPRESSION_LEVEL) if (write_to_file or is_legacy_format) else None
+        temp_file = None
         if write_to_file:
-            obj_file_path = self.get_full_file_path_from_hash(hash)
-            dir_path = os.path.dirname(obj_file_path)
-            if not os.path.exists(dir_path):
-                os.mkdir(dir_path)
-            with open(obj_file_path, "wb") as f:
-                f.write(full_content)
+            temp_file, temp_file_path = self.repo.object_writer.create_temp_file()
+            temp_file.write(header)
+        try:
+            bytes_read = 0
+            while chunk := f.read(OBJECT_STREAM_CHUNK_SIZE):
+                bytes_read += len(chunk)
+                compressed_chunk = compressor.compress(chunk) if compressor else b""
+                hasher.update(compressed_chunk if is_legacy_format else chunk)
+                if temp_file:
+                    temp_file.write(compressed_chunk)
+            if compressor:
+                compressed_chunk = compressor.flush()
+                if is_legacy_format:
+                    hasher.update(compressed_chunk)
+                if temp_file:
+                    temp_file.write(compressed_chunk)
+            if bytes_read != uncompressed_size:
+                raise Exception(f"{file_path} was modified while it was being read.")
+            hash = hasher.hexdigest()
+            if temp_file:
+                temp_file.close()
+                self.repo.object_writer.move_temp_file_into_place(temp_file_path, hash)
+        except BaseException:
+            if temp_file:
+                temp_file.close()
+                os.remove(temp_file_path)
+            raise
         return hash
 
+    @traced()
     def deserialise_object(self, obj_hash: str, expected_type=None) -> bytes:
         """
         Serialised/stored data -> usable/readable data
         """
-        full_file_path = self.get_full_file_path_from_hash(obj_hash)
-        with open(full_file_path, "rb") as f:
-            full_content = f.read()
-        try:
-            header, compressed_content = full_content.split(b"\0", 1) # only split on the first occurence
-        except ValueError:
-            raise ValueError("Null delimiter not found - incorrect blob format being read.")
-        type, uncompressed_size_str = header.decode().split(" ")
+        compressed_object = self.open_compressed_object(obj_hash)
+        if compressed_object is None: # a delta in a pack
+            pack, offset = self._find_packed_object(obj_hash)
+            type, uncompressed_content = pack.read_object(offset)
+            if expected_type:
+                assert type == expected_type
+            return uncompressed_content
+        type, uncompressed_size, compressed_stream = compressed_object
+        with compressed_stream:
+            compressed_content = compressed_stream.read()
         # if expecting the object to be a certain type, check it is this type
         if expected_type:
             assert type == expected_type
         uncompressed_content = zlib.decompress(compressed_content)
-        assert int(uncompressed_size_str) == len(uncompressed_content)
+        assert uncompressed_size == len(uncompressed_content)
         return uncompressed_content
 
+    def open_compressed_object(self, obj_hash: str) -> tuple|None:
+        """
+        Find an object, whether it is a loose object or in a pack.
+        Returns its type, its uncompressed size, and a stream of its compressed content.
+        Objects stored as deltas in a pack have no compressed content of their own, so None is returned for these
+        """
+        full_file_path = self.get_full_file_path_from_hash(obj_hash)
+        try:
+            f = open(full_file_path, "rb")
+        except FileNotFoundError:
+            pack, offset = self._find_packed_object(obj_hash)
+            if pack.is_delta(offset):
+                return None
+            return pack.open_compressed(offset)
+        try:
+            header = b""
+            while b"\0" not in header:
+                chunk = f.read(64)
+                if not chunk:
+                    raise ValueError("Null delimiter not found - incorrect blob format being read.")
+                header += chunk
+            header = header.split(b"\0", 1)[0] # only split on the first occurence
+            f.seek(len(header) + 1) # move to the start of the compressed content
+            type, uncompressed_size_str = header.decode().split(" ")
+        except BaseException:
+            f.close()
+            raise
+        return type, int(uncompressed_size_str), f
+
+    def get_object_header(self, obj_hash: str) -> tuple[str, int]:
+        """ The type and uncompressed size of an object, without decompressing it """
+        compressed_object = self.open_compressed_object(obj_hash)
+        if compressed_object is None:
+            pack, offset = self._find_packed_object(obj_hash)
+            return pack.get_object_header(offset)
+        type, uncompressed_size, compressed_stream = compressed_object
+        compressed_stream.close()
+        return type, uncompressed_size
+
+    def _find_packed_object(self, obj_hash: str) -> tuple:
+        packed_object = self.repo.packs.find(obj_hash)
+        if packed_object is None:
+            raise FileNotFoundError(f"Hash {obj_hash} does not exist.")
+        return packed_object
+
+    def open_object(self, obj_hash: str, expected_type=None) -> io.RawIOBase:
+        """
+        Like deserialise_object, but returns a file-like object that decompresses the content
+        as it is read, rather than decompressing it all into memory at once.
+        (Deltas have to be rebuilt in memory anyway, so for these the content is read all at once)
+        """
+        compressed_object = self.open_compressed_object(obj_hash)
+        if compressed_object is None:
+            return io.BytesIO(self.deserialise_object(obj_hash, expected_type))
+        type, uncompressed_size, compressed_stream = compressed_object
+        if expected_type and type != expected_type:
+            compressed_stream.close()
+            assert type == expected_type
+        return ObjectReader(compressed_stream, type, uncompressed_size)
+
+    def copy_object_to_file(self, obj_hash: str, file_path: str, expected_type=None) -> None:
+        """ Write an object's (uncompressed) contents to file_path, in bounded chunks """
+        with self.open_object(obj_hash, expected_type) as reader, open(file_path, "wb") as f:
+            shutil.copyfileobj(reader, f, OBJECT_STREAM_CHUNK_SIZE)
+
     def get_full_file_path_from_hash(self, hash: str, should_exist=False) -> str:
         dir_name = hash[:2]
         file_name = hash[2:]
         full_path = os.path.join(self.objects_dir, dir_name, file_name)
-        if should_exist and not os.path.exists(full_path):
+        if should_exist and not self.object_exists(hash):
             raise FileNotFoundError(f"Hash {hash} does not exist.")
         return full_path
 
+    def object_exists(self, hash: str) -> bool:
+        """ True if the object exists, either as a loose object or in a pack """
+        return self.repo.object_writer.object_exists(hash)
+
+    def get_all_loose_object_hashes(self) -> list:
+        all_hashes = []
+        for dir_name in os.listdir(self.objects_dir):
+            dir_path = os.path.join(self.objects_dir, dir_name)
+            if len(dir_name) != 2 or not os.path.isdir(dir_path):
+                continue
+            all_hashes.extend(dir_name + file_name for file_name in os.listdir(dir_path) if not file_name.startswith("tmp_"))
+        return all_hashes
+
+    def delete_loose_objects(self, hashes) -> None:
+        for hash in hashes:
+            obj_file_path = self.get_full_file_path_from_hash(hash)
+            os.remove(obj_file_path)
+            try:
+                os.rmdir(os.path.dirname(obj_file_path)) # only succeeds if the dir is now empty
+            except OSError:
+                pass
+
+
+class ObjectWriter:
+    """
+    The only thing that writes (loose) objects into the object store:
+    - an object that already exists (loose or in a pack) is never written again
+    - objects are written to a temporary file, then moved into place, so a crash can never leave a truncated object
+    - the fan-out directories (objects/xx/) that exist are remembered, rather than checked for every object
+    There is one of these per repository (repo.object_writer)
+    """
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self.objects_dir = os.path.join(repo.path, "objects")
+        self._fanout_dirs: set|None = None # read from disk the first time it's needed
+
+    def object_exists(self, hash: str) -> bool:
+        loose_path = os.path.join(self.objects_dir, hash[:2], hash[2:])
+        return os.path.exists(loose_path) or self.repo.packs.find(hash) is not None
+
+    def write_object(self, hash: str, full_content: bytes) -> None:
+        """ full_content is the header + compressed content """
+        temp_file, temp_file_path = self.create_temp_file()
+        try:
+            with temp_file:
+                temp_file.write(full_content)
+        except BaseException:
+            os.remove(temp_file_path)
+            raise
+        self.move_temp_file_into_place(temp_file_path, hash)
+
+    def create_temp_file(self) -> tuple:
+        temp_fd, temp_file_path = tempfile.mkstemp(dir=self.objects_dir, prefix="tmp_")
+        os.chmod(temp_file_path, get_new_file_permissions()) # as if it was made with open(), like objects used to be
+        return os.fdopen(temp_fd, "wb"), temp_file_path
+
+    def move_temp_file_into_place(self, temp_file_path: str, hash: str) -> None:
+        if self.object_exists(hash): # eg written by another process in the meantime
+            os.remove(temp_file_path)
+            return
+        dir_name = hash[:2]
+        dir_path = os.path.join(self.objects_dir, dir_name)
+        if self._fanout_dirs is None:
+            self._fanout_dirs = set(os.listdir(self.objects_dir))
+        if dir_name not in self._fanout_dirs:
+            os.makedirs(dir_path, exist_ok=True)
+            self._fanout_dirs.add(dir_name)
+        try:
+            os.replace(temp_file_path, os.path.join(dir_path, hash[2:]))
+        except FileNotFoundError: # the dir was removed since it was cached (eg by `gud gc`)
+            os.makedirs(dir_path, exist_ok=True)
+            os.replace(temp_file_path, os.path.join(dir_path, hash[2:]))
+
+
+class ObjectReader(io.RawIOBase):
+    """
+    Read-only file-like object that decompresses an object's content as it is read.
+    Once everything has been read, the amount of content is checked against the size in the object's header
+    """
+    def __init__(self, compressed_stream, object_type: str, uncompressed_size: int, leftover=b""):
+        super().__init__()
+        self.type = object_type
+        self.size = uncompressed_size
+        self._stream = compressed_stream
+        self._pending = leftover # compressed bytes already read from the stream (eg along with the header)
+        self._decompressor = zlib.decompressobj()
+        self._bytes_read = 0
+        self._finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._finished:
+            if self._decompressor.unconsumed_tail:
+                compressed_chunk = self._decompressor.unconsumed_tail
+            elif self._pending:
+                compressed_chunk, self._pending = self._pending, b""
+            else:
+                compressed_chunk = self._stream.read(OBJECT_STREAM_CHUNK_SIZE)
+            # limiting the output size keeps memory bounded, the rest stays in unconsumed_tail
+            uncompressed_chunk = self._decompressor.decompress(compressed_chunk, len(buffer))
+            if uncompressed_chunk:
+                buffer[:len(uncompressed_chunk)] = uncompressed_chunk
+                self._bytes_read += len(uncompressed_chunk)
+                return len(uncompressed_chunk)
+            if not compressed_chunk: # nothing more to read or decompress
+                self._finished = True
+                if not self._decompressor.eof or self._bytes_read != self.size:
+                    raise ValueError(f"Object is corrupted - expected {self.size} bytes but read {self._bytes_read}.")
+        return 0
+
+    def close(self) -> None:
+        if not self.closed:
+            self._stream.close()
+        super().close()
+
 
 class Blob(GudObject):    
     def serialise(self, og_file_path: str, write_to_file=False) -> str:
@@ -262,11 +726,9 @@ class Blob(GudObject):
         - combine the header + compressed file contents
         - hash this overall contents
         - store the blob, with the name/location based on the hash
+        (large files are read in chunks, rather than all at once - see serialise_file)
         """
-        # open and read bytes
-        with open(og_file_path, "rb") as f:
-            uncompressed_content = f.read()
-        blob_hash = super().serialise_object(uncompressed_content, "blob", write_to_file)
+        blob_hash = super().serialise_file(og_file_path, "blob", write_to_file)
         return blob_hash        
 
     def get_content(self, blob_hash) -> bytes:
@@ -296,17 +758,24 @@ class Tree(GudObject):
     """
     def __init__(self, repo):
         super().__init__(repo)
-        self.index = self.repo.parse_index()
+        self._index = None
         self.tree_hash = None
 
+    @property
+    def index(self) -> dict:
+        """ Only parsed when needed, as most Trees are just used to read existing tree objects """
+        if self._index is None:
+            self._index = self.repo.parse_index()
+        return self._index
+
     def serialise(self) -> str:
         """
-        - read the current index and create and save a path_tree object from it
-        - using the tree, and the hashes stored in it, generate and save tree objects
+        Write a tree object for every directory in the index whose cached tree (see CacheTree) is no longer valid,
+        reusing the cached hashes of unchanged directories, then save the updated cache tree in the index
         """
-        all_path_parts = [path.split(os.sep) for path in self.index.keys()]
-        path_tree = self._build_path_tree(all_path_parts)
-        self.tree_hash = self._create_tree_object(path_tree) # creates all the tree objects
+        sorted_paths = sorted(self.index)
+        self.tree_hash = self._create_tree_object(sorted_paths, "", 0, len(sorted_paths)) # creates the changed tree objects
+        self.repo.write_to_index(self.index)
         return self.tree_hash
         
     def get_content(self, tree_hash) -> bytes:
@@ -315,67 +784,74 @@ class Tree(GudObject):
         """
         file_content = super().deserialise_object(tree_hash, expected_type="tree")
         return file_content
-    
-    def _insert_path_into_tree(self, tree, prefix_parts, suffix_parts):
-        """
-        eg for the path /home/me/project/file.txt
-        if we have navigated to tree["home"]["me"],
-        - prefix_parts = ["home", "me"]
-        - suffix_parts = ["project", "file.txt"]
-        ie prefix_parts represents the file path *up to* this current directory
-        suffix_parts represents the rest of the full file path
-        -- prefix_parts is "remembered" so the full path can be reconstructed to
-        read from the index (using index[file_path]) to get the file mode and hash,
-        which will both be stored in the tree in a tuple (mode, hash)    
-        """
-        if len(suffix_parts) == 1: # this is a file
-            file_name = suffix_parts[0]
-            all_parts = [x for x in prefix_parts] + suffix_parts
-            full_rel_file_path = os.path.join(*all_parts)
-            blob_info_dict = self.index[full_rel_file_path] # this should exist
-            blob_info = [blob_info_dict["mode"], blob_info_dict["hash"]]
-            tree[file_name] = blob_info
-            return
-        # update the path parts
-        prefix_parts.append(suffix_parts[0])
-        suffix_parts = suffix_parts[1:]
-        child_dir = prefix_parts[-1]
-        if child_dir not in tree:
-            tree[child_dir] = {} # dict represents a directory
-        self._insert_path_into_tree(
-            tree=tree[child_dir],
-            prefix_parts=prefix_parts,
-            suffix_parts=suffix_parts
-        )
-
-    def _build_path_tree(self, all_path_parts: list[list]) -> dict:
-        """
-        each dir is represented by a dictionary
-        a dir can contain:
-            - other dirs (which are dicts)
-            - files (represented by [mode, hash])
-        """
-        tree = {}
-        for path_parts in all_path_parts:
-            self._insert_path_into_tree(
-                tree=tree,
-                prefix_parts=[],
-                suffix_parts=path_parts
+
+    def get_entries(self, tree_hash) -> tuple:
+        """
+        The parsed rows of a tree object, as (mode, type, hash, name) tuples.
+        Cached on the repo, so a tree shared between commits is only decoded once
+        """
+        cache_key = ("tree", tree_hash)
+        entries = self.repo.object_cache.get(cache_key)
+        if entries is None:
+            content = self.get_content(tree_hash)
+            entries = tuple(
+                tuple(line.split("\t"))
+                for line in content.decode().split("\n")
+                if line.strip()
             )
-        return tree
-    
-    def _create_tree_object(self, path_tree):
+            self.repo.object_cache.put(cache_key, entries, len(content))
+        return entries
+
+    def get_entry_at_path(self, tree_hash: str, file_path: str) -> tuple|None:
+        """ The (mode, type, hash, name) of file_path inside the tree, or None - only reads the trees on the way to it """
+        entry = None
+        for name in file_path.split(os.sep):
+            if entry is not None:
+                if entry[1] != "tree":
+                    return None
+                tree_hash = entry[2]
+            entry = next((child for child in self.get_entries(tree_hash) if child[3] == name), None)
+            if entry is None:
+                return None
+        return entry
+
+    def _iter_dir_children(self, sorted_paths: list, dir_path: str, lo: int, hi: int):
         """
-        Creates all the tree objects in .gud/objects
+        sorted_paths[lo:hi] are all the index paths inside dir_path.
+        Yields (name, path, child_lo, child_hi) for each file/subdir directly inside dir_path,
+        where sorted_paths[child_lo:child_hi] are the paths inside a subdir (child_hi is None for files)
         """
-        tree_file_lines = []
+        prefix_len = len(dir_path) + 1 if dir_path else 0
+        i = lo
+        while i < hi:
+            name, sep, _ = sorted_paths[i][prefix_len:].partition(os.sep)
+            child_path = sorted_paths[i][:prefix_len + len(name)]
+            if not sep: # a file
+                yield name, child_path, i, None
+                i += 1
+            else:
+                # every path starting with "<child_path>/" sorts before "<child_path>0" ("0" comes right after "/")
+                child_hi = bisect_left(sorted_paths, child_path + chr(ord(os.sep) + 1), i, hi)
+                yield name, child_path, i, child_hi
+                i = child_hi
 
-        for name, subtree in path_tree.items():
-            if isinstance(subtree, list): # it's a blob
-                mode, hash = subtree
+    def _create_tree_object(self, sorted_paths: list, dir_path: str, lo: int, hi: int) -> str:
+        """
+        Creates the tree objects (in .gud/objects) for dir_path and everything below it,
+        skipping any directory whose cached tree is still valid
+        """
+        cached_tree_hash = self.repo.cache_tree.get(dir_path, hi - lo)
+        if cached_tree_hash:
+            return cached_tree_hash
+
+        tree_file_lines = []
+        for name, child_path, child_lo, child_hi in self._iter_dir_children(sorted_paths, dir_path, lo, hi):
+            if child_hi is None: # it's a blob
+                mode = self.index[child_path]["mode"]
+                hash = self.index[child_path]["hash"]
                 type = "blob"
-            else: # is a subtree (expected to be a dict)
-                hash = self._create_tree_object(subtree)
+            else: # is a subtree
+                hash = self._create_tree_object(sorted_paths, child_path, child_lo, child_hi)
                 mode = "040000" # this is the mode git uses for directories
                 type = "tree"
             # insert a single row representing the blob or tree
@@ -384,8 +860,118 @@ class Tree(GudObject):
         # using tree_file_lines, create and hash the actual file
         uncompressed_content = b"".join((line.encode() for line in tree_file_lines))
         tree_hash = super().serialise_object(uncompressed_content, "tree", write_to_file=True)
+        self.repo.cache_tree.set(dir_path, tree_hash, hi - lo)
         return tree_hash
+
+    def get_staged_changes(self, head_tree_hash: str|None) -> tuple[set, set, set]:
+        """
+        Compare the index to a commit's tree one directory at a time, returning the (modified, added, deleted) paths.
+        Directories whose cached tree matches the commit's tree have no changes, so are skipped entirely
+        """
+        changes = (set(), set(), set())
+        sorted_paths = sorted(self.index)
+        self._compare_dir_to_tree(sorted_paths, "", 0, len(sorted_paths), head_tree_hash, changes)
+        return changes
+
+    def _compare_dir_to_tree(self, sorted_paths: list, dir_path: str, lo: int, hi: int, tree_hash: str|None, changes: tuple) -> None:
+        modified, added, deleted = changes
+        cached_tree_hash = self.repo.cache_tree.get(dir_path, hi - lo)
+        if tree_hash and cached_tree_hash:
+            # the index's version of this dir is already a tree, so only the subtrees that differ need comparing
+            changes_by_type = {"modified": modified, "added": added, "deleted": deleted}
+            for change, file_path, entry in self.diff(tree_hash, cached_tree_hash, dir_path):
+                changes_by_type[change].add(file_path)
+            return
+        head_entries = {}
+        if tree_hash:
+            head_entries = {name: (mode, type, hash) for mode, type, hash, name in self.get_entries(tree_hash)}
+        for name, child_path, child_lo, child_hi in self._iter_dir_children(sorted_paths, dir_path, lo, hi):
+            head_entry = head_entries.pop(name, None)
+            if child_hi is None: # a file
+                if head_entry is None or head_entry[1] != "blob":
+                    added.add(child_path)
+                    if head_entry is not None: # replaced a directory
+                        deleted.update(file_path for _, file_path, _ in self.diff(head_entry[2], None, child_path))
+                elif ("blob", head_entry[0], head_entry[2]) != get_entry_signature(self.index[child_path]):
+                    modified.add(child_path)
+            else:
+                head_subtree_hash = None
+                if head_entry is not None:
+                    if head_entry[1] == "tree":
+                        head_subtree_hash = head_entry[2]
+                    else: # replaced a file
+                        deleted.add(child_path)
+                self._compare_dir_to_tree(sorted_paths, child_path, child_lo, child_hi, head_subtree_hash, changes)
+        # anything left in the commit's version of this dir is no longer in the index
+        for name, (mode, type, hash) in head_entries.items():
+            child_path = os.path.join(dir_path, name)
+            if type == "tree":
+                deleted.update(file_path for _, file_path, _ in self.diff(hash, None, child_path))
+            else:
+                deleted.add(child_path)
+
+    def diff(self, old_tree_hash: str|None, new_tree_hash: str|None, dir_path: str = ""):
+        """
+        Walk two trees side by side, yielding (change, path, entry) for every file that differs between them,
+        where change is "modified", "added" or "deleted", and entry is the file's index entry in the new tree
+        (or the old tree, if it was deleted). Either hash can be None, for an empty tree.
+        Subtrees with the same hash are identical, so are skipped without being read.
+        A file's deletion is always yielded before anything is added in its place (eg a file replaced by a dir)
+        """
+        if old_tree_hash == new_tree_hash:
+            return
+        old_entries = {}
+        if old_tree_hash:
+            old_entries = {name: (mode, type, hash) for mode, type, hash, name in self.get_entries(old_tree_hash)}
+        new_entries = {}
+        if new_tree_hash:
+            new_entries = {name: (mode, type, hash) for mode, type, hash, name in self.get_entries(new_tree_hash)}
+        for name in sorted(old_entries.keys() | new_entries.keys()):
+            file_path = os.path.join(dir_path, name)
+            old_mode, old_type, old_hash = old_entries.get(name, (None, None, None))
+            new_mode, new_type, new_hash = new_entries.get(name, (None, None, None))
+            if old_type == "blob" and new_type != "blob":
+                yield "deleted", file_path, {"type": "blob", "mode": old_mode, "hash": old_hash}
+            if old_type == "tree" or new_type == "tree":
+                yield from self.diff(
+                    old_hash if old_type == "tree" else None,
+                    new_hash if new_type == "tree" else None,
+                    file_path
+                )
+            if new_type == "blob":
+                new_entry = {"type": "blob", "mode": new_mode, "hash": new_hash}
+                if old_type != "blob":
+                    yield "added", file_path, new_entry
+                elif (old_mode, old_hash) != (new_mode, new_hash):
+                    yield "modified", file_path, new_entry
+
+    def update_cache_tree(self, tree_hash: str, changed_paths: list) -> None:
+        """
+        For when the index has just been updated to match tree_hash by changing only changed_paths (eg a checkout):
+        the dirs those paths are in now match the tree's subtrees, and every other dir's cached tree is still valid,
+        so only the changed dirs' tree objects need reading
+        """
+        changed_dirs = {""}
+        for file_path in changed_paths:
+            self.repo.cache_tree.invalidate(file_path)
+            dir_path = os.path.dirname(file_path)
+            while dir_path and dir_path not in changed_dirs:
+                changed_dirs.add(dir_path)
+                dir_path = os.path.dirname(dir_path)
+        self._update_cache_tree_dir(sorted(self.index), tree_hash, "", changed_dirs)
+
+    def _update_cache_tree_dir(self, sorted_paths: list, tree_hash: str, dir_path: str, changed_dirs: set) -> None:
+        lo, hi = 0, len(sorted_paths)
+        if dir_path:
+            lo = bisect_left(sorted_paths, dir_path + os.sep)
+            hi = bisect_left(sorted_paths, dir_path + chr(ord(os.sep) + 1), lo)
+        self.repo.cache_tree.set(dir_path, tree_hash, hi - lo)
+        for mode, type, hash, name in self.get_entries(tree_hash):
+            child_path = os.path.join(dir_path, name)
+            if type == "tree" and child_path in changed_dirs:
+                self._update_cache_tree_dir(sorted_paths, hash, child_path, changed_dirs)
     
+    @traced()
     def _read_tree_object(self, tree_hash, curr_path, indexed_files=None):
         """
         create an index (as a dictionary), representing all files descended from a specified
@@ -393,15 +979,10 @@ class Tree(GudObject):
         """
         if indexed_files is None:
             indexed_files = {}
-        content = self.deserialise_object(tree_hash).decode()
-        lines = content.split("\n")
         # collect blobs and trees
         blobs = []
         trees = []
-        for line in lines:
-            if not line.strip():
-                continue
-            mode, type, hash, path = line.split("\t")
+        for mode, type, hash, path in self.get_entries(tree_hash):
             if type == "blob":
                 blobs.append((mode, type, hash, path))
             elif type == "tree":
@@ -427,17 +1008,7 @@ class Tree(GudObject):
         if not commit_hash: # no commits are recorded
             head_index = {}
         else:
-            head_commit_contents = commit_obj.get_content(commit_hash).decode()
-            for line in head_commit_contents.split("\n"):
-                try:
-                    type, value = line.split("\t")
-                except ValueError:
-                    continue
-                else:
-                    if type == "tree":
-                        root_tree_hash = value
-            if not root_tree_hash:
-                raise Exception(f"Could not find tree_hash from commit {commit_hash}")
+            root_tree_hash = commit_obj.get_tree_hash(commit_hash)
             # generate an "head_index" by recursively inspecting all the tree objects
             head_index = self._read_tree_object(root_tree_hash, curr_path="")
         return head_index
@@ -478,20 +1049,238 @@ class Commit(GudObject):
         file_content = super().deserialise_object(commit_hash, expected_type="commit")
         return file_content
     
+    def get_info(self, commit_hash) -> dict:
+        """
+        The parsed commit, as {"tree": ..., "parent": ... (if any), "committer": ..., "message": ...}.
+        Cached on the repo, so walking the history never decodes a commit twice
+        (the returned dict is shared, so copy it before modifying it)
+        """
+        cache_key = ("commit", commit_hash)
+        commit_info = self.repo.object_cache.get(cache_key)
+        if commit_info is None:
+            content = self.get_content(commit_hash)
+            # only the lines before the first blank line are headers - the rest is the message
+            headers, _, message = content.decode().partition("\n\n")
+            commit_info = {}
+            for line in headers.split("\n"):
+                if not line.strip():
+                    continue
+                key, value = line.split("\t", 1)
+                commit_info.setdefault(key, value)
+            commit_info["message"] = message.strip()
+            self.repo.object_cache.put(cache_key, commit_info, len(content))
+        return commit_info
+
+    def get_tree_hash(self, commit_hash) -> str:
+        graph_commit = self._get_graph_commit(commit_hash)
+        if graph_commit:
+            return graph_commit[1]
+        tree_hash = self.get_info(commit_hash).get("tree")
+        if not tree_hash:
+            raise Exception(f"Could not find tree_hash from commit {commit_hash}")
+        return tree_hash
+
     def get_parent_hash(self, commit_hash) -> str|None:
-        commit_content = super().deserialise_object(commit_hash, expected_type="commit").decode()
-        for line in commit_content.split("\n"):
-            if not line.strip(): # empty line
-                continue
-            parts = line.split("\t")
-            if len(parts) == 2:
-                # either a tree, parent or committer
-                key, value = parts
-                if key == "parent":
-                    return value
-        return None
+        graph_commit = self._get_graph_commit(commit_hash)
+        if graph_commit:
+            parent_position = graph_commit[2]
+            return self.repo.commit_graph.get_commit(parent_position)[0] if parent_position is not None else None
+        return self.get_info(commit_hash).get("parent")
+
+    def get_timestamp(self, commit_hash) -> int:
+        """ When the commit was made, in microseconds since the epoch """
+        graph_commit = self._get_graph_commit(commit_hash)
+        if graph_commit:
+            return graph_commit[4]
+        # the committer is stored as "<name> <<email>> (<timestamp>)"
+        timestamp = self.get_info(commit_hash)["committer"].rsplit(" (", 1)[1].rstrip(")")
+        return round(datetime.fromisoformat(timestamp).timestamp() * 1_000_000)
+
+    def iter_history(self, commit_hash):
+        """
+        Yields commit_hash, then each of its ancestors (newest to oldest).
+        Once a commit is found in the commit-graph, so are all of its ancestors,
+        so the rest of the history is walked without reading any commit objects
+        """
+        graph = self.repo.commit_graph
+        while commit_hash:
+            position = graph.find_position(commit_hash) if graph else None
+            if position is not None:
+                while position is not None:
+                    commit_hash, _, position, _, _ = graph.get_commit(position)
+                    yield commit_hash
+                return
+            yield commit_hash
+            commit_hash = self.get_info(commit_hash).get("parent")
+
+    def _get_graph_commit(self, commit_hash) -> tuple|None:
+        graph = self.repo.commit_graph
+        if graph is None:
+            return None
+        position = graph.find_position(commit_hash)
+        return graph.get_commit(position) if position is not None else None
         
 
+class ObjectFormatMigration:
+    """
+    Rewrites all of a repository's objects using the current object format.
+    Object hashes change between formats, so trees and commits have to be rewritten
+    from the bottom up (as their contents contain the hashes of other objects),
+    and the refs and index are then pointed at the new hashes
+    """
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self.obj = GudObject(repo)
+        self.tree = Tree(repo)
+        self.new_hashes = {} # old hash -> new hash
+
+    def run(self) -> int:
+        """ Returns the number of objects that were rewritten """
+        old_object_hashes = set(self.obj.get_all_loose_object_hashes())
+        old_pack_names = [pack.name for pack in self.repo.packs.packs]
+        # from here on, any objects written use the new format
+        self.repo.object_format = OBJECT_FORMAT_VERSION
+
+        # rewrite everything reachable from a branch or the detached head
+        branch = Branch(self.repo)
+        new_branch_heads = {}
+        for branch_name, head_hash in branch.get_all_branches_info().items():
+            new_branch_heads[branch_name] = self.migrate_commit(head_hash) if head_hash else ""
+        new_detached_head = self.migrate_commit(self.repo.detached_head) if self.repo.detached_head else ""
+
+        # staged files may point to blobs that aren't in any commit yet
+        index = self.repo.parse_index()
+        for entry in index.values():
+            entry["hash"] = self.migrate_blob(entry["hash"])
+        self.repo.write_to_index(index)
+
+        # only update the refs once every new object has been written
+        for branch_name, head_hash in new_branch_heads.items():
+            with open(branch._get_branch_path(branch_name), "w", encoding="utf-8") as f:
+                f.write(head_hash)
+        with open(os.path.join(self.repo.path, "DETACHED_HEAD"), "w", encoding="utf-8") as f:
+            f.write(new_detached_head)
+        self.repo.set_object_format(OBJECT_FORMAT_VERSION)
+        write_commit_graph(self.repo) # the old graph only has the old hashes
+
+        # finally, delete the objects that are no longer referenced by anything
+        # (every object in an existing pack is in the old format, so the packs can go entirely)
+        new_object_hashes = set(self.new_hashes.values())
+        self.obj.delete_loose_objects(old_object_hashes - new_object_hashes)
+        self.repo.packs.delete_packs(old_pack_names)
+        return len(self.new_hashes)
+
+    def migrate_blob(self, old_hash: str) -> str:
+        if old_hash not in self.new_hashes:
+            content = self.obj.deserialise_object(old_hash, expected_type="blob")
+            self.new_hashes[old_hash] = self.obj.serialise_object(content, "blob", write_to_file=True)
+        return self.new_hashes[old_hash]
+
+    def migrate_tree(self, old_hash: str) -> str:
+        if old_hash not in self.new_hashes:
+            new_lines = []
+            for mode, type, hash, name in self.tree.get_entries(old_hash):
+                if type == "tree":
+                    hash = self.migrate_tree(hash)
+                else:
+                    hash = self.migrate_blob(hash)
+                new_lines.append(f"{mode}\t{type}\t{hash}\t{name}\n")
+            new_content = "".join(new_lines).encode()
+            self.new_hashes[old_hash] = self.obj.serialise_object(new_content, "tree", write_to_file=True)
+        return self.new_hashes[old_hash]
+
+    def migrate_commit(self, old_hash: str) -> str:
+        # collect the commits that haven't been migrated yet, newest to oldest
+        # (a loop rather than recursion, as histories can be very long)
+        commit = Commit(self.repo)
+        commits_to_migrate = []
+        commit_hash = old_hash
+        while commit_hash and commit_hash not in self.new_hashes:
+            commits_to_migrate.append(commit_hash)
+            commit_hash = commit.get_parent_hash(commit_hash)
+        # then migrate them oldest first, so each parent's new hash is known
+        for commit_hash in reversed(commits_to_migrate):
+            commit_info = commit.get_info(commit_hash)
+            new_header_lines = []
+            for key, value in commit_info.items():
+                if key == "message":
+                    continue
+                if key == "tree":
+                    value = self.migrate_tree(value)
+                elif key == "parent":
+                    value = self.new_hashes[value]
+                new_header_lines.append(f"{key}\t{value}\n")
+            new_content = ("".join(new_header_lines) + "\n" + commit_info["message"]).encode()
+            self.new_hashes[commit_hash] = self.obj.serialise_object(new_content, "commit", write_to_file=True)
+        return self.new_hashes[old_hash]
+
+
+class ObjectPacker:
+    """
+    Writes objects into a new pack, storing each as a delta against a similar object where that saves space.
+    Objects are sorted by type, name and size (so different versions of the same file end up next to each other),
+    then each one is compared against a sliding window of the objects just before it.
+    The window holds at most PACK_DELTA_WINDOW objects, and fewer if their indexes would use more than PACK_DELTA_WINDOW_MEMORY
+    """
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self.obj = GudObject(repo)
+
+    def write_pack(self, objects: dict) -> str:
+        """ objects is {hash: (type, name)}. Returns the name of the new pack """
+        object_sizes = {hash: self.obj.get_object_header(hash)[1] for hash in objects}
+        sorted_hashes = sorted(objects, key=lambda hash: (*objects[hash], -object_sizes[hash], hash))
+        window = deque() # (hash, type, delta_index, delta_depth), oldest first
+        window_memory = 0 # total memory_size of the delta indexes in the window
+        pack_writer = PackWriter(self.repo.packs.pack_dir)
+        try:
+            for hash in sorted_hashes:
+                type, name = objects[hash]
+                uncompressed_size = object_sizes[hash]
+                # commits are small and rarely similar, and big objects would use too much memory
+                if type == "commit" or uncompressed_size > PACK_MAX_DELTA_OBJECT_SIZE:
+                    self._add_whole_object(pack_writer, hash)
+                    continue
+                content = self.obj.deserialise_object(hash)
+                best_delta = None # (base_hash, delta, depth)
+                for base_hash, base_type, delta_index, base_depth in window:
+                    if base_type != type or base_depth >= PACK_MAX_DELTA_DEPTH:
+                        continue
+                    # only worth it if the delta is less than half the size (and smaller than any found so far)
+                    max_size = len(best_delta[1]) - 1 if best_delta else len(content) // 2
+                    delta = delta_index.create_delta(content, max_size=max_size)
+                    if delta is not None:
+                        best_delta = (base_hash, delta, base_depth + 1)
+                if best_delta:
+                    base_hash, delta, depth = best_delta
+                    pack_writer.add_delta(hash, uncompressed_size, base_hash, delta)
+                else:
+                    depth = 0
+                    self._add_whole_object(pack_writer, hash, content)
+                delta_index = DeltaIndex(content)
+                window.append((hash, type, delta_index, depth))
+                window_memory += delta_index.memory_size
+                # (the newest object is always kept, however big it is)
+                while len(window) > PACK_DELTA_WINDOW or (window_memory > PACK_DELTA_WINDOW_MEMORY and len(window) > 1):
+                    window_memory -= window.popleft()[2].memory_size
+        except BaseException:
+            pack_writer.abort()
+            raise
+        self.repo.packs.close() # in case the new pack replaces an identical existing one
+        return pack_writer.finish()
+
+    def _add_whole_object(self, pack_writer: PackWriter, hash: str, content: bytes|None = None) -> None:
+        compressed_object = self.obj.open_compressed_object(hash)
+        if compressed_object is None: # a delta in an existing pack, so it has to be rebuilt
+            type, _ = self.obj.get_object_header(hash)
+            pack_writer.add_object_content(hash, type, content or self.obj.deserialise_object(hash))
+            return
+        type, uncompressed_size, compressed_stream = compressed_object
+        with compressed_stream:
+            # the content is already compressed, so it can be copied straight into the pack
+            pack_writer.add_object(hash, type, uncompressed_size, compressed_stream)
+
+
 class Branch:
     def __init__(self, repo: Repository):
         self.repo = repo
@@ -621,37 +1410,100 @@ class GlobalConfig:
                 f.write(new_config_options)
 
 
-def get_indexed_file_paths_that_may_not_exist() -> list:
-    """ my dumb way of "fixing" the file paths that don't exist when validating """
-    repo = Repository(cwd=os.getcwd())
-    staged_index = repo.parse_index()
+def get_reachable_objects(repo: Repository) -> dict:
+    """
+    Every object that can be reached from a branch, the detached head or the index,
+    as {hash: (type, name)}, where name is the file/dir name the object was found at (if any).
+    Anything not in here is garbage
+    """
+    reachable_objects = {}
     commit = Commit(repo)
-    curr_head = repo.head
     tree = Tree(repo)
-    head_index = tree.get_index_of_commit(commit, curr_head)
-    additional_paths = list(set(staged_index.keys()) | set(head_index.keys()))
-    return additional_paths
 
+    branch_heads = list(Branch(repo).get_all_branches_info().values())
+    commits_to_visit = [commit_hash for commit_hash in branch_heads + [repo.detached_head] if commit_hash]
+    trees_to_visit = []
+    while commits_to_visit:
+        commit_hash = commits_to_visit.pop()
+        if commit_hash in reachable_objects:
+            continue
+        reachable_objects[commit_hash] = ("commit", "")
+        trees_to_visit.append((commit.get_tree_hash(commit_hash), ""))
+        parent_hash = commit.get_parent_hash(commit_hash)
+        if parent_hash:
+            commits_to_visit.append(parent_hash)
 
-class PathValidatorQuestionary(Validator):
-    # these are for including the index files in the validator
-    def validate(self, document):
-        """
-        The path must either be blank, in which case the user can 'complete' their selection
-        or it must exist as a file path 
-        """
-        _additional_paths = get_indexed_file_paths_that_may_not_exist() # this is very inefficient
-        path = os.path.expanduser(document.text.strip()) # expanduser converts ~ to /home/<username>
-        if (path == "/") or (path != "" and not os.path.exists(path) and path not in _additional_paths):
-            raise ValidationError(
-                message="Path is not valid"
-            )
-        
+    while trees_to_visit:
+        tree_hash, tree_name = trees_to_visit.pop()
+        if tree_hash in reachable_objects:
+            continue
+        reachable_objects[tree_hash] = ("tree", tree_name)
+        for mode, type, hash, name in tree.get_entries(tree_hash):
+            if type == "tree":
+                trees_to_visit.append((hash, name))
+            elif hash not in reachable_objects:
+                reachable_objects[hash] = (type, name)
+
+    for file_path, entry in repo.parse_index().items():
+        if entry["hash"] not in reachable_objects:
+            reachable_objects[entry["hash"]] = (entry["type"], os.path.basename(file_path))
+    return reachable_objects
 
-class TextValidatorQuestionaryNotEmpty(Validator):
-    def validate(self, document):
-        text = document.text.strip()
-        if not text:
-            raise ValidationError(
-                message="You cannot leave this blank"
+
+def write_commit_graph(repo: Repository) -> None:
+    """
+    Rebuild the commit-graph from every commit reachable from a branch or the detached head
+    (using the existing graph for any commits already in it)
+    """
+    commit = Commit(repo)
+    writer = CommitGraphWriter()
+    branch_heads = list(Branch(repo).get_all_branches_info().values())
+    for head_hash in branch_heads + [repo.get_current_detached_head()]:
+        # collect the commits that haven't been added yet (newest to oldest), then add them parents first
+        commits_to_add = []
+        for commit_hash in commit.iter_history(head_hash):
+            if writer.contains(commit_hash):
+                break
+            commits_to_add.append(commit_hash)
+        for commit_hash in reversed(commits_to_add):
+            writer.add_commit(
+                commit_hash,
+                commit.get_tree_hash(commit_hash),
+                commit.get_parent_hash(commit_hash),
+                commit.get_timestamp(commit_hash)
             )
+    repo.close_commit_graph()
+    writer.write(os.path.join(repo.path, "commit-graph"))
+
+
+def add_to_commit_graph(repo: Repository, commit_hash: str) -> None:
+    """
+    Add a new commit to the commit-graph. If its parent isn't in the graph
+    (eg the repo was made with an older version of Gud), the whole graph is rebuilt instead
+    """
+    commit = Commit(repo)
+    graph = repo.commit_graph
+    parent_hash = commit.get_parent_hash(commit_hash)
+    if parent_hash and (graph is None or graph.find_position(parent_hash) is None):
+        write_commit_graph(repo)
+        return
+    writer = CommitGraphWriter(graph)
+    writer.add_commit(commit_hash, commit.get_tree_hash(commit_hash), parent_hash, commit.get_timestamp(commit_hash))
+    writer.write(os.path.join(repo.path, "commit-graph")) # (this closes the old graph)
+    repo.close_commit_graph()
+
+
+def is_indexed_file_path_that_may_not_exist(repo: Repository, file_path: str) -> bool:
+    """
+    Whether file_path (which may no longer exist) is in the index or the HEAD commit, eg so a deleted file can still be staged.
+    Only the one path is looked up - with a binary search of the index, then only reading the trees on the way to it
+    """
+    rel_path = os.path.relpath(os.path.abspath(file_path), repo.root)
+    if rel_path.startswith(os.pardir):
+        return False
+    if repo.get_index_entry(rel_path) is not None:
+        return True
+    head_commit_hash = repo.detached_head or repo.head
+    if not head_commit_hash:
+        return False
+    return Tree(repo).get_entry_at_path(Commit(repo).get_tree_hash(head_commit_hash), rel_path) is not None
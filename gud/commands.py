@@ -1,36 +1,53 @@
 """
 All of these are commands that will ultimately be used as `gud <command_name>`
 """
-import questionary
 from configparser import ConfigParser
+from .globals import OBJECT_FORMAT_VERSION
 from .helpers import (
     is_valid_username,
     is_valid_email,
     is_valid_branch_name,
     open_relevant_editor,
     get_file_from_package_installation,
-    get_all_ignored_paths,
     format_path_for_gudignore,
-    get_file_mode,
     see_if_command_exists,
-    open_relevant_pager,
-    print_col
+    write_to_pager,
+    discard_closed_stdout,
+    print_col,
+    LazyModule
 )
 from .classes import (
     Blob,
     Tree,
     Commit,
     Branch,
-    PathValidatorQuestionary,
-    TextValidatorQuestionaryNotEmpty,
-    get_indexed_file_paths_that_may_not_exist
+    GudObject,
+    ObjectFormatMigration,
+    ObjectPacker,
+    get_reachable_objects,
+    write_commit_graph,
+    add_to_commit_graph
+)
+from .ignore import IgnoreMatcher
+from .trace import span, traced
+from .fsmonitor import get_fsmonitor_changes, start_fsmonitor, stop_fsmonitor, query_fsmonitor
+from .daemon import start_daemon, stop_daemon, is_daemon_running
+from .worktree import (
+    WorkingDirComparison,
+    WorkingDirWalker,
+    StagingPipeline,
+    CheckoutExecutor,
+    get_indexed_paths_in_dir
 )
 import os
 import shutil
 import sys
-import tempfile
-from copy import deepcopy
-from pathlib import Path
+from itertools import islice
+
+# only imported once they're actually used (eg when a prompt is shown), as they are slow to import
+questionary = LazyModule("questionary")
+prompts = LazyModule(f"{__package__}.prompts")
+pathlib = LazyModule("pathlib")
 
 
 def hello():
@@ -181,24 +198,29 @@ def config(invocation):
             print(f.read())
 
 
-def ignoring(invocation, for_printing_to_user=True) -> set:
+def ignoring(invocation) -> set:
     """
     Show all files in this repository that Gud is set to ignore
-    Find all .gudignore files, and print them out in stdout
-    Make sure to label each file above its contents, and make it clear/well-formatted
+    ie every file/folder matched by a rule in any of the .gudignore files (folders end with a slash)
     """
     repo_root = invocation.repo.root
-    all_ignored_file_paths = get_all_ignored_paths(repo_root)        
-    if for_printing_to_user:
-        if not all_ignored_file_paths:
-            print(f"No files/folders are being ignored in this repository ({invocation.repo.path})")
-        else:
-            print(f"Gud is ignoring the following files/folders in this repository ({invocation.repo.path}):\n")
-            for file_path in sorted(all_ignored_file_paths):
-                print(file_path)
+    ignore_matcher = IgnoreMatcher.for_repo(invocation.repo)
+    walker = WorkingDirWalker(repo_root, ignore_matcher)
+    ignored_paths = []
+    for _ in walker.walk(ignored_paths=ignored_paths): # ignored dirs are listed, but not walked into
+        pass
+    ignore_matcher.save_cache()
+    all_ignored_file_paths = set(
+        format_path_for_gudignore(os.path.join(repo_root, path), check_if_dir=False)
+        for path in ignored_paths if path != ".gud" + os.sep
+    )
+    if not all_ignored_file_paths:
+        print(f"No files/folders are being ignored in this repository ({invocation.repo.path})")
     else:
-        all_ignored_file_paths.add(format_path_for_gudignore(invocation.repo.path))
-    return all_ignored_file_paths # return value for if another command calls this
+        print(f"Gud is ignoring the following files/folders in this repository ({invocation.repo.path}):\n")
+        for file_path in sorted(all_ignored_file_paths):
+            print(file_path)
+    return all_ignored_file_paths
 
 
 def stage(invocation):
@@ -219,7 +241,7 @@ def stage(invocation):
         while True: # loop for selecting multiple files
             path = questionary.path(
                 f"Search for a file/directory to be {connective} the staging area (enter blank when finished):",
-                validate=PathValidatorQuestionary()
+                validate=prompts.PathValidatorQuestionary(invocation.repo)
             ).ask()
             if path == "":
                 break
@@ -234,56 +256,47 @@ def stage(invocation):
                 print(path)
 
     # convert all paths to rel_paths - this is how they will be stored in the index
-    rel_paths_specified = [os.path.relpath(path, invocation.repo.root) for path in paths_specified]
+    rel_paths_specified = sorted(os.path.relpath(path, invocation.repo.root) for path in paths_specified)
     abs_paths_specified = [os.path.join(invocation.repo.root, path) for path in rel_paths_specified]
 
-    # "expand" directories into their specific files
-    for rel_path in rel_paths_specified:
-        if os.path.isdir(rel_path):
-            rel_paths_specified.remove(rel_path) # remove the directory path
-            for file in os.listdir(rel_path):
-                rel_file_path = os.path.join(rel_path, file)
-                rel_paths_specified.append(rel_file_path)
-
     # prevent users from staging the .gud directory, or anything within it
-    repo_path_obj = Path(invocation.repo.path)
-    if any(Path(path).is_relative_to(repo_path_obj) for path in abs_paths_specified):
+    repo_path_obj = pathlib.Path(invocation.repo.path)
+    if any(pathlib.Path(path).is_relative_to(repo_path_obj) for path in abs_paths_specified):
         sys.exit("You cannot add anything in the `.gud` directory into the staging area!")
 
     index = invocation.repo.parse_index()
 
-    # for when you are adding a "deleted" file to the staging area
-    file_paths_that_may_not_exist = get_indexed_file_paths_that_may_not_exist()
-
     if action == "add":
-        # this should only contain files now, not directories
-        ignored_abs_paths = ignoring(invocation, for_printing_to_user=False)
-        for abs_path in abs_paths_specified:
-            for ignored_path in ignored_abs_paths:
-                if ignored_path.endswith("/"): # directory
-                    if abs_path.startswith(ignored_path):
-                        sys.exit(f"{abs_path} is being ignored by Gud.\nPlease remove it from your `.gudignore` file(s) if you wish to stage it.")
-                else:
-                    if ignored_path == abs_path:
-                        sys.exit(f"{abs_path} is being ignored by Gud.\nPlease remove it from your `.gudignore` file(s) if you wish to stage it.")
-
-        for rel_path in rel_paths_specified:
-            # handle if a file which was deleted, was added to the staging area
-            if not os.path.exists(rel_path):
-                if rel_path in file_paths_that_may_not_exist:
-                    del index[rel_path]
-                    continue
+        with span("stage files"):
+            ignore_matcher = IgnoreMatcher.for_repo(invocation.repo)
+            for abs_path in abs_paths_specified:
+                rel_path = os.path.relpath(abs_path, invocation.repo.root)
+                if ignore_matcher.is_ignored(rel_path, is_dir=os.path.isdir(abs_path)):
+                    sys.exit(f"{abs_path} is being ignored by Gud.\nPlease remove it from your `.gudignore` file(s) if you wish to stage it.")
+
+            # files are hashed and written on a pool of threads, and the index is updated once they're all done
+            pipeline = StagingPipeline(invocation.repo, index)
+            walker = WorkingDirWalker(invocation.repo.root, ignore_matcher)
+            # if the filesystem monitor is running, only the paths that it says may have changed are looked at
+            fsmonitor_changes = get_fsmonitor_changes(invocation.repo)
+            changed_paths = fsmonitor_changes[1] if fsmonitor_changes is not None else None
+            for rel_path, abs_path in zip(rel_paths_specified, abs_paths_specified):
+                if os.path.isdir(abs_path):
+                    # every (non-ignored) file in the directory, however deep, plus any tracked files in it that have since been deleted
+                    pipeline.add_dir(walker, "" if rel_path == os.curdir else rel_path, changed_paths)
+                elif os.path.exists(abs_path):
+                    pipeline.add_file(rel_path)
+                # handle if a file (or directory) which was deleted, was added to the staging area
+                elif rel_path in index:
+                    pipeline.remove_file(rel_path)
+                elif deleted_file_paths := get_indexed_paths_in_dir(index, rel_path):
+                    for file_path in deleted_file_paths:
+                        pipeline.remove_file(file_path)
                 else:
                     sys.exit(f"{rel_path} does not exist")
-            abs_path = os.path.join(invocation.repo.root, rel_path)
-            blob = Blob(repo=invocation.repo)
-            file_hash = blob.serialise(abs_path, write_to_file=True)
-            file_mode = get_file_mode(abs_path)
-            index[rel_path] = {
-                "type": "blob",
-                "mode": file_mode,
-                "hash": file_hash
-            }
+            pipeline.finish()
+            ignore_matcher.save_cache()
+            num_files_staged = pipeline.num_files
 
     elif action == "remove":
         commit = Commit(invocation.repo)
@@ -292,15 +305,21 @@ def stage(invocation):
         head_commit_hash = invocation.repo.detached_head or invocation.repo.head
         head_index = tree.get_index_of_commit(commit_obj=commit, commit_hash=head_commit_hash)
         # revert the file(s) to their previous version, if it exists, else remove entirely from the index
+        num_files_staged = 0
         for rel_path in rel_paths_specified:
-            previous_version_of_file = head_index.get(rel_path, None)
-            if previous_version_of_file is None: # file didn't exist at the last commit
-                del index[rel_path]
-            else:
-                index[rel_path] = previous_version_of_file
+            if rel_path in index or rel_path in head_index:
+                file_paths = [rel_path]
+            else: # a directory
+                file_paths = sorted(set(get_indexed_paths_in_dir(index, rel_path) + get_indexed_paths_in_dir(head_index, rel_path)))
+            for file_path in file_paths:
+                previous_version_of_file = head_index.get(file_path, None)
+                if previous_version_of_file is None: # file didn't exist at the last commit
+                    index.pop(file_path, None)
+                else:
+                    index[file_path] = previous_version_of_file
+            num_files_staged += len(file_paths)
     
     invocation.repo.write_to_index(index)
-    num_files_staged = len(rel_paths_specified)
     print(f"{num_files_staged} file{'s' if num_files_staged > 1 else ''} {connective} the staging area.\nUse `gud status` for more details.\nUse `gud commit` when ready to commit.")
 
 
@@ -313,14 +332,20 @@ def commit(invocation):
     if invocation.repo.detached_head: # this should ideally not be hit
         sys.exit("Please create a branch with `gud branch create`, before committing files.")
 
+    commit_message = invocation.args.get("message") # (only asked for if it wasn't given)
+    if commit_message is not None and not commit_message.strip():
+        sys.exit("The commit message cannot be empty.")
+
     # create the tree object(s), using the current index
     tree = Tree(invocation.repo)
-    tree_hash = tree.serialise()
+    with span("write trees"):
+        tree_hash = tree.serialise()
 
-    commit_message = questionary.text(
-        "What changes does this commit represent?",
-        validate=TextValidatorQuestionaryNotEmpty()
-    ).ask()
+    if commit_message is None:
+        commit_message = questionary.text(
+            "What changes does this commit represent?",
+            validate=prompts.TextValidatorQuestionaryNotEmpty()
+        ).ask()
 
     commit = Commit(
         repo=invocation.repo,
@@ -328,16 +353,20 @@ def commit(invocation):
         commit_message=commit_message.strip(),
         timestamp=invocation.timestamp
     )
-    commit_hash = commit.serialise()
+    with span("write commit"):
+        commit_hash = commit.serialise()
 
-    # update the reference to head
-    heads_path = os.path.join(invocation.repo.path, "heads", invocation.repo.branch)
-    with open(heads_path, "w", encoding="utf-8") as f:
-        f.write(commit_hash)
+        # update the reference to head
+        heads_path = os.path.join(invocation.repo.path, "heads", invocation.repo.branch)
+        with open(heads_path, "w", encoding="utf-8") as f:
+            f.write(commit_hash)
+    with span("update commit-graph"):
+        add_to_commit_graph(invocation.repo, commit_hash)
 
     print_col(f"Successfully committed {num_files_staged} file{'s' if num_files_staged > 1 else ''} on branch {invocation.repo.branch}.\nUse `gud log` to view commit history.", "green")
     
 
+@traced("status") # (also run as part of other commands)
 def status(invocation, print_output=True) -> dict:
     """
     6 categories for files:
@@ -354,101 +383,26 @@ def status(invocation, print_output=True) -> dict:
     staged_index = tree.index
 
     """ Determine STAGED file differences (where index =/ last commit) """
-    commit = Commit(invocation.repo)
-    tree = Tree(invocation.repo)
-    head_commit_hash = invocation.repo.detached_head or invocation.repo.head
-    head_index = tree.get_index_of_commit(commit_obj=commit, commit_hash=head_commit_hash)
-
-    # compare head_index to staged_index
-    files_in_head_index = set(head_index)
-    files_in_staged_index = set(staged_index)
-    _staged_existing_files = files_in_head_index & files_in_staged_index
-    staged_modified_files = set()
-    for file_path in _staged_existing_files:
-        # simple implementation to see if anything about the file has changed
-        info_str_head = "".join(head_index[file_path].values())
-        info_str_staged = "".join(staged_index[file_path].values())
-        if info_str_head != info_str_staged: # modified file
-            staged_modified_files.add(file_path)
-
-    staged_deleted_files = files_in_head_index - files_in_staged_index
-    staged_added_files = files_in_staged_index - files_in_head_index
+    with span("compare index to HEAD"):
+        commit = Commit(invocation.repo)
+        head_commit_hash = invocation.repo.detached_head or invocation.repo.head
+        head_tree_hash = commit.get_tree_hash(head_commit_hash) if head_commit_hash else None
+        # compared one directory at a time, skipping any dir that matches the last commit
+        staged_modified_files, staged_added_files, staged_deleted_files = tree.get_staged_changes(head_tree_hash)
 
     """ Determine UNSTAGED file differences (where working directory =/ index) """
-    # build a path_tree for the current index
-
-    all_path_parts = [path.split(os.sep) for path in staged_index.keys()]
-    path_tree = tree._build_path_tree(all_path_parts)
-
-    # find all ignored files (this is messy but seems to work like git?)
-    ignored_abs_paths = ignoring(invocation, for_printing_to_user=False)
-    abs_staged_index_without_ignored_files = set(os.path.join(invocation.repo.root, path) for path in staged_index.keys())
-    for path in abs_staged_index_without_ignored_files.copy():
-        for ignored_path in ignored_abs_paths:
-            if ignored_path.endswith("/"): # directory
-                if path.startswith(ignored_path):
-                    abs_staged_index_without_ignored_files.remove(path)
-            else:
-                if ignored_path == path:
-                    abs_staged_index_without_ignored_files.remove(path)
-    rel_staged_index_without_ignored = set(
-        os.path.relpath(path, invocation.repo.root) for path in abs_staged_index_without_ignored_files
-    )
-
-    unstaged_added_files = set()
-    unstaged_modified_files = set()
-
-    # get all files in the working directory
-    working_dir_paths_traversed = set()
-    repo_root = invocation.repo.root
-    for root, subdirs, files in os.walk(repo_root):
-        root_formatted = format_path_for_gudignore(root)
-        # stop traversing any directory that is listed in gudignore
-        if root_formatted in ignored_abs_paths:
-            subdirs[:] = [] # prevents traversal of ignored directories
-            continue
-        for file in files:
-            full_path = os.path.join(root, file)
-            full_path_formatted = format_path_for_gudignore(full_path)
-            # if any of the ignored paths is a prefix to the current path, ignore the current path
-            if any(full_path_formatted.startswith(ignored_path) for ignored_path in ignored_abs_paths):
-                continue
-
-            rel_path = os.path.relpath(full_path, invocation.repo.root)
-            working_dir_paths_traversed.add(rel_path)
-            path_parts = rel_path.split("/")
-
-            subtree = deepcopy(path_tree)
-            prefix_parts = []
-            suffix_parts = path_parts[:]
-            while suffix_parts:
-                prefix_parts.append(suffix_parts[0])
-                suffix_parts = suffix_parts[1:]
-                next_lookup: str = prefix_parts[-1]
-                subtree = subtree.get(next_lookup, None)
-                file_path_so_far = os.path.join(*prefix_parts)
-                abs_file_path_so_far = os.path.join(invocation.repo.root, file_path_so_far)
-                if subtree is None: # untracked file/dir
-                    # using untracked path like this ensures that it only lists the
-                    # shallowest untracked directory, rather than listing the entire contents
-                    # as untracked
-                    if os.path.isdir(abs_file_path_so_far):
-                        file_path_so_far += os.sep # trailing slash if dir - is clearer in the output
-                    unstaged_added_files.add(file_path_so_far)
-                    break
-                elif isinstance(subtree, list): # tracked FILE
-                    old_mode = subtree[0]
-                    old_hash = subtree[1]
-                    blob = Blob(invocation.repo)
-                    new_mode = get_file_mode(abs_file_path_so_far)
-                    new_hash = blob.serialise(abs_file_path_so_far, write_to_file=False)
-                    if old_mode != new_mode or old_hash != new_hash:
-                        unstaged_modified_files.add(file_path_so_far)
-                    break
-                # else, it's a tracked subtree and the loop continues
-    
-    # checks which staged/indexed files were not traversed
-    unstaged_deleted_files = rel_staged_index_without_ignored - working_dir_paths_traversed
+    with span("compare working dir to index"):
+        ignore_matcher = IgnoreMatcher.for_repo(invocation.repo)
+        # the working dir and the index are walked together, in a single pass
+        comparison = WorkingDirComparison(invocation.repo, tree, ignore_matcher).run()
+        ignore_matcher.save_cache()
+    unstaged_modified_files = comparison.modified
+    unstaged_added_files = comparison.added
+    unstaged_deleted_files = comparison.deleted
+    index_needs_refresh = comparison.index_needs_refresh
+
+    if index_needs_refresh:
+        invocation.repo.write_to_index(staged_index, fsmonitor_state=comparison.fsmonitor_state)
 
     """ Print out everything we determined from this whole function """
     staged = {
@@ -528,65 +482,58 @@ def log(invocation, internal_use=False, specified_branch=None) -> list|None:
                 sys.exit(f"Your current branch {invocation.repo.branch} does not have any commits, so there are not logs to show.")
             return []
 
+    skip = invocation.args.get("skip") or 0
+    max_count = invocation.args.get("max_count")
+    if skip < 0 or (max_count is not None and max_count < 0):
+        sys.exit("--skip and --max-count cannot be negative.")
+
+    # commits are only read as they're needed - the history is walked using the commit-graph,
+    # and walking stops as soon as enough commits have been shown (or the pager is closed)
     commit = Commit(invocation.repo)
-    commit_content = commit.get_content(head_commit_hash).decode()
-
-    commit_has_parent = True
-    commit_hash = head_commit_hash
-    all_commit_contents = [] # left to right is most
-    while commit_has_parent:
-        curr_commit_content = {"hash": commit_hash}
-        commit_content = commit.get_content(commit_hash).decode()
-        for line in commit_content.split("\n"):
-            if not line.strip(): # empty line
-                continue
-            parts = line.split("\t")
-            if len(parts) == 1: # commit message
-                curr_commit_content["message"] = parts[0]
-            else:
-                # either a tree, parent or committer
-                key, value = parts
-                curr_commit_content[key] = value
-        # next commit hash
-        commit_hash = curr_commit_content.get("parent", None)
-        if commit_hash is None:
-            commit_has_parent = False
-        all_commit_contents.append(curr_commit_content)
+    history = islice(commit.iter_history(head_commit_hash), skip, None if max_count is None else skip + max_count)
+    all_commit_contents = ({"hash": commit_hash, **commit.get_info(commit_hash)} for commit_hash in history)
     
     if internal_use: # if just wanting the values and don't need the output
-        return all_commit_contents
-
-    # determine which program to run
-    less_exists = see_if_command_exists("less")
-    pager = "less" if less_exists else "more"
-    if pager == "less":
-        instructions_str = "To scroll, use the arrow keys. **To exit, press q.**"
-    else:
-        instructions_str = "If scrollable, use spacebar to scrolldown and **press Q to exit.**"
-
-    short = invocation.args["short"]
-    with tempfile.NamedTemporaryFile(delete=False, mode="w", newline="") as temp_log_file:
-        temp_log_file.write(f"\n-- Gud commits on branch {invocation.repo.get_effective_branch_name()} (newest to oldest) --\n")
-        temp_log_file.write(f"-- {instructions_str} --\n\n\n")
-        if short:
-            for commit in all_commit_contents:
-                temp_log_file.write(
-                    f"{commit['hash'][:7]} -- {commit['message']}\n"
-                )
+        return list(all_commit_contents)
+
+    short = invocation.args.get("short")
+    use_pager = not invocation.args.get("no_pager") and sys.stdout.isatty()
+    header_lines = [f"\n-- Gud commits on branch {invocation.repo.get_effective_branch_name()} (newest to oldest) --\n"]
+    if use_pager:
+        # determine which program to run
+        less_exists = see_if_command_exists("less")
+        pager = "less" if less_exists else "more"
+        if pager == "less":
+            instructions_str = "To scroll, use the arrow keys. **To exit, press q.**"
         else:
-            for commit in all_commit_contents:
-                temp_log_file.write(
+            instructions_str = "If scrollable, use spacebar to scrolldown and **press Q to exit.**"
+        header_lines.append(f"-- {instructions_str} --\n")
+    header_lines.append("\n\n")
+
+    def generate_log_text():
+        yield from header_lines
+        for commit in all_commit_contents:
+            if short:
+                yield f"{commit['hash'][:7]} -- {commit['message']}\n"
+            else:
+                yield (
                     f"Commit: {commit['hash']}\n"
                     f"Committer: {commit['committer']}\n\n"
                     f"  {commit['message']}\n\n"
                 )
-        temp_log_file.write("\n\n")
-        log_file_name = temp_log_file.name
+        yield "\n\n"
 
-    print(f"Gud logs are about to open...\n{instructions_str}")
-    questionary.press_any_key_to_continue().ask()
-    open_relevant_pager(invocation.os, pager, log_file_name)
-    os.remove(log_file_name) # delete temp file
+    # (commits are read as they're written out)
+    with span("write log"):
+        if use_pager:
+            write_to_pager(invocation.os, pager, generate_log_text())
+        else:
+            try:
+                for text in generate_log_text():
+                    sys.stdout.write(text)
+                sys.stdout.flush()
+            except BrokenPipeError: # eg piped into `head`, which has seen enough (so there's no point reading any more commits)
+                discard_closed_stdout()
 
 
 def branch(invocation):
@@ -750,70 +697,36 @@ def checkout(invocation):
 
     tree = Tree(invocation.repo)
     commit = Commit(invocation.repo)
-    staged_index = tree.index
-    checked_out_index = tree.get_index_of_commit(commit_obj=commit, commit_hash=specific_hash)
-
-    # abs paths so the modifications are easier
-    staged_index_abs = {os.path.join(invocation.repo.root, path): value for path, value in staged_index.items()}
-    checked_out_index_abs = {os.path.join(invocation.repo.root, path): value for path, value in checked_out_index.items()}
-
-    # determine which files need creating/deleting/modifying, and create a backup (maybe) of them
-    files_to_delete = set()
-    files_to_modify: dict[str, dict] = {} # dict([type, mode, hash])
-    files_to_not_change = set()
-
-    for file_path, info_dict in staged_index_abs.items():
-        checked_out_version = checked_out_index_abs.get(file_path, None) # either [type, mode, hash] or None
-        if not checked_out_version:
-            files_to_delete.add(file_path)
-        else:
-            info_str_staged = "".join(str(x) for x in info_dict.values())
-            info_str_checked_out = "".join(str(x) for x in checked_out_version.values())
-            if info_str_staged != info_str_checked_out:
-                files_to_modify[file_path] = checked_out_version # store the checked out version of the file's hash etc
+    # nothing is staged, so the index matches the current commit's tree
+    current_commit_hash = invocation.repo.detached_head or invocation.repo.head
+    current_tree_hash = commit.get_tree_hash(current_commit_hash) if current_commit_hash else None
+    checked_out_tree_hash = commit.get_tree_hash(specific_hash)
+
+    # determine which files need creating/deleting/modifying (only reading the trees that differ)
+    new_index = tree.index
+    files_to_delete = []
+    files_to_write: dict[str, dict] = {} # files to create or modify -> their checked out index entry
+    with span("diff trees"):
+        for change, file_path, entry in tree.diff(current_tree_hash, checked_out_tree_hash):
+            if change == "deleted":
+                files_to_delete.append(file_path)
+                del new_index[file_path]
             else:
-                files_to_not_change.add(file_path)
-
-    # anything that exists in checked_out_index but not been seen yet
-    file_paths_to_create = set(checked_out_index_abs.keys()) - files_to_delete - files_to_not_change - set(files_to_modify.keys())
-    files_to_create = {file_path: checked_out_index_abs[file_path] for file_path in file_paths_to_create}
+                files_to_write[file_path] = entry
+                new_index[file_path] = entry
 
     # change the value of DETACHED_HEAD
     with open(detached_head_file_path, "w", encoding="utf-8") as f:
         f.write(specific_hash)
 
-    # delete files
-    for file in files_to_delete:
-        os.remove(file)
-        # this is a really bad implementation because it only up to one directory up
-        # TODO - fix this implementation so it deletes all folders all the way up
-        parent_dir = os.path.dirname(file)
-        # try to remove the parent directory if deleting files made it it empty
-        try:
-            os.rmdir(parent_dir)
-        except OSError as e:
-            pass
-
-    # create files
-    for file, info_dict in files_to_create.items():
-        # create directories if needed
-        os.makedirs(os.path.dirname(file), exist_ok=True)
-        with open(file, "wb") as f:
-            blob = Blob(invocation.repo)
-            blob_hash = info_dict["hash"]
-            uncompressed_content = blob.deserialise_object(obj_hash=blob_hash, expected_type="blob")
-            f.write(uncompressed_content)
-
-    # modify existing files
-    for file, info_dict in files_to_modify.items():
-        with open(file, "wb") as f:
-            blob = Blob(invocation.repo)
-            blob_hash = info_dict["hash"]
-            uncompressed_content = blob.deserialise_object(obj_hash=blob_hash, expected_type="blob")
-            f.write(uncompressed_content)
+    # delete, create and modify the files (the writes happen on a pool of threads)
+    # this also updates the stat info of the written files' index entries
+    with span("update working dir", files_deleted=len(files_to_delete), files_written=len(files_to_write)):
+        CheckoutExecutor(invocation.repo).run(files_to_delete, files_to_write)
 
     # update the current index so gud status etc doesn't go wild
-    invocation.repo.write_to_index(checked_out_index)
+    tree.update_cache_tree(checked_out_tree_hash, files_to_delete + list(files_to_write))
+    invocation.repo.write_to_index(new_index, cache_tree=invocation.repo.cache_tree)
 
     # if checking out the head of a branch, clear the detached HEAD file
     if specific_hash == invocation.repo.get_head(specific_branch):
@@ -854,8 +767,98 @@ def restore(invocation):
     blob = Blob(invocation.repo)
     head_index = tree.get_index_of_commit(commit, branch_commit_hash)
     blob_hash = head_index[file_path_rel]["hash"]
-    uncompressed_content = blob.deserialise_object(obj_hash=blob_hash, expected_type="blob")
-    with open(file_path_abs, "wb") as f:
-        f.write(uncompressed_content)
+    blob.copy_object_to_file(blob_hash, file_path_abs, expected_type="blob")
     # don't need to update the index because the file was unstaged anyway
-    print(f"Successfully restored file {file_path_rel} back to its previous state (on branch {invocation.repo.branch}).")
\ No newline at end of file
+    print(f"Successfully restored file {file_path_rel} back to its previous state (on branch {invocation.repo.branch}).")
+
+
+def migrate(invocation):
+    """
+    Upgrade the repository's objects to the latest object format.
+    Every object, plus the branches, detached head and index that refer to them, gets rewritten
+    """
+    curr_format = invocation.repo.object_format
+    if curr_format >= OBJECT_FORMAT_VERSION:
+        print(f"This repository already uses the latest object format (version {curr_format}).")
+        return
+    print(f"Migrating this repository from object format {curr_format} to {OBJECT_FORMAT_VERSION}...")
+    migration = ObjectFormatMigration(invocation.repo)
+    num_objects = migration.run()
+    print_col(f"Successfully migrated {num_objects} object{'s' if num_objects != 1 else ''} to object format {OBJECT_FORMAT_VERSION}.", "green")
+
+
+def gc(invocation):
+    """
+    Pack every reachable object into a single pack file (with an index for fast lookups),
+    storing similar objects as deltas, then delete the loose objects and old packs.
+    Unreachable objects are deleted too
+    """
+    repo = invocation.repo
+    obj = GudObject(repo)
+    reachable_objects = get_reachable_objects(repo)
+    loose_object_hashes = obj.get_all_loose_object_hashes()
+    old_pack_names = [pack.name for pack in repo.packs.packs]
+    if not reachable_objects:
+        print("There are no objects to pack.")
+        return
+
+    new_pack_name = ObjectPacker(repo).write_pack(reachable_objects)
+    write_commit_graph(repo) # drops any commits that are no longer reachable
+
+    # everything is safely in the new pack now
+    repo.packs.delete_packs([pack_name for pack_name in old_pack_names if pack_name != new_pack_name])
+    obj.delete_loose_objects(loose_object_hashes)
+    num_objects = len(reachable_objects)
+    print_col(f"Packed {num_objects} object{'s' if num_objects != 1 else ''} into {new_pack_name}.", "green")
+
+
+def fsmonitor(invocation):
+    """
+    Start, stop or check on the filesystem monitor (Linux only), which lets status and stage
+    only look at the files that have changed, rather than the whole working directory
+    """
+    if invocation.os.name != "LINUX":
+        sys.exit("The filesystem monitor is only supported on Linux.")
+    repo_path = invocation.repo.path
+    is_running = query_fsmonitor(repo_path, "") is not None
+    match invocation.args.get("start_or_stop_or_status") or "status":
+        case "start":
+            if is_running:
+                print("The filesystem monitor is already running.")
+            elif start_fsmonitor(repo_path):
+                print_col("Started the filesystem monitor.", "green")
+            else:
+                sys.exit("The filesystem monitor failed to start.\nYou may need to raise the limit on inotify watches (fs.inotify.max_user_watches).")
+        case "stop":
+            if is_running and stop_fsmonitor(repo_path):
+                print("Stopped the filesystem monitor.")
+            else:
+                print("The filesystem monitor is not running.")
+        case "status":
+            print(f"The filesystem monitor is {'running' if is_running else 'not running'}.")
+
+
+def daemon(invocation):
+    """
+    Start, stop or check on the daemon, which runs commands that don't need any input
+    (eg status) in a process that is kept running, so they don't have to start from scratch each time
+    """
+    if invocation.os.name == "WINDOWS":
+        sys.exit("The Gud daemon is not supported on Windows.")
+    repo_path = invocation.repo.path
+    is_running = is_daemon_running(repo_path)
+    match invocation.args.get("start_or_stop_or_status") or "status":
+        case "start":
+            if is_running:
+                print("The Gud daemon is already running.")
+            elif start_daemon(repo_path):
+                print_col("Started the Gud daemon.", "green")
+            else:
+                sys.exit("The Gud daemon failed to start.")
+        case "stop":
+            if is_running and stop_daemon(repo_path):
+                print("Stopped the Gud daemon.")
+            else:
+                print("The Gud daemon is not running.")
+        case "status":
+            print(f"The Gud daemon is {'running' if is_running else 'not running'}.")
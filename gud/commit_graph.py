@@ -0,0 +1,172 @@
+"""
+The commit-graph (.gud/commit-graph) - the tree, parent, generation and timestamp of every commit,
+stored in fixed-width records so the history can be walked without decompressing or parsing any commit objects:
+
+    header      signature, version, number of commits
+    fanout      256 cumulative counts - fanout[b] is the number of hashes whose first byte is <= b
+    lookup      every commit's raw 20 byte hash, sorted, each followed by that commit's position (below)
+    commits     one record per commit, in the order they were added (so a parent always comes before its children):
+                raw commit hash, raw tree hash, position of the parent, generation, timestamp
+    checksum    sha1 of everything above
+
+A commit's generation is 1 more than its parent's (and 1 for the first commit), so a commit can never be
+an ancestor of one with a lower generation. Timestamps are in microseconds since the epoch.
+
+As positions never change once a commit has been added, `gud commit` only has to append a record and insert
+a single lookup row, while `gud gc` rebuilds the whole thing (dropping any commits that are no longer reachable).
+Commits that aren't in the graph (eg ones made by an older version of Gud) are just read from their objects instead.
+"""
+import os
+import mmap
+import struct
+from hashlib import sha1
+
+
+COMMIT_GRAPH_SIGNATURE = b"GCGR"
+COMMIT_GRAPH_VERSION = 1
+NO_PARENT = 0xFFFFFFFF
+
+_HEADER = struct.Struct(">4sII") # signature, version, number of commits
+_FANOUT = struct.Struct(">256I")
+_LOOKUP_ROW = struct.Struct(">20sI") # raw commit hash, position
+_COMMIT_RECORD = struct.Struct(">20s20sIIq") # raw commit hash, raw tree hash, parent position, generation, timestamp
+_HASH_SIZE = 20
+
+
+class CommitGraph:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._file_id = _get_file_id(os.fstat(f.fileno()))
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, self.num_commits = _HEADER.unpack_from(self._mm, 0)
+        if signature != COMMIT_GRAPH_SIGNATURE or version > COMMIT_GRAPH_VERSION:
+            raise Exception(f"Commit graph {path} is corrupted, or not supported by this version of Gud.")
+        self.fanout = _FANOUT.unpack_from(self._mm, _HEADER.size)
+        self._lookup_start = _HEADER.size + _FANOUT.size
+        self._commits_start = self._lookup_start + _LOOKUP_ROW.size * self.num_commits
+
+    def find_position(self, commit_hash: str) -> int|None:
+        """ The position of the commit's record, or None if it isn't in the graph """
+        raw_hash = bytes.fromhex(commit_hash)
+        row_num = self._find_lookup_row(raw_hash)
+        row_start = self._lookup_start + row_num * _LOOKUP_ROW.size
+        if row_num < self.num_commits and self._mm[row_start:row_start + _HASH_SIZE] == raw_hash:
+            _, position = _LOOKUP_ROW.unpack_from(self._mm, row_start)
+            return position
+        return None
+
+    def get_commit(self, position: int) -> tuple[str, str, int|None, int, int]:
+        """ (commit hash, tree hash, parent position or None, generation, timestamp) of the commit at position """
+        raw_hash, raw_tree_hash, parent_position, generation, timestamp = _COMMIT_RECORD.unpack_from(
+            self._mm, self._commits_start + position * _COMMIT_RECORD.size
+        )
+        if parent_position == NO_PARENT:
+            parent_position = None
+        return raw_hash.hex(), raw_tree_hash.hex(), parent_position, generation, timestamp
+
+    def _find_lookup_row(self, raw_hash: bytes) -> int:
+        """ The row the hash is at in the lookup table, or the row it would be inserted at """
+        first_byte = raw_hash[0]
+        low = self.fanout[first_byte - 1] if first_byte > 0 else 0
+        high = self.fanout[first_byte]
+        while low < high:
+            mid = (low + high) // 2
+            row_start = self._lookup_start + mid * _LOOKUP_ROW.size
+            if self._mm[row_start:row_start + _HASH_SIZE] < raw_hash:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def is_stale(self) -> bool:
+        """ Whether the graph has been replaced (or deleted) since it was opened """
+        try:
+            return _get_file_id(os.stat(self.path)) != self._file_id
+        except FileNotFoundError:
+            return True
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+class CommitGraphWriter:
+    """
+    Writes a new commit-graph, containing every commit in base (if given) followed by the commits added.
+    Commits must be added after their parents. As it's mmap'd, base is closed before it's replaced
+    """
+    def __init__(self, base: CommitGraph|None = None):
+        self._base = base
+        self._num_base_commits = base.num_commits if base else 0
+        self._records = []
+        self._added = {} # raw hash -> (position, generation) of each commit added
+
+    def contains(self, commit_hash: str) -> bool:
+        if bytes.fromhex(commit_hash) in self._added:
+            return True
+        return self._base is not None and self._base.find_position(commit_hash) is not None
+
+    def add_commit(self, commit_hash: str, tree_hash: str, parent_hash: str|None, timestamp: int) -> None:
+        parent_position, generation = NO_PARENT, 1
+        if parent_hash:
+            parent_position, parent_generation = self._find_commit(parent_hash)
+            generation = parent_generation + 1
+        raw_hash = bytes.fromhex(commit_hash)
+        self._added[raw_hash] = (self._num_base_commits + len(self._records), generation)
+        self._records.append(_COMMIT_RECORD.pack(raw_hash, bytes.fromhex(tree_hash), parent_position, generation, timestamp))
+
+    def write(self, path: str) -> None:
+        """ Write the graph to a temp file, then move it into place (replacing any existing graph) """
+        lookup_parts = []
+        commit_parts = []
+        new_counts = [0] * 256
+        if self._base:
+            base_lookup = self._base._mm[self._base._lookup_start:self._base._commits_start]
+            base_commits_end = self._base._commits_start + _COMMIT_RECORD.size * self._num_base_commits
+            commit_parts.append(self._base._mm[self._base._commits_start:base_commits_end])
+        else:
+            base_lookup = b""
+        # merge the new commits' rows into the (already sorted) existing rows
+        prev_row_num = 0
+        for raw_hash in sorted(self._added):
+            row_num = self._base._find_lookup_row(raw_hash) if self._base else 0
+            lookup_parts.append(base_lookup[prev_row_num * _LOOKUP_ROW.size:row_num * _LOOKUP_ROW.size])
+            lookup_parts.append(_LOOKUP_ROW.pack(raw_hash, self._added[raw_hash][0]))
+            prev_row_num = row_num
+            new_counts[raw_hash[0]] += 1
+        lookup_parts.append(base_lookup[prev_row_num * _LOOKUP_ROW.size:])
+        fanout = list(self._base.fanout) if self._base else [0] * 256
+        num_new = 0
+        for i in range(256):
+            num_new += new_counts[i]
+            fanout[i] += num_new
+        commit_parts.extend(self._records)
+
+        num_commits = self._num_base_commits + len(self._records)
+        content = b"".join([
+            _HEADER.pack(COMMIT_GRAPH_SIGNATURE, COMMIT_GRAPH_VERSION, num_commits),
+            _FANOUT.pack(*fanout),
+            *lookup_parts,
+            *commit_parts
+        ])
+        temp_path = f"{path}.lock"
+        with open(temp_path, "wb") as f:
+            f.write(content)
+            f.write(sha1(content).digest())
+        if self._base:
+            self._base.close()
+        os.replace(temp_path, path)
+
+    def _find_commit(self, commit_hash: str) -> tuple[int, int]:
+        """ The (position, generation) of a commit already in the graph """
+        added = self._added.get(bytes.fromhex(commit_hash))
+        if added is not None:
+            return added
+        position = self._base.find_position(commit_hash) if self._base else None
+        if position is None:
+            raise Exception(f"Commit {commit_hash} must be added to the commit graph before its children.")
+        return position, self._base.get_commit(position)[3]
+
+
+def _get_file_id(file_stat: os.stat_result) -> tuple:
+    return file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size
@@ -0,0 +1,247 @@
+"""
+An optional background process (`gud daemon start`) that runs commands on behalf of `gud`, so each one doesn't have to
+pay for starting Python, importing everything, and opening the repository from scratch.
+
+The daemon listens on a unix socket in .gud. `gud` (run.py) sends it any command that never prompts or opens a pager
+(see can_run_in_daemon), and only runs the command itself if there's no daemon running for the repo.
+Everything the command prints is sent back as it's written, followed by its exit code - one JSON object per line:
+
+    client -> daemon    {"argv": [...], "cwd": ..., "isatty": ..., "env": {the client's GUD_* environment variables}}
+    daemon -> client    {"stdout": text} or {"stderr": text}, any number of times
+                        {"exit_code": code}
+
+Commands are run one at a time, all using the same Repository, so its parsed trees and commits (including those of HEAD),
+open packs and commit-graph stay in memory between commands, as do the compiled .gudignore rules (in re's cache).
+Before each command, the refs and config are re-read, and anything another process may have replaced is dropped
+(see Repository.refresh) - the index is always re-read, as it's a single mmap'd file.
+
+Only the standard library (and helpers.py, which is quick to import) is imported at the top of this module,
+as the client side is run before anything else.
+"""
+import io
+import json
+import os
+import select
+import socket
+import sys
+from .helpers import find_repo_root_dir, start_background_process, listen_on_unix_socket, receive_line, discard_closed_stdout
+
+
+DAEMON_SOCKET_NAME = "daemon.sock"
+DAEMON_START_TIMEOUT = 10 # seconds to wait for a new daemon to start listening
+DAEMON_TIMEOUT = 2 # seconds to wait for a request (from a client), or for the daemon to answer (eg `gud daemon status`)
+_READ_SIZE = 64 * 1024
+_OUTPUT_BUFFER_SIZE = 64 * 1024 # characters of output to collect before sending them to the client
+_IDLE_CHECK_INTERVAL = 60 # seconds between checks that the repo still exists
+
+
+class _ClientStream(io.TextIOBase):
+    """ Stands in for stdout/stderr while a command runs, sending whatever is written to the client """
+    def __init__(self, connection: socket.socket, name: str, is_tty: bool):
+        self._connection = connection
+        self._name = name
+        self._is_tty = is_tty
+        self._buffer = []
+        self._buffer_size = 0
+
+    def write(self, text: str) -> int:
+        self._buffer.append(text)
+        self._buffer_size += len(text)
+        if self._buffer_size >= _OUTPUT_BUFFER_SIZE:
+            self.flush()
+        return len(text)
+
+    def flush(self) -> None:
+        if self._buffer:
+            text = "".join(self._buffer)
+            self._buffer = []
+            self._buffer_size = 0
+            _send_message(self._connection, {self._name: text})
+
+    def isatty(self) -> bool:
+        """ Whether the client's stdout is a terminal (eg so colours are only used if they would be in the client) """
+        return self._is_tty
+
+
+class GudDaemon:
+    def __init__(self, repo_path: str):
+        self.repo_path = repo_path
+        self.repo = None # opened by the first command
+
+    def serve(self, server_socket: socket.socket) -> None:
+        """ Run commands until asked to stop (or the repo is deleted) """
+        while os.path.isdir(self.repo_path):
+            readable, _, _ = select.select([server_socket], [], [], _IDLE_CHECK_INTERVAL)
+            if not readable:
+                continue
+            connection, _ = server_socket.accept()
+            with connection:
+                try:
+                    # so a client that never finishes sending its request can't hang the daemon
+                    connection.settimeout(DAEMON_TIMEOUT)
+                    request = json.loads(receive_line(connection))
+                    connection.settimeout(None) # commands can take as long as they need, sending output as they go
+                    if request.get("stop"):
+                        _send_message(connection, {})
+                        return
+                    if "argv" not in request: # eg just checking whether the daemon is running
+                        _send_message(connection, {})
+                        continue
+                    _send_message(connection, {"exit_code": self.run_command(connection, request)})
+                except (OSError, ValueError): # the client went away, or sent something that isn't a request
+                    pass
+
+    def run_command(self, connection: socket.socket, request: dict) -> int:
+        """ Run a command as if it were run by the client, sending its output to the client. Returns the exit code """
+        import traceback
+        # the same as what main() would import, had the client run the command itself
+        from .classes import Repository
+        from .run import parser, run_command
+
+        stdout = _ClientStream(connection, "stdout", request["isatty"])
+        stderr = _ClientStream(connection, "stderr", request["isatty"])
+        original_stdout, original_stderr = sys.stdout, sys.stderr
+        original_env = {key: value for key, value in os.environ.items() if key.startswith("GUD_")}
+        sys.stdout, sys.stderr = stdout, stderr
+        exit_code = 0
+        try:
+            for key in original_env:
+                del os.environ[key]
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            all_args = parser.parse_args(request["argv"])
+            if self.repo is None:
+                self.repo = Repository(request["cwd"])
+            else:
+                self.repo.refresh()
+            run_command(all_args, request["cwd"], self.repo)
+        except SystemExit as e: # (including any from argparse or Repository)
+            if isinstance(e.code, int):
+                exit_code = e.code
+            elif e.code is not None:
+                print(e.code, file=stderr)
+                exit_code = 1
+        except Exception:
+            traceback.print_exc(file=stderr)
+            exit_code = 1
+        finally:
+            sys.stdout, sys.stderr = original_stdout, original_stderr
+            for key in [key for key in os.environ if key.startswith("GUD_")]:
+                del os.environ[key]
+            os.environ.update(original_env)
+            os.chdir(os.path.dirname(self.repo_path.rstrip(os.sep)))
+        stdout.flush()
+        stderr.flush()
+        return exit_code
+
+
+def run_daemon(repo_path: str) -> None:
+    """ The entry point of the background process """
+    repo_path = os.path.abspath(repo_path)
+    os.chdir(os.path.dirname(repo_path.rstrip(os.sep)))
+    with listen_on_unix_socket(os.path.join(repo_path, DAEMON_SOCKET_NAME)) as server_socket:
+        GudDaemon(repo_path).serve(server_socket)
+
+
+def start_daemon(repo_path: str) -> bool:
+    """ Start the daemon in the background, and wait until it's ready. Returns False if it failed to start """
+    return start_background_process("gud.daemon", repo_path, lambda: is_daemon_running(repo_path), DAEMON_START_TIMEOUT)
+
+
+def stop_daemon(repo_path: str) -> bool:
+    """ Returns False if the daemon wasn't running """
+    return _send_request(os.path.join(repo_path, DAEMON_SOCKET_NAME), {"stop": True}) is not None
+
+
+def is_daemon_running(repo_path: str) -> bool:
+    return _send_request(os.path.join(repo_path, DAEMON_SOCKET_NAME), {}) is not None
+
+
+def can_run_in_daemon(all_args, stdout_is_tty: bool) -> bool:
+    """ Only commands that never prompt (or open a pager) can be run by the daemon """
+    match all_args.command:
+        case "status" | "ignoring":
+            return True
+        case "stage":
+            return bool(all_args.add_or_remove and all_args.file_paths)
+        case "log":
+            return all_args.no_pager or not stdout_is_tty
+    return False
+
+
+def run_in_daemon(all_args, argv: list, cwd: str) -> int|None:
+    """
+    Have the repo's daemon run the command, if there is one running and it can.
+    Returns the exit code, or None if the command still needs to be run
+    """
+    stdout_is_tty = sys.stdout.isatty()
+    if not can_run_in_daemon(all_args, stdout_is_tty):
+        return None
+    socket_path = find_daemon_socket(cwd)
+    if socket_path is None:
+        return None
+    client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client_socket.connect(socket_path)
+    except OSError: # eg left behind by a daemon that didn't exit cleanly
+        client_socket.close()
+        return None
+    with client_socket:
+        request = {
+            "argv": argv,
+            "cwd": cwd,
+            "isatty": stdout_is_tty,
+            "env": {key: value for key, value in os.environ.items() if key.startswith("GUD_")}
+        }
+        client_socket.sendall(json.dumps(request).encode() + b"\n")
+        buffer = b""
+        while chunk := client_socket.recv(_READ_SIZE):
+            buffer += chunk
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                message = json.loads(line)
+                if "exit_code" in message:
+                    return message["exit_code"]
+                if "stdout" in message:
+                    try:
+                        sys.stdout.write(message["stdout"])
+                        sys.stdout.flush()
+                    except BrokenPipeError: # eg piped into `head` - closing the connection stops the daemon sending any more
+                        discard_closed_stdout()
+                        return 0
+                else:
+                    sys.stderr.write(message["stderr"])
+    # the command may have been partly run, so can't just be run again
+    sys.exit("Lost connection to the Gud daemon.")
+
+
+def find_daemon_socket(cwd: str) -> str|None:
+    """ The socket of the daemon for the repo that cwd is in, or None if there isn't one running """
+    if os.name == "nt": # (no unix sockets)
+        return None
+    repo_root = find_repo_root_dir(cwd)
+    if not repo_root:
+        return None
+    socket_path = os.path.join(repo_root, ".gud", DAEMON_SOCKET_NAME)
+    return socket_path if os.path.exists(socket_path) else None
+
+
+def _send_request(socket_path: str, request: dict) -> dict|None:
+    if not os.path.exists(socket_path):
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+            client_socket.settimeout(DAEMON_TIMEOUT)
+            client_socket.connect(socket_path)
+            client_socket.sendall(json.dumps(request).encode() + b"\n")
+            return json.loads(receive_line(client_socket))
+    except (OSError, ValueError):
+        return None
+
+
+def _send_message(connection: socket.socket, message: dict) -> None:
+    connection.sendall(json.dumps(message).encode() + b"\n")
+
+
+if __name__ == "__main__":
+    run_daemon(sys.argv[1])
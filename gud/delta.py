@@ -0,0 +1,156 @@
+"""
+Delta compression - describing one object (the target) as a series of instructions
+that rebuild it from another, similar object (the base).
+
+A delta is laid out as:
+
+    base size, target size (varints)
+    instructions, each either:
+        COPY    offset, size (varints)     - copy size bytes from the base, starting at offset
+        INSERT  size (varint), data        - insert the following size bytes of data as-is
+
+Matches are found by indexing the base in fixed-size blocks, then looking up positions of the target
+in that index and extending any match as far as possible in both directions.
+Every position is looked up at first, but after a run of misses the lookups step further and further ahead
+(as LZ4 does), so a stretch of the target with nothing in common with the base doesn't cost a lookup per byte.
+The steps are always odd, so they can't keep stepping over the base's block boundaries - any match long enough
+is still found within a few steps, and extending it backwards recovers the bytes that were stepped over.
+"""
+
+
+_COPY = 0x01
+_INSERT = 0x02
+_BLOCK_SIZE = 16
+_EXTEND_CHUNK_SIZE = 4096
+_MISSES_PER_STEP_INCREASE = 32 # after this many misses in a row, the step grows by 2
+_MAX_STEP = 31
+# rough bytes used by each indexed block: the 16-byte key (a bytes object), its offset (an int) and the dict slot
+_INDEX_BYTES_PER_BLOCK = 120
+
+
+class DeltaIndex:
+    """
+    An index of a base object's blocks. Building this is the expensive part,
+    so it is built once per base and reused for every target compared against that base
+    """
+    def __init__(self, base: bytes):
+        self.base = base
+        self._block_offsets = {}
+        for offset in range(0, len(base) - _BLOCK_SIZE + 1, _BLOCK_SIZE):
+            self._block_offsets.setdefault(base[offset:offset + _BLOCK_SIZE], offset)
+        # roughly how much memory the index (including the base itself) takes up
+        self.memory_size = len(base) + len(self._block_offsets) * _INDEX_BYTES_PER_BLOCK
+
+    def create_delta(self, target: bytes, max_size: int|None = None) -> bytes|None:
+        """
+        Returns None if the delta would be larger than max_size (ie not worth storing as a delta)
+        """
+        base = self.base
+        delta = bytearray(_encode_varint(len(base)) + _encode_varint(len(target)))
+        block_offsets = self._block_offsets
+        insert_start = 0 # start of the target bytes not yet covered by an instruction
+        pos = 0
+        num_misses = 0 # in a row
+        last_block_start = len(target) - _BLOCK_SIZE
+        while pos <= last_block_start:
+            base_offset = block_offsets.get(target[pos:pos + _BLOCK_SIZE])
+            if base_offset is None:
+                num_misses += 1
+                pos += min(1 + 2 * (num_misses // _MISSES_PER_STEP_INCREASE), _MAX_STEP)
+                if max_size is not None and pos - insert_start > max_size: # the insert alone is too big
+                    return None
+                continue
+            num_misses = 0
+            # extend the match backwards into the bytes waiting to be inserted...
+            match_start, base_start = pos, base_offset
+            while match_start > insert_start and base_start > 0 and target[match_start - 1] == base[base_start - 1]:
+                match_start -= 1
+                base_start -= 1
+            # ...and forwards as far as it goes
+            match_end = pos + _BLOCK_SIZE
+            base_end = base_offset + _BLOCK_SIZE
+            match_end, base_end = _extend_match(base, target, base_end, match_end)
+            if match_start > insert_start:
+                _append_insert(delta, target[insert_start:match_start])
+            delta.append(_COPY)
+            delta += _encode_varint(base_start)
+            delta += _encode_varint(match_end - match_start)
+            insert_start = pos = match_end
+            if max_size is not None and len(delta) > max_size:
+                return None
+        if insert_start < len(target):
+            _append_insert(delta, target[insert_start:])
+        if max_size is not None and len(delta) > max_size:
+            return None
+        return bytes(delta)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    base_size, pos = _decode_varint(delta, 0)
+    target_size, pos = _decode_varint(delta, pos)
+    if base_size != len(base):
+        raise ValueError(f"Delta expects a base of {base_size} bytes, but the base is {len(base)} bytes.")
+    base_view = memoryview(base)
+    target = bytearray()
+    while pos < len(delta):
+        instruction = delta[pos]
+        pos += 1
+        if instruction == _COPY:
+            offset, pos = _decode_varint(delta, pos)
+            size, pos = _decode_varint(delta, pos)
+            target += base_view[offset:offset + size]
+        elif instruction == _INSERT:
+            size, pos = _decode_varint(delta, pos)
+            target += delta[pos:pos + size]
+            pos += size
+        else:
+            raise ValueError(f"Invalid delta instruction {instruction}.")
+    if len(target) != target_size:
+        raise ValueError(f"Delta produced {len(target)} bytes, but {target_size} bytes were expected.")
+    return bytes(target)
+
+
+def _extend_match(base: bytes, target: bytes, base_end: int, target_end: int) -> tuple[int, int]:
+    """ Compare whole chunks at a time first (much faster than byte by byte for long matches) """
+    while True:
+        chunk_size = min(_EXTEND_CHUNK_SIZE, len(base) - base_end, len(target) - target_end)
+        if chunk_size <= 0:
+            return target_end, base_end
+        if base[base_end:base_end + chunk_size] == target[target_end:target_end + chunk_size]:
+            base_end += chunk_size
+            target_end += chunk_size
+            continue
+        # the mismatch is somewhere in this chunk
+        while base[base_end] == target[target_end]:
+            base_end += 1
+            target_end += 1
+        return target_end, base_end
+
+
+def _append_insert(delta: bytearray, data: bytes) -> None:
+    delta.append(_INSERT)
+    delta += _encode_varint(len(data))
+    delta += data
+
+
+def _encode_varint(value: int) -> bytes:
+    """ 7 bits per byte, with the high bit set on every byte except the last """
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _decode_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """ Returns the value, and the position just after it """
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
@@ -0,0 +1,263 @@
+"""
+An optional filesystem monitor for Linux (`gud fsmonitor start`), so commands don't have to look at every file
+in the working directory to find out what has changed.
+
+A background process watches every directory in the working directory using inotify, and records each path that changes.
+Commands ask it (over a unix socket in .gud) which paths have changed since a token, and are sent a new token back.
+The index stores the token from when the working directory was last compared to it, along with every path that didn't match
+the index at that point (see FsMonitorState), so only those paths and the ones that have changed since need checking.
+
+Tokens are "<id of the monitor process>:<event batch number>". The monitor can't answer (so the whole working directory
+is walked, just as if the monitor wasn't running) for a token from a different monitor process, if the kernel's event queue
+overflowed since the token was given out, or if the monitor has since forgotten some of the paths that changed
+(only the latest FSMONITOR_MAX_CHANGED_PATHS are remembered, so a busy tree can't make it use more and more memory).
+A changed .gudignore file means a full walk too, as it can change which files are ignored anywhere below it.
+"""
+import json
+import os
+import select
+import socket
+import struct
+import sys
+from collections import OrderedDict
+from .helpers import start_background_process, listen_on_unix_socket, receive_line, LazyModule
+from .ignore import GUDIGNORE_FILE_NAME
+
+
+# only needed by the monitor process itself
+ctypes = LazyModule("ctypes")
+ctypes_util = LazyModule("ctypes.util")
+
+FSMONITOR_SOCKET_NAME = "fsmonitor.sock"
+FSMONITOR_TIMEOUT = 2 # seconds to wait for the monitor to answer before giving up on it
+FSMONITOR_START_TIMEOUT = 60 # seconds to wait for a new monitor to watch every directory
+# the most changed paths remembered - past this, the oldest are forgotten, and tokens from before them can't be answered
+FSMONITOR_MAX_CHANGED_PATHS = 100_000
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_DONT_FOLLOW = 0x2000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+_EVENT_HEADER = struct.Struct("iIII") # watch descriptor, mask, cookie, length of name
+_READ_SIZE = 64 * 1024
+_IDLE_CHECK_INTERVAL = 60 # seconds between checks that the repo still exists
+
+
+class FsMonitorDaemon:
+    """ The background process - see `run_fsmonitor_daemon` """
+    def __init__(self, repo_root: str):
+        self.repo_root = repo_root
+        self.instance_id = os.urandom(8).hex()
+        self.batch_num = 0 # incremented every time events are read
+        self.overflowed_at = 0 # tokens from before this batch can't be answered
+        self.changed_paths = OrderedDict() # path -> batch it last changed in, oldest first
+        self._watched_dirs = {} # watch descriptor -> dir path
+        self._watch_descriptors = {} # dir path -> watch descriptor
+        self._libc = ctypes.CDLL(ctypes_util.find_library("c") or "libc.so.6", use_errno=True)
+        self._inotify_fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._inotify_fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def watch_dir(self, dir_path: str) -> None:
+        """ Watch dir_path and every dir below it (apart from .gud), without following symlinks """
+        dirs_to_watch = [dir_path]
+        while dirs_to_watch:
+            dir_path = dirs_to_watch.pop()
+            abs_path = os.path.join(self.repo_root, dir_path)
+            watch_descriptor = self._libc.inotify_add_watch(self._inotify_fd, os.fsencode(abs_path), _WATCH_MASK)
+            if watch_descriptor < 0:
+                errno = ctypes.get_errno()
+                if errno in (2, 20): # ENOENT, ENOTDIR - it's already gone, which will show up as its own event
+                    continue
+                raise OSError(errno, f"Could not watch {abs_path} (you may need to raise fs.inotify.max_user_watches)")
+            self._watched_dirs[watch_descriptor] = dir_path
+            self._watch_descriptors[dir_path] = watch_descriptor
+            try:
+                dir_entries = list(os.scandir(abs_path))
+            except (FileNotFoundError, NotADirectoryError, PermissionError):
+                continue
+            for dir_entry in dir_entries:
+                if dir_entry.is_dir(follow_symlinks=False) and not (dir_path == "" and dir_entry.name == ".gud"):
+                    dirs_to_watch.append(os.path.join(dir_path, dir_entry.name))
+
+    def read_events(self) -> None:
+        """ Record every event that the kernel has queued up so far (without waiting for more) """
+        while True:
+            try:
+                data = os.read(self._inotify_fd, _READ_SIZE)
+            except BlockingIOError:
+                return
+            self.batch_num += 1
+            offset = 0
+            while offset < len(data):
+                watch_descriptor, mask, _, name_length = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+                offset += name_length
+                self._handle_event(watch_descriptor, mask, name)
+
+    def answer(self, token: str) -> dict:
+        """ {"token": new token, "paths": every path changed since token (or None if that isn't known)} """
+        self.read_events() # so everything that happened before the question is included
+        response = {"token": f"{self.instance_id}:{self.batch_num}", "paths": None}
+        instance_id, _, batch_num = token.partition(":")
+        if instance_id != self.instance_id or not batch_num.isdigit() or int(batch_num) < self.overflowed_at:
+            return response
+        since = int(batch_num)
+        paths = []
+        for path, changed_at in reversed(self.changed_paths.items()):
+            if changed_at <= since:
+                break
+            paths.append(path)
+        response["paths"] = paths
+        return response
+
+    def serve(self, server_socket: socket.socket, repo_path: str) -> None:
+        """ Handle requests until asked to stop (or the repo is deleted) """
+        while os.path.isdir(repo_path):
+            readable, _, _ = select.select([self._inotify_fd, server_socket], [], [], _IDLE_CHECK_INTERVAL)
+            if self._inotify_fd in readable:
+                self.read_events()
+            if server_socket not in readable:
+                continue
+            connection, _ = server_socket.accept()
+            with connection:
+                connection.settimeout(FSMONITOR_TIMEOUT)
+                try:
+                    command, _, token = receive_line(connection).partition(" ")
+                    if command == "stop":
+                        connection.sendall(b"{}\n")
+                        return
+                    connection.sendall(json.dumps(self.answer(token)).encode() + b"\n")
+                except OSError: # the client went away
+                    pass
+
+    def close(self) -> None:
+        os.close(self._inotify_fd)
+
+    def _handle_event(self, watch_descriptor: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW: # events were dropped, so nothing from before now can be answered
+            self.overflowed_at = self.batch_num
+            return
+        dir_path = self._watched_dirs.get(watch_descriptor)
+        if dir_path is None:
+            return
+        if mask & IN_IGNORED: # the watch has gone (eg the dir was deleted)
+            self._forget_watch(watch_descriptor)
+            return
+        if not name: # an event on a watched dir itself, which its parent dir's watch also reports
+            return
+        path = os.path.join(dir_path, name)
+        if path == ".gud":
+            return
+        self.changed_paths[path] = self.batch_num
+        self.changed_paths.move_to_end(path)
+        if len(self.changed_paths) > FSMONITOR_MAX_CHANGED_PATHS:
+            _, forgotten_batch_num = self.changed_paths.popitem(last=False)
+            self.overflowed_at = max(self.overflowed_at, forgotten_batch_num)
+        if mask & IN_ISDIR:
+            if mask & IN_MOVED_FROM: # its watches now point somewhere else
+                self._unwatch_dir(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                # anything created in it before it was watched is covered by the dir itself being marked as changed
+                self.watch_dir(path)
+
+    def _unwatch_dir(self, dir_path: str) -> None:
+        """ Stop watching dir_path and every dir below it """
+        prefix = dir_path + os.sep
+        for watched_path in [path for path in self._watch_descriptors if path == dir_path or path.startswith(prefix)]:
+            watch_descriptor = self._watch_descriptors[watched_path]
+            self._libc.inotify_rm_watch(self._inotify_fd, watch_descriptor)
+            self._forget_watch(watch_descriptor)
+
+    def _forget_watch(self, watch_descriptor: int) -> None:
+        dir_path = self._watched_dirs.pop(watch_descriptor, None)
+        if dir_path is not None and self._watch_descriptors.get(dir_path) == watch_descriptor:
+            del self._watch_descriptors[dir_path]
+
+
+def run_fsmonitor_daemon(repo_path: str) -> None:
+    """ The entry point of the background process - watches the repo's working directory, then answers requests """
+    repo_path = os.path.abspath(repo_path)
+    daemon = FsMonitorDaemon(os.path.dirname(repo_path.rstrip(os.sep)))
+    try:
+        daemon.watch_dir("")
+        # only listen once every dir is watched, so every token given out is valid
+        with listen_on_unix_socket(os.path.join(repo_path, FSMONITOR_SOCKET_NAME)) as server_socket:
+            daemon.serve(server_socket, repo_path)
+    finally:
+        daemon.close()
+
+
+def start_fsmonitor(repo_path: str) -> bool:
+    """ Start the monitor in the background, and wait until it's ready. Returns False if it failed to start """
+    return start_background_process(
+        "gud.fsmonitor", repo_path, lambda: query_fsmonitor(repo_path, "") is not None, FSMONITOR_START_TIMEOUT
+    )
+
+
+def stop_fsmonitor(repo_path: str) -> bool:
+    """ Returns False if the monitor wasn't running """
+    return _send_request(repo_path, "stop") is not None
+
+
+def query_fsmonitor(repo_path: str, token: str) -> tuple[str, list|None]|None:
+    """
+    (new token, every path that has changed since token - or None if the monitor can't tell),
+    or None if the monitor isn't running
+    """
+    response = _send_request(repo_path, f"query {token}")
+    if response is None:
+        return None
+    return response["token"], response["paths"]
+
+
+def get_fsmonitor_changes(repo) -> tuple[str, set|None]|None:
+    """
+    Which paths may no longer match the (already parsed) index, according to the monitor - as (new token, paths),
+    where paths is None if the whole working directory has to be checked. None if the monitor isn't running.
+    A path may be a directory, in which case everything inside it needs checking
+    """
+    response = query_fsmonitor(repo.path, repo.fsmonitor_state.token)
+    if response is None:
+        return None
+    new_token, changed_paths = response
+    if changed_paths is None or any(os.path.basename(path) == GUDIGNORE_FILE_NAME for path in changed_paths):
+        return new_token, None
+    return new_token, repo.fsmonitor_state.dirty_paths | set(changed_paths)
+
+
+def _send_request(repo_path: str, request: str) -> dict|None:
+    socket_path = os.path.join(repo_path, FSMONITOR_SOCKET_NAME)
+    if not os.path.exists(socket_path): # (also the case on any OS other than Linux)
+        return None
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+            client_socket.settimeout(FSMONITOR_TIMEOUT)
+            client_socket.connect(socket_path)
+            client_socket.sendall(request.encode() + b"\n")
+            return json.loads(receive_line(client_socket))
+    except (OSError, ValueError):
+        return None
+
+
+if __name__ == "__main__":
+    run_fsmonitor_daemon(sys.argv[1])
@@ -1 +1,31 @@
-COMPRESSION_LEVEL = 3
\ No newline at end of file
+COMPRESSION_LEVEL = 3
+
+# stat info cached per index entry, used to skip re-hashing unchanged files
+INDEX_STAT_FIELDS = ("mtime", "ctime", "size", "ino", "dev")
+
+# object format 1 hashed the *compressed* contents of objects, so every hash needed a compression pass
+# object format 2 hashes the uncompressed contents, and only compresses objects when storing them
+LEGACY_OBJECT_FORMAT = 1
+OBJECT_FORMAT_VERSION = 2
+
+# files larger than this are read (and written to the object store) one chunk at a time
+OBJECT_STREAM_CHUNK_SIZE = 1024 * 1024
+
+# delta compression settings, used when building packs (`gud gc`)
+PACK_DELTA_WINDOW = 10 # how many of the previous (similar) objects are tried as delta bases
+PACK_MAX_DELTA_DEPTH = 10 # longest chain of deltas allowed, so reading an object stays fast
+# larger objects are never deltified (or used as bases), as finding matches in pure Python is slow, and each base's index is big
+PACK_MAX_DELTA_OBJECT_SIZE = 2 * 1024 * 1024
+# once the indexes of the bases in the window (see DeltaIndex.memory_size) add up to more than this, the oldest are dropped
+PACK_DELTA_WINDOW_MEMORY = 128 * 1024 * 1024
+PACK_DELTA_BASE_CACHE_SIZE = 32 * 1024 * 1024 # bytes of reconstructed delta bases kept in memory
+
+# bytes of parsed trees and commits kept in memory, so each object is only decoded once per command
+# (can be overridden with `object_cache_size` in the [core] section of the config)
+OBJECT_CACHE_SIZE = 16 * 1024 * 1024
+
+# files are hashed/compressed/written on a pool of threads (zlib, hashlib and file I/O all release the GIL)
+# the number of threads defaults to the number of CPUs - it can be set with `threads` in the [core] section of the config,
+# or the GUD_THREADS environment variable (which takes priority)
+PARALLEL_BATCH_SIZE = 1024 * 1024 # small files are grouped into batches of about this many bytes per task...
+PARALLEL_BATCH_MAX_FILES = 64 # ...or at most this many files
@@ -1,11 +1,20 @@
 import re
 from enum import Enum
 import os
-import subprocess
+import socket
+import sys
+import time
+import importlib
 import importlib.util
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock
 from os.path import realpath
-from pathlib import Path
-from termcolor import colored
+from .globals import INDEX_STAT_FIELDS
+
+
+_SOCKET_READ_SIZE = 64 * 1024
+_umask: int|None = None # read the first time it's needed
 
 
 class EnumWrapper(Enum):
@@ -23,6 +32,94 @@ class OperatingSystem(EnumWrapper):
     LINUX = "Linux"
 
 
+class LRUCache:
+    """
+    Holds up to max_size bytes worth of values (the size of each value is given when it is added).
+    Once full, the least recently used values are dropped first.
+    Safe to share between threads (eg the workers writing files during a checkout all read from the same packs)
+    """
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._size = 0
+        self._values: OrderedDict = OrderedDict() # key -> (value, size)
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            cached = self._values.get(key)
+            if cached is None:
+                return default
+            self._values.move_to_end(key)
+            return cached[0]
+
+    def put(self, key, value, size: int) -> None:
+        with self._lock:
+            if key in self._values or size > self.max_size:
+                return
+            self._values[key] = (value, size)
+            self._size += size
+            while self._size > self.max_size:
+                _, (_, evicted_size) = self._values.popitem(last=False)
+                self._size -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._values.clear()
+            self._size = 0
+
+
+class LazyModule:
+    """ Stands in for a module that is slow to import, only importing it once one of its attributes is used """
+    def __init__(self, module_name: str):
+        self._module_name = module_name
+
+    def __getattr__(self, name: str):
+        return getattr(importlib.import_module(self._module_name), name)
+
+
+subprocess = LazyModule("subprocess") # only needed to run other programs (eg the pager)
+pathlib = LazyModule("pathlib")
+termcolor = LazyModule("termcolor")
+
+
+def find_repo_root_dir(cwd: str) -> str:
+    """
+    The dir containing the deepest .gud dir at or above cwd (with a single stat per dir), or "" if there isn't one.
+    GUD_DIR can be set to the path of a .gud dir, to skip looking for one
+    """
+    gud_dir = os.environ.get("GUD_DIR")
+    if gud_dir:
+        gud_dir = os.path.abspath(gud_dir)
+        if os.path.basename(gud_dir) != ".gud" or not os.path.isdir(gud_dir):
+            return ""
+        return os.path.dirname(gud_dir)
+    curr_path = cwd
+    while True:
+        if os.path.isdir(os.path.join(curr_path, ".gud")):
+            return curr_path
+        parent_dir_path = os.path.dirname(curr_path)
+        if parent_dir_path == curr_path:
+            return ""
+        curr_path = parent_dir_path
+
+
+def get_mtime(file_path: str) -> int|None:
+    """ In nanoseconds, or None if the file doesn't exist """
+    try:
+        return os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def get_new_file_permissions() -> int:
+    """ The permissions open() gives a new file - for files made with tempfile.mkstemp, which are only readable by their owner """
+    global _umask
+    if _umask is None: # (it can only be read by setting it, so it's put straight back)
+        _umask = os.umask(0)
+        os.umask(_umask)
+    return 0o666 & ~_umask
+
+
 def is_valid_username(username) -> bool:
     regex_pattern = r"^\w+$"
     results = re.search(regex_pattern, username)
@@ -59,12 +156,90 @@ def open_relevant_editor(op_sys: OperatingSystem, file_path: str) -> None:
             subprocess.run(["nano", file_path], check=True)
 
 
-def open_relevant_pager(op_sys: OperatingSystem, pager: str, file_path: str) -> None:
+def write_to_pager(op_sys: OperatingSystem, pager: str, text_chunks) -> None:
+    """
+    Pipe the text into the pager's stdin as it's generated, so the first screen appears straight away.
+    If the pager is closed before the end (eg the user presses q), no more text is generated
+    """
     match op_sys.name:
         case "WINDOWS":
-            os.system(f"{pager} {file_path}")
+            process = subprocess.Popen(pager, stdin=subprocess.PIPE, shell=True, encoding="utf-8")
         case _:
-             subprocess.run([pager, file_path], check=True) # open log file
+            process = subprocess.Popen([pager], stdin=subprocess.PIPE, encoding="utf-8")
+    try:
+        for chunk in text_chunks:
+            process.stdin.write(chunk)
+        process.stdin.close()
+    except BrokenPipeError: # the pager has been closed
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    process.wait()
+
+
+def discard_closed_stdout() -> None:
+    """
+    For when whatever stdout was piped into has exited (eg `gud log | head`) - anything still buffered, or written later,
+    goes nowhere, rather than raising another BrokenPipeError (eg when stdout is flushed as Python exits)
+    """
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    os.close(devnull)
+
+
+def start_background_process(module_name: str, repo_path: str, is_ready, timeout: float) -> bool:
+    """
+    Run `python -m <module_name> <repo_path>` in the background (so it carries on after this command, and terminal, exit),
+    and wait until is_ready() returns True. Returns False if it exited, or wasn't ready in time
+    """
+    package_parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [package_parent_dir, os.environ.get("PYTHONPATH")]))}
+    process = subprocess.Popen(
+        [sys.executable, "-m", module_name, repo_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+        env=env
+    )
+    deadline = time.monotonic() + timeout
+    while process.poll() is None and time.monotonic() < deadline:
+        if is_ready():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+@contextmanager
+def listen_on_unix_socket(socket_path: str):
+    """ Replaces any socket left behind by a process that didn't exit cleanly, and removes the socket afterwards """
+    server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.remove(socket_path)
+    except FileNotFoundError:
+        pass
+    server_socket.bind(socket_path)
+    server_socket.listen()
+    try:
+        yield server_socket
+    finally:
+        server_socket.close()
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+
+
+def receive_line(connection: socket.socket) -> str:
+    """ Read from the socket up to the end of a line (or until it's closed), without the newline """
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = connection.recv(_SOCKET_READ_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode().rstrip("\n")
 
 
 def see_if_command_exists(command: str):
@@ -90,44 +265,12 @@ def get_file_from_package_installation(file_path) -> None|str:
     return full_file_path
 
 
-def parse_gudignore_in_dir(parent_dir) -> set:
-    """ parent_dir is the directory where a specific gudignore exists """
-    gudignore_path = os.path.join(parent_dir, ".gudignore")
-    if not os.path.exists(gudignore_path):
-        raise Exception(f"Gudignore file does not exist in {parent_dir}")
-    ignored_file_paths = set()
-    with open(gudignore_path, "r", encoding="utf-8") as f:
-        file_paths = [line.strip() for line in f.readlines() if line.strip()]
-        for file_path in file_paths:
-            full_file_path = os.path.join(parent_dir, file_path)
-            if not file_path.startswith("#"):
-                ignored_file_paths.add(full_file_path)
-    return ignored_file_paths
-
-
-def get_all_ignored_paths(initial_dir, as_rel_path=False) -> set:
-    """
-    as_rel_path determines if the paths returned are relative to the initial_dir or not
-    """
-    # TODO - determine if I will ever use as_rel_path
-    all_ignored_file_paths = set() # contains full file paths
-    for root, subdirs, files in os.walk(initial_dir):
-        if ".gudignore" in files:
-            ignored_file_paths = parse_gudignore_in_dir(root)
-            if as_rel_path:
-                rel_paths = set(os.path.relpath(file_path, initial_dir) for file_path in ignored_file_paths)
-                all_ignored_file_paths.update(rel_paths)
-            else:
-                all_ignored_file_paths.update(ignored_file_paths)
-    return all_ignored_file_paths
-
-
 def format_path_for_gudignore(path_str, check_if_dir=True):
     """
     1) posix-style file path
     2) ends in backslash if the path is a directory
     """
-    path = Path(path_str)
+    path = pathlib.Path(path_str)
     path_posix = path.as_posix()
     if not check_if_dir: # prioritise keeping the trailing slash
         if path_str.endswith("/") and not path_posix.endswith("/"):
@@ -138,15 +281,50 @@ def format_path_for_gudignore(path_str, check_if_dir=True):
     return path_posix
 
 
-def get_file_mode(file_path):
+def get_file_mode(file_path, file_stat=None):
     """
     Returns a 6 digit octal number
     First 3 digits represent the file type (100 means normal file)
     The next 3 digits show the file mode for user, group, others (respectively)
     See https://docs.nersc.gov/filesystems/unix-file-permissions/ for an explanation
+    file_stat can be passed in if the file has already been stat'd, to avoid another syscall
     """
-    return oct(os.stat(file_path).st_mode).replace("0o", "")
+    if file_stat is None:
+        file_stat = os.stat(file_path)
+    return oct(file_stat.st_mode).replace("0o", "")
+
+
+def get_stat_info(file_stat: os.stat_result) -> dict:
+    """ The stat info that gets cached for each file in the index """
+    return {
+        "mtime": file_stat.st_mtime_ns,
+        "ctime": file_stat.st_ctime_ns,
+        "size": file_stat.st_size,
+        "ino": file_stat.st_ino,
+        "dev": file_stat.st_dev
+    }
+
+
+def get_empty_stat_info() -> dict:
+    """ For index entries with no cached stat info - these will always be re-hashed """
+    return {field: 0 for field in INDEX_STAT_FIELDS}
+
+
+def stat_info_matches(index_entry: dict, file_stat: os.stat_result) -> bool:
+    """
+    True if the file looks unchanged since its index entry was last hashed.
+    An mtime of 0 means there is no stat info cached (or it was "smudged"), so it never matches
+    """
+    if not index_entry.get("mtime"):
+        return False
+    stat_info = get_stat_info(file_stat)
+    return all(index_entry.get(field) == stat_info[field] for field in INDEX_STAT_FIELDS)
+
+
+def get_entry_signature(index_entry: dict) -> tuple:
+    """ The parts of an index entry that describe the file's contents (ie ignoring stat info) """
+    return (index_entry["type"], index_entry["mode"], index_entry["hash"])
 
 
 def print_col(text, col, *args, **kwargs):
-    print(colored(text, col), *args, **kwargs)
+    print(termcolor.colored(text, col), *args, **kwargs)
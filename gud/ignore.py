@@ -0,0 +1,238 @@
+"""
+Matching paths against the rules in .gudignore files.
+
+Each line of a .gudignore file is a rule, which applies to the paths inside the directory the file is in:
+
+    notes.txt       a name (with no slash) matches at any depth - eg notes.txt, docs/notes.txt
+    build/          a trailing slash means the rule only matches directories
+    /todo.txt       a leading (or middle) slash anchors the rule to this directory - eg docs/*.md
+    *.log, ?, [ab]  globs, none of which match a slash
+    **              matches any number of directories - eg **/cache, logs/**, a/**/b
+    !keep.log       re-includes a path that an earlier rule ignored
+    # comment
+
+Later rules take priority over earlier ones, and rules in deeper .gudignore files over shallower ones.
+Anything inside an ignored directory is ignored too (and can't be re-included).
+
+The rules are kept in a trie with one node per directory, so a path is only checked against the rules of
+the .gudignore files above it, and each node's rules are combined into a single regex (one match per path,
+however many rules there are). The combined regexes are cached in .gud/, keyed by each file's mtime and size.
+.gudignore files are only loaded for the directories that are actually looked at (eg by WorkingDirWalker),
+so ignored directories are never even searched for them.
+"""
+import json
+import os
+import re
+
+
+GUDIGNORE_FILE_NAME = ".gudignore"
+IGNORE_CACHE_VERSION = 1
+
+
+class _IgnoreNode:
+    """ A directory in the trie - regexes are only set if there is a .gudignore file in it """
+    def __init__(self):
+        self.children: dict[str, "_IgnoreNode"] = {}
+        self.file_regex: re.Pattern|None = None
+        self.dir_regex: re.Pattern|None = None
+
+
+class IgnoreMatcher:
+    def __init__(self, repo_root: str, cache_path: str|None = None):
+        self.repo_root = repo_root
+        self.cache_path = cache_path
+        self._root = _IgnoreNode()
+        self._ignored_dirs: dict[str, bool] = {} # dir path -> whether it (or a parent) is ignored
+        self._cache = self._read_cache() # dir path -> {mtime, size, file_regex, dir_regex}
+        self._cache_needs_write = False
+        self._loaded_dirs: dict[str, bool] = {} # dir path -> whether it has a .gudignore file
+
+    @classmethod
+    def for_repo(cls, repo) -> "IgnoreMatcher":
+        return cls(repo.root, os.path.join(repo.path, "ignore_cache"))
+
+    def load_dir(self, dir_path: str, has_gudignore: bool|None = None) -> None:
+        """
+        Load the .gudignore file in dir_path, if there is one and it hasn't been loaded already.
+        has_gudignore can be passed in if it is already known (eg from a directory listing), to save a stat
+        """
+        if dir_path in self._loaded_dirs:
+            return
+        if has_gudignore is None:
+            has_gudignore = os.path.isfile(os.path.join(self.repo_root, dir_path, GUDIGNORE_FILE_NAME))
+        if has_gudignore:
+            self.add_gudignore(dir_path)
+        else:
+            self._loaded_dirs[dir_path] = False
+
+    def add_gudignore(self, dir_path: str) -> None:
+        """ Load the rules from the .gudignore file in dir_path (relative to the repo root, "." or "" for the root) """
+        dir_path = "" if dir_path == "." else dir_path
+        gudignore_path = os.path.join(self.repo_root, dir_path, GUDIGNORE_FILE_NAME)
+        file_stat = os.stat(gudignore_path)
+        cached = self._cache.get(dir_path)
+        if cached is None or (cached["mtime"], cached["size"]) != (file_stat.st_mtime_ns, file_stat.st_size):
+            with open(gudignore_path, "r", encoding="utf-8") as f:
+                file_regex, dir_regex = _compile_rules(f.read().split("\n"))
+            cached = {
+                "mtime": file_stat.st_mtime_ns,
+                "size": file_stat.st_size,
+                "file_regex": file_regex,
+                "dir_regex": dir_regex
+            }
+            self._cache[dir_path] = cached
+            self._cache_needs_write = True
+        node = self._root
+        for part in _split_path(dir_path):
+            node = node.children.setdefault(part, _IgnoreNode())
+        node.file_regex = re.compile(cached["file_regex"]) if cached["file_regex"] else None
+        node.dir_regex = re.compile(cached["dir_regex"]) if cached["dir_regex"] else None
+        self._loaded_dirs[dir_path] = True
+        self._ignored_dirs.clear()
+
+    def save_cache(self) -> None:
+        if self.cache_path is None:
+            return
+        # forget any .gudignore files that no longer exist
+        for dir_path, has_gudignore in self._loaded_dirs.items():
+            if not has_gudignore and dir_path in self._cache:
+                del self._cache[dir_path]
+                self._cache_needs_write = True
+        if not self._cache_needs_write:
+            return
+        temp_path = f"{self.cache_path}.lock"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": IGNORE_CACHE_VERSION, "files": self._cache}, f)
+        os.replace(temp_path, self.cache_path)
+        self._cache_needs_write = False
+
+    def is_ignored(self, rel_path: str, is_dir: bool) -> bool:
+        """ Whether the path, or any directory it is in, is ignored (loading any .gudignore files needed along the way) """
+        parts = _split_path(rel_path)
+        for depth in range(1, len(parts)):
+            dir_path = os.sep.join(parts[:depth])
+            if dir_path not in self._ignored_dirs:
+                self._ignored_dirs[dir_path] = self.matches(dir_path, is_dir=True)
+            if self._ignored_dirs[dir_path]:
+                return True
+        return self.matches(rel_path, is_dir)
+
+    def matches(self, rel_path: str, is_dir: bool) -> bool:
+        """
+        Whether the path itself is ignored, without checking the directories it is in
+        (for when they are already known not to be ignored, eg when walking down the tree).
+        The .gudignore files of the directories above the path must already be loaded, apart from its parent's
+        """
+        parts = _split_path(rel_path)
+        if not parts: # the root of the repo
+            return False
+        if parts[0] == ".gud": # never track the repo itself
+            return True
+        self.load_dir(os.sep.join(parts[:-1]))
+        # collect the nodes of every directory above the path, deepest last
+        node = self._root
+        nodes = [(node, 0)]
+        for depth, part in enumerate(parts[:-1], start=1):
+            node = node.children.get(part)
+            if node is None:
+                break
+            nodes.append((node, depth))
+        for node, depth in reversed(nodes):
+            regex = node.dir_regex if is_dir else node.file_regex
+            if regex is None:
+                continue
+            match = regex.fullmatch("/".join(parts[depth:]))
+            if match:
+                return match.lastgroup.startswith("i")
+        return False
+
+    def _read_cache(self) -> dict:
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+        if cache.get("version") != IGNORE_CACHE_VERSION:
+            return {}
+        return cache["files"]
+
+
+def _split_path(path: str) -> list:
+    return [part for part in path.split(os.sep) if part and part != "."]
+
+
+def _compile_rules(lines: list) -> tuple[str, str]:
+    """
+    Combine the rules of a .gudignore file into two regexes - one for files, and one for directories
+    (which also includes the directory-only rules). The rules are tried last to first, so the first rule to match wins,
+    and the name of the group that matched says whether it was an ignore (i) or a negated (n) rule
+    """
+    file_alternatives = []
+    dir_alternatives = []
+    for rule_num, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        pattern = line.rstrip("/")
+        if not pattern:
+            continue
+        anchored = "/" in pattern
+        regex = _translate_pattern(pattern.lstrip("/"))
+        if not anchored: # can match at any depth
+            regex = f"(?:.*/)?{regex}"
+        alternative = f"(?P<{'n' if negated else 'i'}{rule_num}>{regex})"
+        dir_alternatives.append(alternative)
+        if not dir_only:
+            file_alternatives.append(alternative)
+    return "|".join(reversed(file_alternatives)), "|".join(reversed(dir_alternatives))
+
+
+def _translate_pattern(pattern: str) -> str:
+    segments = pattern.split("/")
+    regex_parts = []
+    for i, segment in enumerate(segments):
+        is_last = i == len(segments) - 1
+        if segment == "**":
+            # matches everything inside the dir if it's at the end, otherwise zero or more dirs
+            regex_parts.append(".*" if is_last else "(?:.*/)?")
+        else:
+            regex_parts.append(_translate_segment(segment) + ("" if is_last else "/"))
+    return "".join(regex_parts)
+
+
+def _translate_segment(segment: str) -> str:
+    """ A single path component, where * ? and [...] never match a slash """
+    regex_parts = []
+    i = 0
+    while i < len(segment):
+        char = segment[i]
+        i += 1
+        if char == "*":
+            while i < len(segment) and segment[i] == "*":
+                i += 1
+            regex_parts.append("[^/]*")
+        elif char == "?":
+            regex_parts.append("[^/]")
+        elif char == "[":
+            # a "]" straight after the "[" (or "[!") is part of the set, rather than closing it
+            end = i + 1 if segment[i:i + 1] == "!" else i
+            if segment[end:end + 1] == "]":
+                end += 1
+            end = segment.find("]", end)
+            if end == -1: # not a set, just a "["
+                regex_parts.append(re.escape(char))
+                continue
+            contents = segment[i:end].replace("\\", "\\\\")
+            if contents.startswith("!"):
+                contents = "^/" + contents[1:]
+            regex_parts.append(f"[{contents}]")
+            i = end + 1
+        else:
+            regex_parts.append(re.escape(char))
+    return "".join(regex_parts)
@@ -0,0 +1,262 @@
+"""
+Reading and writing the index (.gud/index), which is stored in a binary format:
+
+    header      signature, version, number of entries
+    offsets     one uint32 per entry, pointing to where that entry starts
+    entries     sorted by path - type, mode, stat info, raw 20 byte hash, path length, path
+    extensions  zero or more (signature, size, data) sections - unknown ones are skipped
+    checksum    sha1 of everything above
+
+Because the entries are sorted and their offsets are stored in a fixed-width table,
+a single path can be looked up with a binary search over the mmap'd file, without parsing the whole index.
+"""
+import os
+import mmap
+import struct
+from hashlib import sha1
+from .globals import INDEX_STAT_FIELDS
+
+
+INDEX_SIGNATURE = b"GUDI"
+INDEX_VERSION = 1
+
+_HEADER = struct.Struct(">4sII") # signature, version, number of entries
+_OFFSET = struct.Struct(">I")
+_ENTRY = struct.Struct(">BIqqQQQ20sH") # type, mode, mtime, ctime, size, ino, dev, hash, path length
+_EXTENSION_HEADER = struct.Struct(">4sI") # signature, size of data
+_CHECKSUM_SIZE = 20
+
+_TYPE_CODES = {"blob": 1}
+_TYPE_NAMES = {code: name for name, code in _TYPE_CODES.items()}
+
+
+class IndexFile:
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = 0 # mtime (ns) of the index file when it was last read
+        self.is_legacy = False # True if the file read was in the old text format
+        self.extensions: dict[bytes, bytes] = {}
+
+    def read(self) -> dict:
+        """
+        Parse every entry in the index, returning {file_path: entry_dict}, sorted by path
+        """
+        with open(self.path, "rb") as f:
+            file_stat = os.fstat(f.fileno())
+            self.mtime = file_stat.st_mtime_ns
+            if file_stat.st_size == 0: # an (older) empty index
+                self.is_legacy = True
+                return {}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(INDEX_SIGNATURE)] != INDEX_SIGNATURE:
+                    self.is_legacy = True
+                    return __class__._parse_text_index(mm[:].decode("utf-8"))
+                return self._parse_binary_index(mm)
+
+    def lookup(self, file_path: str) -> dict|None:
+        """
+        Find a single entry using a binary search, without parsing the rest of the index
+        """
+        target = file_path.encode()
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm[:len(INDEX_SIGNATURE)] != INDEX_SIGNATURE:
+                    return __class__._parse_text_index(mm[:].decode("utf-8")).get(file_path)
+                num_entries = __class__._read_header(mm)
+                low, high = 0, num_entries
+                while low < high:
+                    mid = (low + high) // 2
+                    offset, = _OFFSET.unpack_from(mm, _HEADER.size + mid * _OFFSET.size)
+                    path, entry, _ = __class__._unpack_entry(mm, offset)
+                    if path < target:
+                        low = mid + 1
+                    elif path > target:
+                        high = mid
+                    else:
+                        return entry
+        return None
+
+    def write(self, entries: dict, extensions: dict[bytes, bytes]|None = None) -> None:
+        """
+        Write all entries (and any extensions) to a temporary file, then move it into place,
+        so a crash can never leave a half-written index behind
+        """
+        if extensions is None:
+            extensions = {}
+        sorted_paths = sorted(entries, key=lambda path: path.encode())
+        offsets = []
+        packed_entries = []
+        curr_offset = _HEADER.size + _OFFSET.size * len(sorted_paths)
+        for file_path in sorted_paths:
+            entry = entries[file_path]
+            path_bytes = file_path.encode()
+            packed_entry = _ENTRY.pack(
+                _TYPE_CODES[entry["type"]],
+                int(entry["mode"], 8),
+                *(entry.get(field, 0) for field in INDEX_STAT_FIELDS),
+                bytes.fromhex(entry["hash"]),
+                len(path_bytes)
+            ) + path_bytes
+            offsets.append(_OFFSET.pack(curr_offset))
+            packed_entries.append(packed_entry)
+            curr_offset += len(packed_entry)
+        packed_extensions = [
+            _EXTENSION_HEADER.pack(signature, len(data)) + data
+            for signature, data in extensions.items()
+        ]
+        content = b"".join([
+            _HEADER.pack(INDEX_SIGNATURE, INDEX_VERSION, len(sorted_paths)),
+            *offsets,
+            *packed_entries,
+            *packed_extensions
+        ])
+        temp_path = f"{self.path}.lock"
+        with open(temp_path, "wb") as f:
+            f.write(content)
+            f.write(sha1(content).digest())
+        os.replace(temp_path, self.path)
+
+    def _parse_binary_index(self, mm: mmap.mmap) -> dict:
+        checksum_start = len(mm) - _CHECKSUM_SIZE
+        if sha1(mm[:checksum_start]).digest() != mm[checksum_start:]:
+            raise Exception(f"Index file {self.path} is corrupted (checksum does not match).")
+        num_entries = __class__._read_header(mm)
+        indexed_files = {}
+        offset = _HEADER.size + _OFFSET.size * num_entries
+        for _ in range(num_entries):
+            path, entry, offset = __class__._unpack_entry(mm, offset)
+            indexed_files[path.decode()] = entry
+        # whatever is left before the checksum is extensions
+        self.extensions = {}
+        while offset < checksum_start:
+            signature, size = _EXTENSION_HEADER.unpack_from(mm, offset)
+            offset += _EXTENSION_HEADER.size
+            self.extensions[signature] = mm[offset:offset + size]
+            offset += size
+        return indexed_files
+
+    @staticmethod
+    def _read_header(mm: mmap.mmap) -> int:
+        signature, version, num_entries = _HEADER.unpack_from(mm, 0)
+        if version > INDEX_VERSION:
+            raise Exception(f"Index version {version} is not supported by this version of Gud.")
+        return num_entries
+
+    @staticmethod
+    def _unpack_entry(mm: mmap.mmap, offset: int) -> tuple[bytes, dict, int]:
+        """ Returns the path (as bytes), the entry, and the offset of the next entry """
+        type_code, mode, *stat_values, raw_hash, path_length = _ENTRY.unpack_from(mm, offset)
+        path_start = offset + _ENTRY.size
+        path = mm[path_start:path_start + path_length]
+        entry = {
+            "type": _TYPE_NAMES[type_code],
+            "mode": oct(mode).replace("0o", ""),
+            "hash": raw_hash.hex(),
+            **dict(zip(INDEX_STAT_FIELDS, stat_values))
+        }
+        return path, entry, path_start + path_length
+
+    @staticmethod
+    def _parse_text_index(content: str) -> dict:
+        """
+        The old tab-separated index format - only kept so existing indexes can be converted
+        """
+        indexed_files = {}
+        for line in content.split("\n"):
+            if not line:
+                continue
+            parts = line.split("\t")
+            if len(parts) == 4: # no stat info
+                file_mode, file_type, file_hash, file_path = parts
+                stat_values = [0] * len(INDEX_STAT_FIELDS)
+            else:
+                file_mode, file_type, file_hash, *stat_values, file_path = parts
+            indexed_files[file_path] = {
+                "type": file_type,
+                "mode": file_mode,
+                "hash": file_hash,
+                **dict(zip(INDEX_STAT_FIELDS, (int(value) for value in stat_values)))
+            }
+        return indexed_files
+
+
+CACHE_TREE_SIGNATURE = b"TREE"
+_CACHE_TREE_ENTRY = struct.Struct(">I20s") # number of index entries under the dir, raw 20 byte tree hash
+
+
+class CacheTree:
+    """
+    The tree hash of every directory whose index entries haven't changed since its tree object was written,
+    stored in the index as an extension.
+    Changing an entry invalidates each directory above it, so a commit only has to write
+    the tree objects of directories that actually changed (and status can skip unchanged directories)
+
+    Each record is the dir path (empty for the root), a NUL byte, then the number of entries and the tree hash
+    """
+    def __init__(self, trees: dict|None = None):
+        self.trees: dict[str, tuple[str, int]] = trees if trees is not None else {} # dir path -> (tree hash, number of entries)
+
+    @classmethod
+    def from_bytes(cls, data: bytes|None) -> "CacheTree":
+        trees = {}
+        offset = 0
+        while data and offset < len(data):
+            path_end = data.index(b"\0", offset)
+            dir_path = data[offset:path_end].decode()
+            num_entries, raw_hash = _CACHE_TREE_ENTRY.unpack_from(data, path_end + 1)
+            trees[dir_path] = (raw_hash.hex(), num_entries)
+            offset = path_end + 1 + _CACHE_TREE_ENTRY.size
+        return cls(trees)
+
+    def to_bytes(self) -> bytes:
+        return b"".join(
+            dir_path.encode() + b"\0" + _CACHE_TREE_ENTRY.pack(num_entries, bytes.fromhex(tree_hash))
+            for dir_path, (tree_hash, num_entries) in sorted(self.trees.items())
+        )
+
+    def get(self, dir_path: str, num_entries: int) -> str|None:
+        """ The cached tree hash, if it is still valid for a dir with this many index entries under it """
+        cached = self.trees.get(dir_path)
+        if cached is None or cached[1] != num_entries:
+            return None
+        return cached[0]
+
+    def set(self, dir_path: str, tree_hash: str, num_entries: int) -> None:
+        self.trees[dir_path] = (tree_hash, num_entries)
+
+    def invalidate(self, file_path: str) -> None:
+        """ Every directory containing file_path (up to and including the root) no longer matches its tree """
+        dir_path = file_path
+        while dir_path:
+            dir_path = os.path.dirname(dir_path)
+            self.trees.pop(dir_path, None)
+
+
+FSMONITOR_SIGNATURE = b"FSMN"
+
+
+class FsMonitorState:
+    """
+    The filesystem monitor's token from when the working dir was last compared to the index (see fsmonitor.py),
+    and every path that didn't match the index at that point (modified, deleted or untracked), stored in the index as an extension.
+    Any other path that the monitor says hasn't changed since the token must still match the index,
+    so only dirty_paths and the changed paths need checking.
+    Changing an entry adds its path to dirty_paths, as the file may no longer match it
+
+    Stored as the token, then each dirty path, all separated by NUL bytes
+    """
+    def __init__(self, token: str = "", dirty_paths: set|None = None):
+        self.token = token
+        self.dirty_paths: set[str] = dirty_paths if dirty_paths is not None else set()
+
+    @classmethod
+    def from_bytes(cls, data: bytes|None) -> "FsMonitorState":
+        if not data:
+            return cls()
+        token, *dirty_paths = bytes(data).decode().split("\0")
+        return cls(token, set(dirty_paths))
+
+    def to_bytes(self) -> bytes:
+        return "\0".join([self.token, *sorted(self.dirty_paths)]).encode()
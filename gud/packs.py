@@ -0,0 +1,343 @@
+"""
+Pack files - many objects stored together in a single file (created by `gud gc`),
+rather than as one "loose" file per object.
+
+Each pack (.gud/objects/pack/pack-<checksum>.pack) is laid out as:
+
+    header      signature, version, number of objects
+    entries     for each object - type, uncompressed size, compressed size, then the zlib-compressed content
+    checksum    sha1 of everything above
+
+An entry can also be a delta (see delta.py), in which case the entry's header is followed by
+the hash of its base object (which is always in the same pack), then the zlib-compressed delta.
+
+And has a matching index (pack-<checksum>.idx), so any object can be found without reading the pack:
+
+    header      signature, version, number of objects
+    fanout      256 cumulative counts - fanout[b] is the number of hashes whose first byte is <= b
+    hashes      every object's raw 20 byte hash, sorted
+    offsets     where each object's entry starts in the pack (in the same order as the hashes)
+    checksum    the pack's checksum
+
+The fanout table narrows the search down to hashes starting with the same byte,
+then a binary search over the (mmap'd) sorted hashes finds the object.
+"""
+import os
+import mmap
+import struct
+import zlib
+from hashlib import sha1
+from .delta import apply_delta
+from .helpers import LRUCache, LazyModule, get_new_file_permissions
+from .globals import COMPRESSION_LEVEL, PACK_DELTA_BASE_CACHE_SIZE
+
+tempfile = LazyModule("tempfile") # only needed when writing packs
+
+
+PACK_SIGNATURE = b"GPAK"
+PACK_VERSION = 2 # version 2 added delta entries
+PACK_INDEX_SIGNATURE = b"GPIX"
+PACK_INDEX_VERSION = 1
+
+_HEADER = struct.Struct(">4sII") # signature, version, number of objects
+_ENTRY_HEADER = struct.Struct(">BQQ") # type, uncompressed size (of the full object), compressed size
+_FANOUT = struct.Struct(">256I")
+_OFFSET = struct.Struct(">Q")
+_HASH_SIZE = 20
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+_TYPE_CODES = {"blob": 1, "tree": 2, "commit": 3}
+_TYPE_NAMES = {code: name for name, code in _TYPE_CODES.items()}
+_DELTA_TYPE_CODE = 4
+
+
+class PackIndex:
+    def __init__(self, idx_path: str):
+        self.path = idx_path
+        with open(idx_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, self.num_objects = _HEADER.unpack_from(self._mm, 0)
+        if signature != PACK_INDEX_SIGNATURE or version > PACK_INDEX_VERSION:
+            raise Exception(f"Pack index {idx_path} is corrupted, or not supported by this version of Gud.")
+        self.fanout = _FANOUT.unpack_from(self._mm, _HEADER.size)
+        self._hashes_start = _HEADER.size + _FANOUT.size
+        self._offsets_start = self._hashes_start + _HASH_SIZE * self.num_objects
+
+    def find_offset(self, hash: str) -> int|None:
+        """ The offset of the object's entry in the pack, or None if it isn't in this pack """
+        raw_hash = bytes.fromhex(hash)
+        first_byte = raw_hash[0]
+        low = self.fanout[first_byte - 1] if first_byte > 0 else 0
+        high = self.fanout[first_byte]
+        while low < high:
+            mid = (low + high) // 2
+            hash_start = self._hashes_start + mid * _HASH_SIZE
+            mid_hash = self._mm[hash_start:hash_start + _HASH_SIZE]
+            if mid_hash < raw_hash:
+                low = mid + 1
+            elif mid_hash > raw_hash:
+                high = mid
+            else:
+                offset, = _OFFSET.unpack_from(self._mm, self._offsets_start + mid * _OFFSET.size)
+                return offset
+        return None
+
+    def get_all_hashes(self) -> list[str]:
+        hashes_end = self._hashes_start + _HASH_SIZE * self.num_objects
+        raw_hashes = self._mm[self._hashes_start:hashes_end]
+        return [raw_hashes[i:i + _HASH_SIZE].hex() for i in range(0, len(raw_hashes), _HASH_SIZE)]
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+class Pack:
+    def __init__(self, pack_path: str, delta_base_cache: LRUCache|None = None):
+        self.path = pack_path
+        self.name = os.path.splitext(os.path.basename(pack_path))[0]
+        self.index = PackIndex(os.path.splitext(pack_path)[0] + ".idx")
+        # recently rebuilt delta bases, so objects sharing a base (or chain of bases) don't each rebuild it
+        self.delta_base_cache = delta_base_cache or LRUCache(PACK_DELTA_BASE_CACHE_SIZE)
+        with open(pack_path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, num_objects = _HEADER.unpack_from(self._mm, 0)
+        if signature != PACK_SIGNATURE or version > PACK_VERSION:
+            raise Exception(f"Pack {pack_path} is corrupted, or not supported by this version of Gud.")
+
+    def is_delta(self, offset: int) -> bool:
+        return self._mm[offset] == _DELTA_TYPE_CODE
+
+    def get_object_header(self, offset: int) -> tuple[str, int]:
+        """ The object's type and (uncompressed) size, without decompressing anything """
+        type_code, uncompressed_size, _ = _ENTRY_HEADER.unpack_from(self._mm, offset)
+        while type_code == _DELTA_TYPE_CODE: # a delta's type is the type of its base
+            offset = self._get_delta_base_offset(offset)
+            type_code = self._mm[offset]
+        return _TYPE_NAMES[type_code], uncompressed_size
+
+    def open_compressed(self, offset: int) -> tuple[str, int, "_PackEntryStream"]:
+        """
+        Returns the object's type, uncompressed size, and a stream of its compressed content.
+        Not possible for deltas, as they don't have any compressed content of their own - use read_object
+        """
+        type_code, uncompressed_size, compressed_size = _ENTRY_HEADER.unpack_from(self._mm, offset)
+        if type_code == _DELTA_TYPE_CODE:
+            raise ValueError("Deltas cannot be read as compressed content.")
+        data_start = offset + _ENTRY_HEADER.size
+        stream = _PackEntryStream(self._mm, data_start, data_start + compressed_size)
+        return _TYPE_NAMES[type_code], uncompressed_size, stream
+
+    def read_object(self, offset: int) -> tuple[str, bytes]:
+        """ Returns the object's type and (uncompressed) content, rebuilding it from its delta base if needed """
+        type_code, uncompressed_size, compressed_size = _ENTRY_HEADER.unpack_from(self._mm, offset)
+        data_start = offset + _ENTRY_HEADER.size
+        if type_code != _DELTA_TYPE_CODE:
+            content = zlib.decompress(self._mm[data_start:data_start + compressed_size])
+            return _TYPE_NAMES[type_code], content
+        base_offset = self._get_delta_base_offset(offset)
+        cached_base = self.delta_base_cache.get((self.name, base_offset))
+        if cached_base is None:
+            cached_base = self.read_object(base_offset)
+            self.delta_base_cache.put((self.name, base_offset), cached_base, len(cached_base[1]))
+        base_type, base_content = cached_base
+        data_start += _HASH_SIZE
+        delta = zlib.decompress(self._mm[data_start:data_start + compressed_size])
+        content = apply_delta(base_content, delta)
+        if len(content) != uncompressed_size:
+            raise Exception(f"Object at offset {offset} in {self.path} is corrupted.")
+        return base_type, content
+
+    def _get_delta_base_offset(self, offset: int) -> int:
+        hash_start = offset + _ENTRY_HEADER.size
+        base_hash = self._mm[hash_start:hash_start + _HASH_SIZE].hex()
+        base_offset = self.index.find_offset(base_hash)
+        if base_offset is None:
+            raise Exception(f"Delta base {base_hash} is missing from {self.path}.")
+        return base_offset
+
+    def close(self) -> None:
+        self._mm.close()
+        self.index.close()
+
+
+class _PackEntryStream:
+    """ File-like access to one entry's compressed bytes, without copying the whole entry out of the mmap """
+    def __init__(self, mm: mmap.mmap, start: int, end: int):
+        self._mm = mm
+        self._pos = start
+        self._end = end
+
+    def read(self, size=-1) -> bytes:
+        if size < 0:
+            size = self._end - self._pos
+        chunk_end = min(self._pos + size, self._end)
+        chunk = self._mm[self._pos:chunk_end]
+        self._pos = chunk_end
+        return chunk
+
+    def close(self) -> None:
+        pass # the mmap belongs to the pack
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _BytesStream:
+    def __init__(self, content: bytes):
+        self._content = content
+        self._pos = 0
+
+    def read(self, size=-1) -> bytes:
+        if size < 0:
+            size = len(self._content) - self._pos
+        chunk = self._content[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+
+
+class PackStore:
+    """
+    All the packs in a repository. Packs are opened (and mmap'd) the first time they're needed,
+    and stay open, so looking up lots of objects doesn't keep re-opening files
+    """
+    def __init__(self, objects_dir: str):
+        self.pack_dir = os.path.join(objects_dir, "pack")
+        self._packs: list[Pack]|None = None
+        self._pack_dir_mtime = None # when the packs were listed
+        self.delta_base_cache = LRUCache(PACK_DELTA_BASE_CACHE_SIZE)
+
+    @property
+    def packs(self) -> list[Pack]:
+        if self._packs is None:
+            self._pack_dir_mtime = self._get_pack_dir_mtime()
+            packs = []
+            if os.path.isdir(self.pack_dir):
+                for file_name in sorted(os.listdir(self.pack_dir)):
+                    if file_name.endswith(".pack"):
+                        pack_path = os.path.join(self.pack_dir, file_name)
+                        packs.append(Pack(pack_path, self.delta_base_cache))
+            self._packs = packs # only set once complete, as other threads may be reading it
+        return self._packs
+
+    def find(self, hash: str) -> tuple[Pack, int]|None:
+        """ The pack containing the object, and the object's offset within it """
+        for pack in self.packs:
+            offset = pack.index.find_offset(hash)
+            if offset is not None:
+                return pack, offset
+        return None
+
+    def close(self) -> None:
+        """ Close every pack (they'll be re-opened if needed) - required before deleting any pack """
+        for pack in self._packs or []:
+            pack.close()
+        self._packs = None
+        self.delta_base_cache = LRUCache(PACK_DELTA_BASE_CACHE_SIZE)
+
+    def refresh(self) -> None:
+        """ Close every pack if any have been added or deleted (eg by another process) since they were listed """
+        if self._packs is not None and self._get_pack_dir_mtime() != self._pack_dir_mtime:
+            self.close()
+
+    def _get_pack_dir_mtime(self) -> int|None:
+        try:
+            return os.stat(self.pack_dir).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def delete_packs(self, pack_names: list[str]) -> None:
+        self.close()
+        for pack_name in pack_names:
+            for extension in (".pack", ".idx"):
+                os.remove(os.path.join(self.pack_dir, pack_name + extension))
+
+
+class PackWriter:
+    """
+    Builds a new pack (and its index) one object at a time.
+    The pack is written to a temporary file, and only moved into place (along with its index)
+    once it is complete, so readers never see a partial pack
+    """
+    def __init__(self, pack_dir: str):
+        self.pack_dir = pack_dir
+        os.makedirs(pack_dir, exist_ok=True)
+        temp_fd, self._temp_path = tempfile.mkstemp(dir=pack_dir, prefix="tmp_pack_")
+        self._file = os.fdopen(temp_fd, "w+b")
+        self._offsets: dict[bytes, int] = {} # raw hash -> offset
+        self._file.write(_HEADER.pack(PACK_SIGNATURE, PACK_VERSION, 0)) # number of objects filled in at the end
+
+    def add_object(self, hash: str, object_type: str, uncompressed_size: int, compressed_stream) -> None:
+        """ compressed_stream is a readable stream of the object's zlib-compressed content """
+        raw_hash = bytes.fromhex(hash)
+        if raw_hash in self._offsets:
+            return
+        offset = self._file.tell()
+        self._file.write(_ENTRY_HEADER.pack(_TYPE_CODES[object_type], uncompressed_size, 0))
+        compressed_size = 0
+        while chunk := compressed_stream.read(_COPY_CHUNK_SIZE):
+            self._file.write(chunk)
+            compressed_size += len(chunk)
+        # now the compressed size is known, go back and fill it in
+        end = self._file.tell()
+        self._file.seek(offset)
+        self._file.write(_ENTRY_HEADER.pack(_TYPE_CODES[object_type], uncompressed_size, compressed_size))
+        self._file.seek(end)
+        self._offsets[raw_hash] = offset
+
+    def add_object_content(self, hash: str, object_type: str, content: bytes) -> None:
+        """ For objects that aren't already compressed """
+        compressed_content = zlib.compress(content, level=COMPRESSION_LEVEL)
+        self.add_object(hash, object_type, len(content), _BytesStream(compressed_content))
+
+    def add_delta(self, hash: str, uncompressed_size: int, base_hash: str, delta: bytes) -> None:
+        """ base_hash must be (or will be) added to this same pack """
+        raw_hash = bytes.fromhex(hash)
+        if raw_hash in self._offsets:
+            return
+        compressed_delta = zlib.compress(delta, level=COMPRESSION_LEVEL)
+        self._offsets[raw_hash] = self._file.tell()
+        self._file.write(_ENTRY_HEADER.pack(_DELTA_TYPE_CODE, uncompressed_size, len(compressed_delta)))
+        self._file.write(bytes.fromhex(base_hash))
+        self._file.write(compressed_delta)
+
+    def finish(self) -> str:
+        """ Write the checksum and index, and move the pack into place. Returns the pack's name """
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(PACK_SIGNATURE, PACK_VERSION, len(self._offsets)))
+        self._file.seek(0)
+        hasher = sha1()
+        while chunk := self._file.read(_COPY_CHUNK_SIZE):
+            hasher.update(chunk)
+        checksum = hasher.digest()
+        self._file.write(checksum)
+        self._file.close()
+
+        pack_name = f"pack-{checksum.hex()}"
+        sorted_hashes = sorted(self._offsets)
+        fanout = [0] * 256
+        for raw_hash in sorted_hashes:
+            fanout[raw_hash[0]] += 1
+        for i in range(1, 256): # make the counts cumulative
+            fanout[i] += fanout[i - 1]
+        idx_content = b"".join([
+            _HEADER.pack(PACK_INDEX_SIGNATURE, PACK_INDEX_VERSION, len(sorted_hashes)),
+            _FANOUT.pack(*fanout),
+            *sorted_hashes,
+            *(_OFFSET.pack(self._offsets[raw_hash]) for raw_hash in sorted_hashes),
+            checksum
+        ])
+        temp_idx_path = f"{self._temp_path}.idx"
+        with open(temp_idx_path, "wb") as f:
+            f.write(idx_content)
+        # the index is moved into place first, as a pack is only looked for via its .pack file
+        os.replace(temp_idx_path, os.path.join(self.pack_dir, f"{pack_name}.idx"))
+        os.chmod(self._temp_path, get_new_file_permissions()) # the same as the .idx, rather than mkstemp's
+        os.replace(self._temp_path, os.path.join(self.pack_dir, f"{pack_name}.pack"))
+        return pack_name
+
+    def abort(self) -> None:
+        self._file.close()
+        os.remove(self._temp_path)
@@ -0,0 +1,73 @@
+"""
+Running lots of small, independent jobs (eg hashing files) on a pool of threads.
+zlib, hashlib and file I/O all release the GIL while they work, so threads make use of every core.
+"""
+from .globals import PARALLEL_BATCH_SIZE, PARALLEL_BATCH_MAX_FILES
+from .helpers import LazyModule
+from .trace import span
+
+
+futures = LazyModule("concurrent.futures") # (which imports logging, threading etc) only needed once there's work to do
+
+
+class BatchedThreadPool:
+    """
+    Calls func(item) for every item passed to submit(), on num_threads threads.
+    Items are grouped into batches (of about batch_size bytes, or max_batch_items items), so small files
+    don't each pay the cost of being scheduled, and only a couple of batches per thread are queued at once,
+    so whatever is submitting items (eg a directory walk) can't get too far ahead of the workers.
+    Results are collected as each batch finishes - finish() waits for the rest, then returns them all.
+    With a single thread, everything just runs on the calling thread.
+    The threads are only started once the first batch is submitted, so nothing is started if there's nothing to do.
+    """
+    def __init__(self, func, num_threads: int, batch_size: int = PARALLEL_BATCH_SIZE, max_batch_items: int = PARALLEL_BATCH_MAX_FILES):
+        self.func = func
+        self.batch_size = batch_size
+        self.max_batch_items = max_batch_items
+        self.num_threads = num_threads
+        self._executor = None
+        self._max_batches_in_flight = num_threads * 2
+        self._batches_in_flight = set()
+        self._batch = []
+        self._batch_bytes = 0
+        self.results = [] # (item, result), in the order they finished
+
+    def submit(self, item, size: int = 0) -> None:
+        if self.num_threads <= 1:
+            self.results.append((item, self.func(item)))
+            return
+        self._batch.append(item)
+        self._batch_bytes += size
+        if len(self._batch) >= self.max_batch_items or self._batch_bytes >= self.batch_size:
+            self._submit_batch()
+
+    def finish(self) -> list:
+        """ Wait for every item to be processed, and return the (item, result) pairs """
+        try:
+            self._submit_batch()
+            if self._batches_in_flight:
+                self._collect(futures.wait(self._batches_in_flight).done)
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+        return self.results
+
+    def _submit_batch(self) -> None:
+        if not self._batch:
+            return
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(max_workers=self.num_threads)
+        while len(self._batches_in_flight) >= self._max_batches_in_flight:
+            self._collect(futures.wait(self._batches_in_flight, return_when=futures.FIRST_COMPLETED).done)
+        self._batches_in_flight.add(self._executor.submit(self._run_batch, self._batch))
+        self._batch = []
+        self._batch_bytes = 0
+
+    def _run_batch(self, batch: list) -> list:
+        with span(self.func.__qualname__, items=len(batch)):
+            return [(item, self.func(item)) for item in batch]
+
+    def _collect(self, finished_batches) -> None:
+        for future in finished_batches:
+            self._batches_in_flight.discard(future)
+            self.results.extend(future.result()) # re-raises anything raised by func
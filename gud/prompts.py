@@ -0,0 +1,33 @@
+"""
+Validators for the interactive prompts. questionary (and prompt_toolkit, which it is built on) is slow to import,
+so this is only imported once a prompt is actually shown (see LazyModule)
+"""
+import os
+from questionary import Validator, ValidationError
+from .classes import is_indexed_file_path_that_may_not_exist
+
+
+class PathValidatorQuestionary(Validator):
+    def __init__(self, repo):
+        # for including files that are in the index (or HEAD commit), but have been deleted
+        self.repo = repo
+
+    def validate(self, document):
+        """
+        The path must either be blank, in which case the user can 'complete' their selection
+        or it must exist as a file path 
+        """
+        path = os.path.expanduser(document.text.strip()) # expanduser converts ~ to /home/<username>
+        if (path == "/") or (path != "" and not os.path.exists(path) and not is_indexed_file_path_that_may_not_exist(self.repo, path)):
+            raise ValidationError(
+                message="Path is not valid"
+            )
+        
+
+class TextValidatorQuestionaryNotEmpty(Validator):
+    def validate(self, document):
+        text = document.text.strip()
+        if not text:
+            raise ValidationError(
+                message="You cannot leave this blank"
+            )
@@ -1,26 +1,18 @@
 import argparse
 import sys
 import os
-from .classes import CommandInvocation
-from .commands import (
-    hello,
-    load_example,
-    init,
-    config,
-    ignoring,
-    stage,
-    commit,
-    status,
-    log,
-    branch,
-    checkout,
-    restore
-)
+from .daemon import run_in_daemon
+from . import trace
+
+
+PROFILE_NUM_FUNCTIONS = 40 # how many functions --profile prints
 
 
 parser = argparse.ArgumentParser(
     description="Functionality for parsing Gud commands.",
 )
+parser.add_argument("--profile", action="store_true", help="Print the functions the command spent the most time in (using cProfile)")
+parser.add_argument("--profile-output", metavar="PATH", help="Save the command's cProfile stats to PATH (eg to load with pstats)")
 subparsers = parser.add_subparsers(title="commands", dest="command")
 subparsers.required = True
 
@@ -44,11 +36,15 @@ add_or_remove = stage_subparser.add_argument('add_or_remove', nargs="?", choices
 file_paths = stage_subparser.add_argument("file_paths", nargs="*", help="A specified file or directory to add/remove to/from the staging area")
 
 commit_subparser = subparsers.add_parser('commit', help="Commit staged files to the repository's history")
+commit_subparser.add_argument("-m", "--message", help="Use this as the commit message, rather than being asked for one")
 
 status_subparser = subparsers.add_parser('status', help="View all staged and unstaged files")
 
 log_subparser = subparsers.add_parser('log', help="View the commit history")
 log_subparser.add_argument("short", nargs="?", choices=["short"], help="Show less information about each commit")
+log_subparser.add_argument("-n", "--max-count", type=int, help="Only show this many commits")
+log_subparser.add_argument("--skip", type=int, default=0, help="Skip this many commits before starting to show them")
+log_subparser.add_argument("--no-pager", action="store_true", help="Print the commits, rather than opening them in a pager")
 
 branch_subparser = subparsers.add_parser('branch', help="View existing branches, rename a branch, create a new branch or delete a branch")
 view_or_rename_or_create_or_delete = branch_subparser.add_argument(
@@ -63,12 +59,84 @@ branch_or_hash.add_argument("--hash", help="Choose a commit hash to checkout to"
 restore_subparser = subparsers.add_parser("restore", help="Restore a file back to its state at the HEAD commit")
 file_path = restore_subparser.add_argument("file_path", nargs=1, help="A specified file to restore")
 
+migrate_subparser = subparsers.add_parser("migrate", help="Upgrade the repository to the latest object format")
+
+gc_subparser = subparsers.add_parser("gc", aliases=["repack"], help="Pack all objects into a single pack file, and delete unreachable objects")
+
+fsmonitor_subparser = subparsers.add_parser("fsmonitor", help="Start or stop a background process that watches for file changes, to speed up status (Linux only)")
+fsmonitor_subparser.add_argument("start_or_stop_or_status", nargs="?", choices=["start", "stop", "status"], help="Start, stop or check on the filesystem monitor")
+
+daemon_subparser = subparsers.add_parser("daemon", help="Start or stop a background process that runs commands, so they start up faster")
+daemon_subparser.add_argument("start_or_stop_or_status", nargs="?", choices=["start", "stop", "status"], help="Start, stop or check on the daemon")
+
 
 def main():
     
     all_args = parser.parse_args(sys.argv[1:])
     cwd = os.getcwd()
 
+    exit_code = run_in_daemon(all_args, sys.argv[1:], cwd)
+    if exit_code is not None:
+        sys.exit(exit_code)
+    run_command(all_args, cwd)
+
+
+def run_command(all_args: argparse.Namespace, cwd: str, repo=None) -> None:
+    """
+    Run the command in this process - repo is given if it's already open (see daemon.py).
+    The command is traced if GUD_TRACE is set (see trace.py), and profiled if --profile or --profile-output was given
+    """
+    command_name = f"gud {all_args.command}"
+    trace_path = os.environ.get("GUD_TRACE")
+    if trace_path:
+        trace.start_tracing()
+    profiler = None
+    if all_args.profile or all_args.profile_output:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with trace.span(command_name):
+            _run_command(all_args, cwd, repo)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            save_profile(profiler, all_args.profile, all_args.profile_output and os.path.join(cwd, all_args.profile_output))
+        if trace_path:
+            trace.stop_tracing(os.path.join(cwd, trace_path), command_name)
+
+
+def save_profile(profiler, print_stats: bool, output_path: str|None) -> None:
+    import pstats
+    stats = pstats.Stats(profiler, stream=sys.stderr)
+    if output_path:
+        stats.dump_stats(output_path)
+    if print_stats:
+        stats.sort_stats("cumulative").print_stats(PROFILE_NUM_FUNCTIONS)
+
+
+def _run_command(all_args: argparse.Namespace, cwd: str, repo) -> None:
+    # only imported once it's known the daemon isn't running the command, as they are slow to import
+    from .classes import CommandInvocation
+    from .commands import (
+        hello,
+        load_example,
+        init,
+        config,
+        ignoring,
+        stage,
+        commit,
+        status,
+        log,
+        branch,
+        checkout,
+        restore,
+        migrate,
+        gc,
+        fsmonitor,
+        daemon
+    )
+
     if all_args.command == "hello":
         hello()
         return
@@ -76,7 +144,7 @@ def main():
         load_example(cwd)
         return
 
-    invocation = CommandInvocation(all_args, cwd)
+    invocation = CommandInvocation(all_args, cwd, repo)
 
     match invocation.command:
         case "init":
@@ -99,6 +167,14 @@ def main():
             checkout(invocation)
         case "restore":
             restore(invocation)
+        case "migrate":
+            migrate(invocation)
+        case "gc" | "repack":
+            gc(invocation)
+        case "fsmonitor":
+            fsmonitor(invocation)
+        case "daemon":
+            daemon(invocation)
 
     # some commands break if the user isn't in the root directory - so this is a warning to them
     if invocation.command != "init":
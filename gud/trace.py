@@ -0,0 +1,102 @@
+"""
+Optional tracing of where the time goes in a command. Set GUD_TRACE to a file path, eg
+
+    GUD_TRACE=trace.json gud status
+
+and every span (a named phase of the command, eg comparing the working directory to the index) is written to it in
+Chrome's trace-event format, which can be opened in chrome://tracing or https://ui.perfetto.dev.
+Spans nest, and are recorded separately for each thread (eg the threads that hash files).
+The file is overwritten by each command.
+
+When GUD_TRACE isn't set, span() returns a shared object that does nothing, and @traced functions are called
+straight away (after a single check), so tracing costs next to nothing.
+"""
+import functools
+import json
+import os
+import time
+from .helpers import LazyModule
+
+
+threading = LazyModule("threading") # only needed while tracing
+
+_events: list|None = None # every finished span, while tracing
+
+
+class _Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+
+    def __enter__(self) -> "_Span":
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        end = time.perf_counter_ns()
+        if _events is not None: # (unless tracing stopped in the meantime)
+            _events.append({
+                "name": self.name,
+                "ph": "X", # a "complete" event, with a start time and duration (in microseconds)
+                "ts": self.start / 1000,
+                "dur": (end - self.start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": self.args
+            })
+
+
+class _NullSpan:
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def is_tracing() -> bool:
+    return _events is not None
+
+
+def span(name: str, **args):
+    """ A context manager that records how long its block takes - args are shown alongside it in the trace """
+    if _events is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name: str|None = None):
+    """ Decorator that records a span (named after the function, unless name is given) every time the function is called """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _events is None:
+                return func(*args, **kwargs)
+            with _Span(span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_tracing() -> None:
+    global _events
+    _events = []
+
+
+def stop_tracing(trace_path: str, process_name: str) -> None:
+    """ Write every span recorded since start_tracing() to trace_path, as Chrome trace-event JSON """
+    global _events
+    events, _events = _events or [], None
+    metadata = [
+        {"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": process_name}},
+        {"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": threading.get_ident(), "args": {"name": "main"}}
+    ]
+    with open(trace_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
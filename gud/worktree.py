@@ -0,0 +1,412 @@
+"""
+Walking the working directory, comparing it to the index (the "unstaged" half of `gud status`),
+and staging files from it.
+
+Every command that looks at the working directory (status, stage and ignoring) walks it with WorkingDirWalker,
+which loads each .gudignore file as it reaches it, and drops ignored files and directories from each listing,
+so ignored directories (eg node_modules/ or .gud/) are never entered at all.
+If the filesystem monitor is running (see fsmonitor.py), only the paths it says may have changed are looked at instead.
+
+The working directory and the index are walked together, one directory at a time.
+Both sides are visited in the same sorted order - a directory sorts as if its name ended in a path separator,
+which is where its files' paths sort in the index - so each directory is a single merge of two sorted lists,
+and the whole comparison is one linear pass.
+"""
+import os
+from bisect import bisect_left
+from .classes import Repository, Tree, Blob
+from .ignore import IgnoreMatcher, GUDIGNORE_FILE_NAME
+from .fsmonitor import get_fsmonitor_changes
+from .index import FsMonitorState
+from .parallel import BatchedThreadPool
+from .trace import span
+from .helpers import (
+    get_file_mode,
+    get_stat_info,
+    stat_info_matches
+)
+
+
+def get_indexed_paths_in_dir(index: dict, dir_path: str) -> list:
+    """ Every path in the index (or an index-like dict) that is inside dir_path ("." for the whole repo) """
+    prefix = "" if dir_path in (os.curdir, "") else dir_path + os.sep
+    return [file_path for file_path in index if file_path.startswith(prefix)]
+
+
+def sort_paths_top_down(paths) -> list:
+    """ Sorted so that everything inside a directory comes straight after the directory itself """
+    return sorted(paths, key=lambda path: path.split(os.sep))
+
+
+def _iter_path_and_parents(path: str):
+    while path:
+        yield path
+        path = os.path.dirname(path)
+
+
+def get_path_type(abs_path: str) -> str|None:
+    """ "dir", "file" or None (if it doesn't exist) - symlinks to dirs count as not existing, as they are never followed """
+    if os.path.isdir(abs_path):
+        return None if os.path.islink(abs_path) else "dir"
+    return "file" if os.path.lexists(abs_path) else None
+
+
+class WorkingDirWalker:
+    def __init__(self, repo_root: str, ignore_matcher: IgnoreMatcher):
+        self.repo_root = repo_root
+        self.ignore_matcher = ignore_matcher
+
+    def list_dir(self, dir_path: str, ignored_paths: list|None = None) -> list:
+        """
+        The non-ignored files and dirs directly inside dir_path (relative to the repo root, "" for the root),
+        as (sort key, DirEntry), sorted the same way as the index (ie as if dir names ended with a path separator).
+        dir_path itself is assumed not to be ignored. Symlinks to directories are not followed.
+        If ignored_paths is given, the paths of any ignored entries are added to it (dirs with a trailing separator)
+        """
+        try:
+            with span("list dir", path=dir_path):
+                dir_entries = list(os.scandir(os.path.join(self.repo_root, dir_path)))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return []
+        children = []
+        with span("match ignore rules", path=dir_path):
+            # this dir's own .gudignore applies to its entries, so load it before checking them
+            self.ignore_matcher.load_dir(
+                dir_path,
+                has_gudignore=any(dir_entry.name == GUDIGNORE_FILE_NAME for dir_entry in dir_entries)
+            )
+            for dir_entry in dir_entries:
+                is_dir = dir_entry.is_dir()
+                if is_dir and dir_entry.is_symlink():
+                    continue
+                sort_key = dir_entry.name + os.sep if is_dir else dir_entry.name
+                if self.ignore_matcher.matches(os.path.join(dir_path, dir_entry.name), is_dir):
+                    if ignored_paths is not None:
+                        ignored_paths.append(os.path.join(dir_path, sort_key))
+                    continue
+                children.append((sort_key, dir_entry))
+        children.sort(key=lambda child: child[0])
+        return children
+
+    def walk(self, dir_path: str = "", ignored_paths: list|None = None):
+        """ Yields (dir_path, children) for dir_path and every non-ignored dir below it, top down """
+        children = self.list_dir(dir_path, ignored_paths)
+        yield dir_path, children
+        for _, dir_entry in children:
+            if dir_entry.is_dir():
+                yield from self.walk(os.path.join(dir_path, dir_entry.name), ignored_paths)
+
+    def contains_file(self, dir_path: str) -> bool:
+        """ True if there is at least one (non-ignored) file somewhere inside dir_path """
+        for _, dir_entry in self.list_dir(dir_path):
+            if not dir_entry.is_dir() or self.contains_file(os.path.join(dir_path, dir_entry.name)):
+                return True
+        return False
+
+
+class WorkingDirComparison:
+    def __init__(self, repo: Repository, tree: Tree, ignore_matcher: IgnoreMatcher):
+        self.repo = repo
+        self.tree = tree
+        self.index = tree.index
+        self.ignore_matcher = ignore_matcher
+        self.walker = WorkingDirWalker(repo.root, ignore_matcher)
+        # files whose stat info has changed are hashed on a pool of threads while the walk carries on
+        self._blob = Blob(repo)
+        self._hashing_pool = BatchedThreadPool(self._hash_file, repo.get_num_threads())
+        self.modified = set()
+        self.added = set() # untracked files, and the shallowest untracked dirs (with a trailing slash)
+        self.deleted = set()
+        # index entries whose stat info is out of date, but whose contents are unchanged
+        self.index_needs_refresh = False
+        self.fsmonitor_state: FsMonitorState|None = None # to store in the index, if the monitor is running
+
+    def run(self) -> "WorkingDirComparison":
+        sorted_paths = sorted(self.index)
+        fsmonitor_changes = get_fsmonitor_changes(self.repo)
+        if fsmonitor_changes is not None and fsmonitor_changes[1] is not None:
+            self._compare_paths(fsmonitor_changes[1], sorted_paths)
+        else:
+            self._compare_dir("", sorted_paths, 0, len(sorted_paths))
+        # applied in path order, so the result never depends on which thread finished first
+        for (file_path, file_stat, is_racy), new_hash in sorted(self._hashing_pool.finish(), key=lambda result: result[0][0]):
+            index_entry = self.index[file_path]
+            if index_entry["hash"] != new_hash:
+                self.modified.add(file_path)
+            elif not is_racy: # unchanged, so cache the new stat info
+                index_entry.update(get_stat_info(file_stat))
+                self.index_needs_refresh = True
+        if fsmonitor_changes is not None:
+            # everything else matched the index as of the new token
+            dirty_paths = {path.rstrip(os.sep) for path in self.modified | self.added | self.deleted}
+            self.fsmonitor_state = FsMonitorState(fsmonitor_changes[0], dirty_paths)
+            if fsmonitor_changes[1] is None: # save the token, so the next comparison can build on this full walk
+                self.index_needs_refresh = True
+        return self
+
+    def _compare_paths(self, paths: set, sorted_paths: list) -> None:
+        """
+        Compare only the given paths (files or dirs) to the index, as everything else is known to match it.
+        The results are the same as comparing the whole working dir
+        """
+        compared_dir = None
+        for path in sort_paths_top_down(paths):
+            if compared_dir is not None and path.startswith(compared_dir + os.sep):
+                continue # already compared as part of a dir
+            path_type = get_path_type(os.path.join(self.repo.root, path))
+            if self.ignore_matcher.is_ignored(path, is_dir=path_type == "dir"):
+                continue
+            lo, hi = self._get_indexed_range(sorted_paths, path)
+            if path_type != "file" and path in self.index: # deleted, or replaced by a dir
+                self._mark_deleted([path], 0, 1)
+            if path_type != "dir": # so nothing in the index can be inside it any more
+                self._mark_deleted(sorted_paths, lo, hi)
+                compared_dir = path
+            if path_type is None:
+                continue
+            # a dir with nothing in the index is shown rather than its contents, so look for the shallowest one
+            untracked_dir = self._find_untracked_dir(path if path_type == "dir" else os.path.dirname(path), sorted_paths)
+            if untracked_dir is not None:
+                if self.walker.contains_file(untracked_dir):
+                    self.added.add(untracked_dir + os.sep)
+                compared_dir = untracked_dir
+            elif path_type == "dir":
+                self._compare_dir(path, sorted_paths, lo, hi)
+                compared_dir = path
+            elif path in self.index:
+                abs_path = os.path.join(self.repo.root, path)
+                self._compare_file(path, abs_path, os.stat(abs_path))
+            else:
+                self.added.add(path)
+
+    def _find_untracked_dir(self, dir_path: str, sorted_paths: list) -> str|None:
+        """ The shallowest dir, out of dir_path and the dirs above it, that has nothing inside it in the index """
+        parts = dir_path.split(os.sep) if dir_path else []
+        for depth in range(1, len(parts) + 1):
+            ancestor_path = os.sep.join(parts[:depth])
+            lo, hi = self._get_indexed_range(sorted_paths, ancestor_path)
+            if lo == hi:
+                return ancestor_path
+        return None
+
+    @staticmethod
+    def _get_indexed_range(sorted_paths: list, dir_path: str) -> tuple[int, int]:
+        """ sorted_paths[lo:hi] are the index entries inside dir_path """
+        lo = bisect_left(sorted_paths, dir_path + os.sep)
+        return lo, bisect_left(sorted_paths, dir_path + chr(ord(os.sep) + 1), lo)
+
+    def _compare_dir(self, dir_path: str, sorted_paths: list, lo: int, hi: int) -> None:
+        """ dir_path is relative to the repo root, and sorted_paths[lo:hi] are the index entries inside it """
+        working_children = self.walker.list_dir(dir_path)
+        indexed_children = [
+            (name + os.sep if child_hi is not None else name, child_path, child_lo, child_hi)
+            for name, child_path, child_lo, child_hi in self.tree._iter_dir_children(sorted_paths, dir_path, lo, hi)
+        ]
+        i = j = 0
+        while i < len(working_children) or j < len(indexed_children):
+            working_key = working_children[i][0] if i < len(working_children) else None
+            indexed_key = indexed_children[j][0] if j < len(indexed_children) else None
+            if indexed_key is None or (working_key is not None and working_key < indexed_key): # untracked
+                _, dir_entry = working_children[i]
+                i += 1
+                child_path = os.path.join(dir_path, dir_entry.name)
+                if dir_entry.is_dir():
+                    # only show the shallowest untracked dir, rather than listing its entire contents
+                    if self.walker.contains_file(child_path):
+                        self.added.add(child_path + os.sep)
+                else:
+                    self.added.add(child_path)
+            elif working_key is None or indexed_key < working_key: # in the index, but not the working dir
+                _, child_path, child_lo, child_hi = indexed_children[j]
+                j += 1
+                self._mark_deleted(sorted_paths, child_lo, child_hi if child_hi is not None else child_lo + 1)
+            else: # on both sides
+                _, dir_entry = working_children[i]
+                _, child_path, child_lo, child_hi = indexed_children[j]
+                i += 1
+                j += 1
+                if child_hi is None:
+                    self._compare_file(child_path, dir_entry.path, dir_entry.stat())
+                else:
+                    self._compare_dir(child_path, sorted_paths, child_lo, child_hi)
+
+    def _compare_file(self, file_path: str, abs_path: str, file_stat: os.stat_result) -> None:
+        index_entry = self.index[file_path]
+        if index_entry["mode"] != get_file_mode(abs_path, file_stat):
+            self.modified.add(file_path)
+            return
+        # only re-hash the file if its stat info suggests it may have changed
+        is_racy = self.repo.is_racy_entry(index_entry)
+        if stat_info_matches(index_entry, file_stat) and not is_racy:
+            return
+        self._hashing_pool.submit((file_path, file_stat, is_racy), size=file_stat.st_size)
+
+    def _hash_file(self, item: tuple) -> str:
+        file_path, _, _ = item
+        return self._blob.serialise(os.path.join(self.repo.root, file_path), write_to_file=False)
+
+    def _mark_deleted(self, sorted_paths: list, lo: int, hi: int) -> None:
+        for file_path in sorted_paths[lo:hi]:
+            if not self.ignore_matcher.is_ignored(file_path, is_dir=False):
+                self.deleted.add(file_path)
+
+
+class StagingPipeline:
+    """
+    Stages files: each file is hashed, compressed and written to the object store on a pool of threads,
+    so objects are being written while other files are still being hashed.
+    The index entries are only updated once every file is done (in finish), so the index is written in one go.
+    Files whose stat info shows they haven't changed since they were staged are skipped entirely
+    """
+    def __init__(self, repo: Repository, index: dict):
+        self.repo = repo
+        self.index = index
+        self.num_files = 0
+        self._blob = Blob(repo)
+        # created up front, so the worker threads never race to create them
+        repo.object_writer
+        repo.packs.packs
+        self._writing_pool = BatchedThreadPool(self._write_blob, repo.get_num_threads())
+
+    def add_file(self, file_path: str, file_stat: os.stat_result|None = None) -> None:
+        """ file_stat can be passed in if the file has already been stat'd (eg from a DirEntry) """
+        self.num_files += 1
+        abs_path = os.path.join(self.repo.root, file_path)
+        # stat before hashing, so if the file changes mid-hash, the stat info won't match next time
+        if file_stat is None:
+            file_stat = os.stat(abs_path)
+        file_mode = get_file_mode(abs_path, file_stat)
+        existing_entry = self.index.get(file_path)
+        if (existing_entry and existing_entry["mode"] == file_mode and stat_info_matches(existing_entry, file_stat)
+                and not self.repo.is_racy_entry(existing_entry)):
+            return # unchanged since it was staged, so there's nothing to hash or write
+        self._writing_pool.submit((file_path, file_mode, file_stat), size=file_stat.st_size)
+
+    def add_dir(self, walker: WorkingDirWalker, dir_path: str, changed_paths: set|None = None) -> None:
+        """
+        Stage every (non-ignored) file in dir_path ("" for the whole repo), however deep,
+        and the deletion of any tracked files in it that no longer exist.
+        If changed_paths is given (from the filesystem monitor), everything else is known to match the index,
+        so only those paths are looked at
+        """
+        prefix = dir_path + os.sep if dir_path else ""
+        if changed_paths is None:
+            paths_to_check = [dir_path]
+        else:
+            paths_to_check = sort_paths_top_down(path for path in changed_paths if path.startswith(prefix))
+        files_found = set()
+        walked_dir = None
+        for path in paths_to_check:
+            if walked_dir is not None and path.startswith(walked_dir + os.sep):
+                continue
+            path_type = get_path_type(os.path.join(self.repo.root, path))
+            if path_type is None or (path != dir_path and walker.ignore_matcher.is_ignored(path, path_type == "dir")):
+                continue
+            if path_type == "file":
+                files_found.add(path)
+                self.add_file(path)
+                continue
+            for walked_dir_path, children in walker.walk(path):
+                for _, dir_entry in children:
+                    if not dir_entry.is_dir():
+                        file_path = os.path.join(walked_dir_path, dir_entry.name)
+                        files_found.add(file_path)
+                        self.add_file(file_path, dir_entry.stat())
+            walked_dir = path
+        # tracked files that were looked for but not found have been deleted, and the rest are unchanged
+        for file_path in get_indexed_paths_in_dir(self.index, dir_path):
+            if file_path in files_found:
+                continue
+            was_checked = changed_paths is None or any(
+                ancestor_path in changed_paths for ancestor_path in _iter_path_and_parents(file_path)
+            )
+            if walker.ignore_matcher.is_ignored(file_path, is_dir=False):
+                continue
+            if was_checked:
+                self.remove_file(file_path)
+            else:
+                self.num_files += 1
+
+    def remove_file(self, file_path: str) -> None:
+        """ Stage the deletion of a file """
+        self.num_files += 1
+        self.index.pop(file_path, None)
+
+    def finish(self) -> None:
+        for (file_path, file_mode, file_stat), file_hash in self._writing_pool.finish():
+            self.index[file_path] = {
+                "type": "blob",
+                "mode": file_mode,
+                "hash": file_hash,
+                **get_stat_info(file_stat)
+            }
+
+    def _write_blob(self, item: tuple) -> str:
+        file_path, _, _ = item
+        return self._blob.serialise(os.path.join(self.repo.root, file_path), write_to_file=True)
+
+
+class CheckoutExecutor:
+    """
+    Updates the working directory to match a checkout:
+    - deleted files go first, then any directories that leaves empty are removed, deepest first
+    - every directory the new files need is created in a single pass (parents before children)
+    - the files are then decompressed and written on a pool of threads (small files grouped per task),
+      with each file's mode set from its tree entry
+    The entries passed in get the written files' stat info, so they can go straight into the index
+    """
+    def __init__(self, repo: Repository):
+        self.repo = repo
+        self._blob = Blob(repo)
+
+    def run(self, files_to_delete: list, files_to_write: dict) -> None:
+        """ files_to_delete are paths, and files_to_write is {path: entry} - all relative to the repo root """
+        self._delete_files(files_to_delete)
+        self._create_dirs(files_to_write)
+        # created up front, so the worker threads never race to create them
+        self.repo.packs.packs
+        writing_pool = BatchedThreadPool(self._write_file, self.repo.get_num_threads())
+        for file_path in sorted(files_to_write):
+            writing_pool.submit((file_path, files_to_write[file_path]))
+        for (file_path, entry), file_stat in writing_pool.finish():
+            entry.update(get_stat_info(file_stat))
+
+    def _delete_files(self, files_to_delete: list) -> None:
+        dirs_to_check = set()
+        for file_path in files_to_delete:
+            os.remove(os.path.join(self.repo.root, file_path))
+            dir_path = os.path.dirname(file_path)
+            while dir_path and dir_path not in dirs_to_check:
+                dirs_to_check.add(dir_path)
+                dir_path = os.path.dirname(dir_path)
+        # deepest first, so a directory's subdirectories have already been removed (if they're now empty)
+        for dir_path in sorted(dirs_to_check, key=lambda dir_path: dir_path.count(os.sep), reverse=True):
+            try:
+                os.rmdir(os.path.join(self.repo.root, dir_path))
+            except OSError: # not empty
+                pass
+
+    def _create_dirs(self, files_to_write: dict) -> None:
+        dirs_needed = set()
+        for file_path in files_to_write:
+            dir_path = os.path.dirname(file_path)
+            while dir_path and dir_path not in dirs_needed:
+                dirs_needed.add(dir_path)
+                dir_path = os.path.dirname(dir_path)
+        # sorted, so every directory comes after its parent
+        for dir_path in sorted(dirs_needed):
+            try:
+                os.mkdir(os.path.join(self.repo.root, dir_path))
+            except FileExistsError:
+                pass
+
+    def _write_file(self, item: tuple) -> os.stat_result:
+        file_path, entry = item
+        abs_path = os.path.join(self.repo.root, file_path)
+        self._blob.copy_object_to_file(entry["hash"], abs_path, expected_type="blob")
+        file_stat = os.stat(abs_path)
+        permissions = int(entry["mode"], 8) & 0o777
+        if file_stat.st_mode & 0o777 != permissions:
+            os.chmod(abs_path, permissions)
+            file_stat = os.stat(abs_path)
+        return file_stat